@@ -1,11 +1,29 @@
 from .actor import ActorConfig, Actor
-from .base import AgentConfig, Agent
+from .base import AgentConfig, Agent, ImageBudget, IMAGE_BUDGETS, get_image_budget, RunUsage, RUN_USAGE
 from .critic import (
     CriticConfig,
+    CascadeConfig,
     Critic,
     TextCriticConfig,
     TextCritic,
     VisionCriticConfig,
-    VisionCritic
+    VisionCritic,
+    CombinedCriticConfig,
+    CombinedCritic,
+    RankingCriticConfig,
+    RankingCritic,
+    PARSE_STATS,
+    RUN_PARSE_STATS,
+    parse_failure_rate,
+    clear_parse_stats,
+    parse_critic_response
 )
-from .prompt.get_sys_prompt import get_sys_prompt
\ No newline at end of file
+from .cache import LLMResponseCache, CachedLLM, get_response_cache
+from .usage import extract_usage, call_with_usage
+from .registry import PooledLLM, ClientRegistry, CLIENT_REGISTRY, get_client
+from .hedge import HedgedLLM, LatencyTracker, get_latency_tracker
+from .telemetry import Telemetry, TELEMETRY
+from .tracing import Tracer, TRACER, traced, trace_run
+from .gateway import ProviderLimits, PROVIDER_LIMITS, ProviderGateway, GatewayLLM, get_gateway, gateway_stats
+from .executor import CriticExecutor, get_critic_executor
+from .prompt.get_sys_prompt import get_sys_prompt, PromptRegistry, PROMPT_REGISTRY
\ No newline at end of file
@@ -1,17 +1,22 @@
 from pydantic import BaseModel, Field
-from typing import Union
+from typing import Union, List
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import os
 import sys 
+import time
+import logging
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(current_dir, '..'))
 
 # import dotenv
 # dotenv.load_dotenv(os.path.join(current_dir, '..', '.env'))
 
-from agent.prompt.get_sys_prompt import get_sys_prompt
+from agent.prompt.get_sys_prompt import PROMPT_REGISTRY, PROMPT_FILES
 from agent.base import AgentConfig, Agent
-from utils import open_image
+from agent.gateway import get_provider, estimate_tokens
+from agent.tracing import traced
+from utils import open_image, CodeFenceParser
 
 class ActorConfig(AgentConfig):
     """
@@ -20,6 +25,27 @@ class ActorConfig(AgentConfig):
     name: str = Field(default='Actor Agent', description="Purpose of the agent")
     module_name: str = 'actor'
     code: str = Field(default='python', description="Code type: either python or html")
+    edit_format: str = Field(default='full', description="Refinement output: 'full' program, or 'search_replace' edit blocks against the previous code")
+    stream: bool = Field(default=False, description="Stream the generation and stop it once the code block is closed and stream_tail_chars of text followed it")
+    stream_tail_chars: int = Field(default=200, description="Text read after a closed code block without a new block opening before the stream is cut, so that a final block after a sketch is not missed")
+    native_samples: bool = Field(default=True, description="Draw several samples in one request with the provider's n parameter where it is supported")
+
+# Providers whose clients accept n and return a list of responses
+N_SAMPLING_PROVIDERS = ('openai',)
+
+# Models whose client answered a request with n by a single response, sampled with separate requests from then on
+N_IGNORED_MODELS = set()
+
+EDIT_INSTRUCTIONS = """### Output format:
+Do not rewrite the whole program. Return only the changes to the previous code as search/replace blocks:
+
+<<<<<<< SEARCH
+exact lines of the previous code to change
+=======
+new lines
+>>>>>>> REPLACE
+
+Copy the SEARCH lines exactly, including indentation, and keep them short but unique. Use several blocks for several changes, in order."""
 
 class Actor(Agent):
     """
@@ -31,23 +57,27 @@ class Actor(Agent):
         super().__init__(config=config)
 
     def get_sys_prompt(self) -> str:
-        
-        code_snippet = ""
+        """
+        Get the system prompt of the actor: the actor prompt followed by the code sample of the configured language.
+        The prompt is assembled once and rebuilt only when one of the files changes.
+        """
         if self.config.code == 'python':
-            code_snippet = "### Code sample for python chart:\n\n"
-            
-            with open(os.path.join(current_dir, '..', 'example', 'chart.py'), 'r') as f:
-                code_snippet += '```python\n' + f.read() + '\n```'
+            header = "### Code sample for python chart:\n\n"
+            example_path = os.path.join(current_dir, '..', 'example', 'chart.py')
         elif self.config.code == 'html':
-            code_snippet = "### Code sample for html chart:"
-            
-            with open(os.path.join(current_dir, '..', 'example', 'chart.html'), 'r') as f:
-                code_snippet += '```html\n' + f.read() + '\n```'
+            header = "### Code sample for html chart:"
+            example_path = os.path.join(current_dir, '..', 'example', 'chart.html')
         else:
             raise ValueError(f"Unsupported code type: {self.config.code}")
-        
-        
-        return get_sys_prompt(self.config.module_name) + f"\n\n{code_snippet}"
+
+        prompt_path = os.path.join(current_dir, 'prompt', PROMPT_FILES[self.config.module_name])
+        language = self.config.code
+
+        def build(prompt: str, example: str) -> str:
+            code_snippet = header + f'```{language}\n' + example + '\n```'
+            return prompt.strip() + f"\n\n{code_snippet}"
+
+        return PROMPT_REGISTRY.assemble(f"{self.config.module_name}_{language}", (prompt_path, example_path), build)
 
     def python_prompt(self, action:str, prev_state_code: str = None, prev_state_critique: str = None):
 
@@ -89,20 +119,90 @@ class Actor(Agent):
 { prev_state_critique if prev_state_critique else "" }"""
 
 
-    def act(self, 
-            request: str, 
-            image : Union[str, Image.Image] = None, 
-            prev_state_code: str = None, 
-            prev_state_critique: str = None,
-            run_name: str = None,
-            tag: str = None) -> dict:
+    def cache_prompt(self, request: str, prev_state_code: str = None, prev_state_critique: str = None) -> tuple:
         """
-        Perform an action with the given parameters.
+        Split the user prompt into a static part (language and task) and a volatile part (previous code and critique),
+        for the 'cache' message layout.
 
-        :param request: The action to perform.
-        :return: Result of the action.
+        :return: Tuple of the static and the volatile prompts.
+        """
+        static_prompt = f"""
+<image>
+### Code language: {self.config.code}
+
+### Task: 
+{request}
+"""
+        volatile_prompt = ""
+        if prev_state_code:
+            volatile_prompt += f"### Previous code for chart: \n\n{prev_state_code}\n\n"
+        if prev_state_critique:
+            volatile_prompt += f"### Previous critique on the chart: \n\n{prev_state_critique}\n"
+
+        return static_prompt.strip(), volatile_prompt.strip()
+
+    def stream_action(self, messages: list, run_name: str = None, tag: str = None, images_path = None, **kwargs) -> Union[dict, None]:
+        """
+        Stream the generation and cancel it once the code block of the configured language is closed
+        and followed by stream_tail_chars of text, so that most of the explanation the model writes
+        after the code is never generated.
+
+        The action is the last closed code block, the one the environment renders from a full response.
+        A cancelled stream reports no usage, so the tokens are estimated from the messages and the text received.
+
+        :return: Dictionary with the action, the token usage and the streaming stats, or None if the model cannot stream.
+        """
+        start = time.perf_counter()
+        chunks = self.stream_llm(messages, run_name=run_name, tag=tag, images_path=images_path, **kwargs)
+        if chunks is None:
+            return None
+
+        parser = CodeFenceParser(self.config.code, tail_chars=self.config.stream_tail_chars)
+        time_to_first_token = None
+        stopped_early = False
+        try:
+            for chunk in chunks:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                if parser.feed(chunk or ''):
+                    stopped_early = True
+                    break
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        parser.finish()
+
+        usage = {
+            'input_tokens': estimate_tokens(messages),
+            'output_tokens': len(parser.text) // 4,
+            'cached_tokens': 0,
+            'cached_ratio': 0.0,
+            'estimated': True
+        }
+        self.add_usage(usage, run_name=run_name)
+        self.record_call(start, usage, run_name=run_name, tag=tag, time_to_first_token=time_to_first_token)
+
+        return {
+            'action': parser.response(),
+            'usage': usage,
+            'stream': {
+                'stopped_early': stopped_early,
+                'time_to_code': time.perf_counter() - start if parser.done else None,
+                'generated_chars': len(parser.text),
+                'code_blocks': len(parser.blocks)
+            }
+        }
+
+    def build_messages(self,
+                       request: str,
+                       image: Union[str, Image.Image] = None,
+                       prev_state_code: str = None,
+                       prev_state_critique: str = None) -> tuple:
         """
+        Build the messages of an actor request.
 
+        :return: Tuple of the messages, the path of the input image (None for a PIL image) and the estimated image tokens.
+        """
         if isinstance(image, Image.Image) and self.config.image_path:
             raise ValueError("Image should be a path string, since force use image_path is set to True.")
 
@@ -116,15 +216,23 @@ class Actor(Agent):
         else:
             image_path = None
 
+        image, image_tokens = self.fit_image(image)
+
         sys_prompt = self.get_sys_prompt()
 
         if self.config.prompt_adjust != '':
             sys_prompt = f"{sys_prompt}\n\n### Notice:\n {self.config.prompt_adjust}"
 
-        if self.config.code == 'html':
-            user_prompt = self.html_prompt(request, prev_state_code, prev_state_critique)
+        if self.config.message_layout == 'cache':
+            # Input image and task stay byte-identical across iterations, the previous state comes last
+            user_prompts = self.cache_prompt(request, prev_state_code, prev_state_critique)
+        elif self.config.code == 'html':
+            user_prompts = [self.html_prompt(request, prev_state_code, prev_state_critique)]
         else:
-            user_prompt = self.python_prompt(request, prev_state_code, prev_state_critique)
+            user_prompts = [self.python_prompt(request, prev_state_code, prev_state_critique)]
+
+        if self.config.edit_format == 'search_replace' and prev_state_code:
+            user_prompts = list(user_prompts) + [EDIT_INSTRUCTIONS]
 
         content = []
         if isinstance(image, Image.Image):
@@ -132,10 +240,12 @@ class Actor(Agent):
                 'type': 'image',
                 'image': image
             })
-        content.append({
-            'type': 'text',
-            'text': user_prompt.strip()
-        })
+        for user_prompt in user_prompts:
+            if user_prompt.strip():
+                content.append({
+                    'type': 'text',
+                    'text': user_prompt.strip()
+                })
 
         messages = [
             {
@@ -148,21 +258,109 @@ class Actor(Agent):
             }
         ]
 
-        if self.config.logger:
-            action = self.llm(messages, run_name=run_name, tag=f'Actor_{tag}', images_path=image_path)
+        return messages, image_path, image_tokens
+
+    @traced('actor.act', 'actor')
+    def act(self, 
+            request: str, 
+            image : Union[str, Image.Image] = None, 
+            prev_state_code: str = None, 
+            prev_state_critique: str = None,
+            run_name: str = None,
+            tag: str = None,
+            temperature: float = None,
+            sample: int = None) -> dict:
+        """
+        Perform an action with the given parameters.
+
+        :param request: The action to perform.
+        :param temperature: Sampling temperature of the request, the provider default when None.
+        :param sample: Index of the sample when several actions are drawn for the same state, keeps them apart in the response cache.
+        :return: Result of the action.
+        """
+        messages, image_path, image_tokens = self.build_messages(request, image, prev_state_code, prev_state_critique)
+        kwargs = {'temperature': temperature} if temperature is not None else {}
+
+        streamed = self.stream_action(messages, run_name=run_name, tag=f'Actor_{tag}', images_path=image_path, **kwargs) if self.config.stream else None
+
+        if streamed is not None:
+            action, usage = streamed['action'], streamed['usage']
         else:
-            action = self.llm(messages)
+            action, usage = self.call_llm(messages, run_name=run_name, tag=f'Actor_{tag}', images_path=image_path,
+                                          image_tokens=image_tokens['tokens_after'] if image_tokens else None, sample=sample, **kwargs)
 
         if self.config.debug:
             print(f"Action: {action}")
 
-        return {
-            'action': action
+        result = {
+            'action': action,
+            'image_tokens': image_tokens,
+            'usage': usage
         }
+        if streamed is not None:
+            result['stream'] = streamed['stream']
+        return result
 
     def act_with_prev_state(self, *args, **kwargs) -> dict:
         return self.act(*args, **kwargs)
 
+    @traced('actor.sample', 'actor')
+    def sample(self,
+               request: str,
+               image: Union[str, Image.Image] = None,
+               prev_state_code: str = None,
+               prev_state_critique: str = None,
+               num_samples: int = 2,
+               run_name: str = None,
+               tag: str = None) -> List[dict]:
+        """
+        Draw several actions for the same state.
+
+        The samples come from one request with the provider's n parameter where it is supported,
+        or from parallel requests. Streaming is not used. Every sample has its own key in the
+        response cache, so cached runs replay the same distinct samples.
+
+        :param num_samples: Number of actions to draw.
+        :return: List of results, in the format of act.
+        """
+        messages, image_path, image_tokens = self.build_messages(request, image, prev_state_code, prev_state_critique)
+        tokens_after = image_tokens['tokens_after'] if image_tokens else None
+
+        actions = []
+        usage = None
+        model_name = self.config.model_name
+        if self.config.native_samples and get_provider(model_name) in N_SAMPLING_PROVIDERS and model_name not in N_IGNORED_MODELS:
+            try:
+                response, usage = self.call_llm(messages, run_name=run_name, tag=f'Actor_{tag}_samples', images_path=image_path,
+                                                image_tokens=tokens_after, n=num_samples)
+            except TypeError:
+                # The client does not take n
+                response = None
+                N_IGNORED_MODELS.add(model_name)
+            if isinstance(response, (list, tuple)):
+                actions = list(response)
+            elif response is not None:
+                # A single string: the client dropped n or joined the choices, neither can be split into samples
+                logging.warning(f"The client of {model_name} ignored n, drawing the samples with separate requests")
+                N_IGNORED_MODELS.add(model_name)
+
+        results = [{'action': action, 'image_tokens': image_tokens, 'usage': usage} for action in actions[:num_samples]]
+
+        missing = num_samples - len(results)
+        if missing > 0:
+            def draw(index: int) -> dict:
+                action, usage = self.call_llm(messages, run_name=run_name, tag=f'Actor_{tag}_sample_{index + 1}', images_path=image_path,
+                                              image_tokens=tokens_after, sample=index)
+                return {'action': action, 'image_tokens': image_tokens, 'usage': usage}
+
+            with ThreadPoolExecutor(max_workers=missing) as executor:
+                results += list(executor.map(draw, range(len(results), num_samples)))
+
+        if self.config.debug:
+            print(f"Drew {len(results)} samples, {len(actions)} from a single request")
+
+        return results
+
     def __str__(self):
         """
         String representation of the actor.
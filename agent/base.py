@@ -1,18 +1,125 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 import os
 import sys 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from llm import get_llm_wrapper, get_rotate_llm_wrapper
-from llm.logger.log_mongodb import LLMLogMongoDB
-from llm.logger.log_postgres import LLMLogPostgres
+from PIL import Image
+from typing import Union, Tuple
+import time
+import hashlib
+import threading
 import logging
 
+from utils import fit_image_to_budget, estimate_image_tokens
+from agent.cache import CachedLLM, SAMPLE_KWARG, get_response_cache
+from agent.gateway import GatewayLLM, ProviderLimits, get_gateway
+from agent.registry import get_client
+from agent.usage import extract_usage, call_with_usage
+from agent.hedge import HedgedLLM
+from agent.telemetry import TELEMETRY
+from agent.tracing import traced
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_image_stats_lock = threading.Lock()
+_usage_stats_lock = threading.Lock()
+
+
+class RunUsage:
+    """
+    Token usage of the calls of every run, summed per model from the usage each call reports.
+
+    Agents are shared by concurrent runs, so their usage_stats mix the calls of every run; the
+    run_name passed to the calls tells the runs apart here.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs: Dict[str, Dict[str, dict]] = {}
+
+    def add(self, run_name: str, model_name: str, usage: dict) -> None:
+        """
+        Add the usage of one call to its run.
+        """
+        with self._lock:
+            model_usage = self._runs.setdefault(run_name, {}).setdefault(model_name, {'input_tokens': 0, 'output_tokens': 0})
+            model_usage['input_tokens'] += usage.get('input_tokens', 0)
+            model_usage['output_tokens'] += usage.get('output_tokens', 0)
+
+    def get(self, run_name: str) -> Dict[str, dict]:
+        """
+        Snapshot of the usage of a run so far, keyed by model.
+        """
+        with self._lock:
+            return {model_name: dict(model_usage) for model_name, model_usage in self._runs.get(run_name, {}).items()}
+
+    def pop(self, run_name: str) -> Dict[str, dict]:
+        """
+        Usage of a run, dropped from the registry.
+        """
+        with self._lock:
+            return self._runs.pop(run_name, {})
+
+
+RUN_USAGE = RunUsage()
+
+
+class ImageBudget(BaseModel):
+    """
+    How a vision model bills images, used to send images at the cheapest readable size.
+    """
+    tile_size: int = Field(default=512, description="Side of the tiles the provider bills, in pixels")
+    max_tiles: int = Field(default=6, description="Maximum number of tiles to pay for per image")
+    base_tokens: int = Field(default=85, description="Tokens billed for every image")
+    tile_tokens: int = Field(default=170, description="Tokens billed per tile")
+    max_side: int = Field(default=2048, description="Longest side accepted by the provider")
+    short_side: Optional[int] = Field(default=768, description="Shortest side the provider downscales to, None if it does not")
+    min_side: int = Field(default=1024, description="Minimum longest side for chart text to stay readable")
+    format: str = Field(default='png', description="Preferred format for resized images written to disk, png or jpeg")
+
+
+# Approximate billing of the model families we use, matched on the model name prefix
+IMAGE_BUDGETS = {
+    'gpt': ImageBudget(),
+    'gemini': ImageBudget(tile_size=768, max_tiles=4, base_tokens=0, tile_tokens=258, max_side=3072, short_side=None),
+    'google:gemma': ImageBudget(tile_size=896, max_tiles=1, base_tokens=0, tile_tokens=256, max_side=896, short_side=None, min_side=896),
+    'nim:google/gemma': ImageBudget(tile_size=896, max_tiles=1, base_tokens=0, tile_tokens=256, max_side=896, short_side=None, min_side=896),
+    'nim:meta/llama-3.2': ImageBudget(tile_size=560, max_tiles=4, base_tokens=0, tile_tokens=1601, max_side=1120, short_side=None, min_side=1120),
+    'nim:meta/llama-4': ImageBudget(tile_size=336, max_tiles=16, base_tokens=144, tile_tokens=144, max_side=1344, short_side=None, format='jpeg'),
+}
+
+
+def get_image_budget(model_name: str) -> ImageBudget:
+    """
+    Get the image budget of a model, the longest matching prefix in IMAGE_BUDGETS wins.
+
+    :param model_name: Name of the model.
+    :return: Image budget of the model, the default budget if the model is unknown.
+    """
+    matches = [prefix for prefix in IMAGE_BUDGETS if model_name and model_name.startswith(prefix)]
+    if not matches:
+        return ImageBudget()
+    return IMAGE_BUDGETS[max(matches, key=len)]
+
+
+def gateway_call(llm) -> dict:
+    """
+    Queue time and retries of the last gateway call of the current thread, searched through the wrappers of llm.
+    """
+    while llm is not None:
+        if isinstance(llm, HedgedLLM):
+            # The requests ran on the hedge threads, the hedged client hands back the call of the winning one
+            return llm.last_call() or {}
+        gateway = llm.__dict__.get('gateway') if hasattr(llm, '__dict__') else None
+        if gateway is not None:
+            return gateway.last_call() or {}
+        llm = llm.__dict__.get('llm') if hasattr(llm, '__dict__') else None
+    return {}
+
+
 class AgentConfig(BaseModel):
     """
     Configuration for the agent.
@@ -24,6 +131,21 @@ class AgentConfig(BaseModel):
     rotate: bool = Field(default=False, description="Enable rotation of the model for the agent")
     image_path: Optional[bool] = Field(default=False, description="Whether to force use image_path to communicate with the agent, default is False")
     prompt_adjust: Optional[str] = Field(default='', description="Adjust the prompt for the agent, either 'keep', 'shrink' or 'text'")
+    image_budget: Optional[ImageBudget] = Field(default=None, description="Image billing of the model, resolved from IMAGE_BUDGETS when not set")
+    fit_images: bool = Field(default=True, description="Resize images to the cheapest readable size for the model before sending them")
+    fit_folder: str = Field(default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'temp', 'fit'), description="Folder of the resized copies of images given as paths")
+    hedge: bool = Field(default=False, description="Send a duplicate of calls slower than hedge_percentile of the recent latencies and keep the first answer")
+    hedge_percentile: float = Field(default=0.95, description="Latency percentile of the model after which a call is hedged")
+    hedge_budget: float = Field(default=0.1, description="Maximum share of the calls that can be hedged")
+    hedge_models: List[str] = Field(default_factory=list, description="Fallback models for the hedge requests, another key of the same model (rotation) when empty, which needs rotate off")
+    gateway: bool = Field(default=True, description="Send every call through the rate-limited gateway of the model provider and API key pool, shared by every agent of the process")
+    gateway_limits: Optional[ProviderLimits] = Field(default=None, description="Rate limits of the gateway, PROVIDER_LIMITS of the provider when not set")
+    cache: str = Field(default='off', description="LLM response cache: 'off', 'read-write' or 'replay' (only serve cached responses)")
+    cache_path: str = Field(default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'temp', 'llm_cache.sqlite'), description="Path to the SQLite database of the LLM response cache")
+    message_layout: str = Field(default='default', description="Message layout: 'default', or 'cache' to put the static content first so provider prefix caching hits")
+    telemetry: bool = Field(default=False, description="Record the latency, tokens, queue time and retries of every call in the process-wide telemetry, enabled for every agent once one agent turns it on")
+    telemetry_path: Optional[str] = Field(default=None, description="JSONL file the telemetry call records are appended to, None to keep only the histograms")
+
 class Agent(BaseModel):
     """
     Represents an agent that can perform actions based on the provided configuration.
@@ -31,6 +153,8 @@ class Agent(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
     config: AgentConfig
     llm: Optional[object] = Field(default=None, description="Language model used by the agent")
+    usage_stats: dict = Field(default_factory=lambda: {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0}, description="Token usage reported by the provider, summed over calls")
+    image_stats: dict = Field(default_factory=lambda: {'images': 0, 'tokens_before': 0, 'tokens_after': 0, 'tokens_saved': 0}, description="Estimated image tokens saved by fitting images to the model budget")
 
     def __init__(self, config: AgentConfig):
         """
@@ -38,24 +162,202 @@ class Agent(BaseModel):
 
         :param config: Configuration for the agent.
         """
-        super().__init__(config=config)
         if config.model_name is None:
             raise ValueError("Model name must be provided in the configuration.")
 
-        if config.rotate:
-            self.llm = get_rotate_llm_wrapper(config.model_name, multimodal=True)
+        if config.image_budget is None:
+            # The caller's config and the IMAGE_BUDGETS entries are left untouched
+            config = config.model_copy(update={'image_budget': get_image_budget(config.model_name).model_copy()})
+        super().__init__(config=config)
+
+        # Agents with the same model, rotation and logger share one client
+        self.llm = get_client(config.model_name, multimodal=True, rotate=config.rotate, logger=config.logger)
+
+        if config.gateway:
+            self.llm = GatewayLLM(self.llm, get_gateway(config.model_name, 'rotate' if config.rotate else 'default', config.gateway_limits))
+
+        if config.hedge:
+            # Each hedge client goes through the gateway of its own provider
+            hedges = []
+            for model_name in config.hedge_models or [config.model_name]:
+                # Hedging on the primary model only helps through other keys; when the primary already
+                # rotates this is the primary client itself, which HedgedLLM refuses
+                rotate = config.rotate or model_name == config.model_name
+                hedge = get_client(model_name, multimodal=True, rotate=rotate, logger=config.logger)
+                limits = config.gateway_limits if model_name == config.model_name else None
+                hedges.append(GatewayLLM(hedge, get_gateway(model_name, 'rotate' if rotate else 'default', limits)) if config.gateway else hedge)
+            self.llm = HedgedLLM(self.llm, hedges, config.model_name,
+                                 percentile=config.hedge_percentile,
+                                 budget=config.hedge_budget)
+
+        if config.telemetry and not TELEMETRY.enabled:
+            TELEMETRY.configure(enabled=True, jsonl_path=config.telemetry_path)
+
+        if config.cache != 'off':
+            logging.info(f"Using LLM response cache in {config.cache} mode")
+            self.llm = CachedLLM(self.llm, get_response_cache(config.cache_path, config.cache), config.model_name)
+
+    def record_call(self, start: float, usage: Optional[dict], run_name: str = None, tag: str = None,
+                    image_tokens: Optional[int] = None, time_to_first_token: Optional[float] = None) -> None:
+        """
+        Record the latency, tokens, queue time and retries of a call in the telemetry, when it is enabled.
+
+        The queue time and retries come from the gateway and are left empty when config.gateway is off.
+        """
+        if not TELEMETRY.enabled:
+            return
+        gateway = gateway_call(self.llm)
+        TELEMETRY.record(getattr(self.config, 'module_name', self.config.name), self.config.model_name,
+                         run_name=run_name,
+                         tag=tag,
+                         latency=time.perf_counter() - start,
+                         queue_time=gateway.get('queue_time'),
+                         retries=gateway.get('retries'),
+                         time_to_first_token=time_to_first_token,
+                         input_tokens=usage['input_tokens'] if usage else None,
+                         output_tokens=usage['output_tokens'] if usage else None,
+                         image_tokens=image_tokens)
+
+    def add_usage(self, usage: Optional[dict], run_name: str = None) -> None:
+        """
+        Add the token usage of a call to usage_stats, and to RUN_USAGE when the call belongs to a run.
+        """
+        if usage is None:
+            return
+        if run_name:
+            RUN_USAGE.add(run_name, self.config.model_name, usage)
+        with _usage_stats_lock:
+            self.usage_stats['calls'] += 1
+            for key in ('input_tokens', 'output_tokens', 'cached_tokens'):
+                self.usage_stats[key] += usage.get(key, 0)
+
+    @traced('llm', 'llm')
+    def call_llm(self, messages: list, run_name: str = None, tag: str = None, images_path = None, image_tokens: Optional[int] = None,
+                 sample: Optional[int] = None, **kwargs) -> Tuple[str, Optional[dict]]:
+        """
+        Call the language model, passing the logging arguments only when a message logger is set.
+
+        :param messages: Messages to send.
+        :param run_name: Name of the run, for the message logger.
+        :param tag: Tag of the call, for the message logger.
+        :param images_path: Paths of the images sent, for the message logger.
+        :param image_tokens: Estimated image tokens sent, for the telemetry.
+        :param sample: Index of the sample when several answers are drawn for the same messages, so that the response cache keeps one answer per sample.
+        :return: Tuple of the response and the token usage reported by the provider (None if not available).
+        """
+        start = time.perf_counter()
+        if sample is not None and isinstance(self.llm, CachedLLM):
+            kwargs[SAMPLE_KWARG] = sample
+        if self.config.logger:
+            log_kwargs = {'run_name': run_name, 'tag': tag}
+            if images_path is not None:
+                log_kwargs['images_path'] = images_path
+            response, usage = call_with_usage(self.llm, messages, **log_kwargs, **kwargs)
+        else:
+            response, usage = call_with_usage(self.llm, messages, **kwargs)
+
+        self.add_usage(usage, run_name=run_name)
+
+        self.record_call(start, usage, run_name=run_name, tag=tag, image_tokens=image_tokens)
+        return response, usage
+
+    def stream_llm(self, messages: list, run_name: str = None, tag: str = None, images_path = None, **kwargs):
+        """
+        Stream the response of the language model chunk by chunk.
+
+        Closing the returned generator cancels the generation.
+
+        :return: Generator of text chunks, or None if the wrapper cannot stream.
+        """
+        stream = getattr(self.llm, 'stream', None)
+        if not callable(stream):
+            return None
+
+        if self.config.logger:
+            log_kwargs = {'run_name': run_name, 'tag': tag}
+            if images_path is not None:
+                log_kwargs['images_path'] = images_path
+            return stream(messages, **log_kwargs, **kwargs)
+        return stream(messages, **kwargs)
+
+    def cached_ratio(self) -> float:
+        """
+        Share of the input tokens served from the provider prompt cache, over all calls.
+        """
+        if not self.usage_stats['input_tokens']:
+            return 0.0
+        return self.usage_stats['cached_tokens'] / self.usage_stats['input_tokens']
+
+    def image_tokens(self, size: Tuple[int, int]) -> int:
+        """
+        Estimate the image tokens billed by the model for an image of the given size.
+        """
+        budget = self.config.image_budget
+        return estimate_image_tokens(*size,
+                                     tile_size=budget.tile_size,
+                                     base_tokens=budget.base_tokens,
+                                     tile_tokens=budget.tile_tokens,
+                                     max_side=budget.max_side,
+                                     short_side=budget.short_side,
+                                     max_tiles=budget.max_tiles)
+
+    def fit_image(self, image: Union[str, Image.Image]) -> Tuple[Union[str, Image.Image], dict]:
+        """
+        Resize an image to the cheapest readable size for the model.
+
+        A PIL image is resized in memory. An image path is kept as a path: if a resize is
+        needed, the resized image is written to config.fit_folder in the preferred format,
+        never next to the source image.
+
+        :param image: PIL Image object or path to the image.
+        :return: Tuple of the image to send and the estimated image tokens before and after.
+        """
+        if image is None or not self.config.fit_images or (isinstance(image, str) and not os.path.exists(image)):
+            return image, None
+
+        budget = self.config.image_budget
+        if isinstance(image, str):
+            with Image.open(image) as source:
+                source.load()
         else:
-            self.llm = get_llm_wrapper(config.model_name, multimodal=True)
-
-        if config.logger == 'mongodb':
-            logging.info("Using MongoDB logger")
-            from llm.logger.log_mongodb import LLMLogMongoDB
-            self.llm = LLMLogMongoDB(self.llm)
-        
-        elif config.logger == 'postgres':
-            logging.info("Using PostgreSQL logger")
-            from llm.logger.log_postgres import LLMLogPostgres
-            self.llm = LLMLogPostgres(self.llm)  
+            source = image
+        fitted = fit_image_to_budget(source,
+                                     tile_size=budget.tile_size,
+                                     max_tiles=budget.max_tiles,
+                                     min_side=budget.min_side,
+                                     max_side=budget.max_side,
+                                     short_side=budget.short_side)
+
+        tokens = {
+            'tokens_before': self.image_tokens(source.size),
+            'tokens_after': self.image_tokens(fitted.size)
+        }
+        tokens['tokens_saved'] = tokens['tokens_before'] - tokens['tokens_after']
+
+        with _image_stats_lock:
+            self.image_stats['images'] += 1
+            for key, value in tokens.items():
+                self.image_stats[key] += value
+
+        if fitted is source:
+            return image, tokens
+
+        if isinstance(image, str):
+            extension = 'jpg' if budget.format == 'jpeg' else 'png'
+            # Named after the source path and modification time, so a changed source gets a new copy
+            source_key = f"{os.path.abspath(image)}:{os.stat(image).st_mtime_ns}"
+            digest = hashlib.sha1(source_key.encode()).hexdigest()[:12]
+            name = os.path.splitext(os.path.basename(image))[0]
+            fitted_path = os.path.join(self.config.fit_folder, f"{name}_{digest}_fit_{fitted.width}x{fitted.height}.{extension}")
+            if not os.path.exists(fitted_path):
+                os.makedirs(self.config.fit_folder, exist_ok=True)
+                # Written aside and renamed, so a concurrent call never reads a partial file
+                partial_path = f"{fitted_path}.{threading.get_ident()}.tmp"
+                fitted.convert('RGB').save(partial_path, format='JPEG' if extension == 'jpg' else 'PNG')
+                os.replace(partial_path, fitted_path)
+            return fitted_path, tokens
+
+        return fitted, tokens
 
     def act(self, action: str) -> str:
         """
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from agent.usage import NO_USAGE, call_with_usage
+
+CACHE_MODES = ('off', 'read-write', 'replay')
+
+# Arguments only used by the message loggers, they do not change the response
+LOGGER_KWARGS = ('run_name', 'tag', 'images_path')
+
+# Argument only read by the cache: index of the sample when several answers are drawn for the same request,
+# part of the key so that the samples are stored apart, never sent to the model
+SAMPLE_KWARG = 'sample'
+
+
+def _image_digest(image) -> str:
+    """
+    Content hash of an image given as a PIL image or a path.
+    """
+    digest = hashlib.sha256()
+    if isinstance(image, Image.Image):
+        digest.update(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+    elif isinstance(image, str) and os.path.exists(image):
+        with open(image, 'rb') as f:
+            digest.update(f.read())
+    else:
+        digest.update(str(image).encode())
+    return digest.hexdigest()
+
+
+def _normalize(value):
+    """
+    JSON-serializable form of messages, with images replaced by their content hash.
+    """
+    if isinstance(value, dict):
+        if value.get('type') == 'image':
+            return {'type': 'image', 'sha256': _image_digest(value.get('image'))}
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, Image.Image):
+        return {'sha256': _image_digest(value)}
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+class LLMResponseCache:
+    """
+    Disk-backed (SQLite) cache of LLM responses, keyed by model, normalized messages and image content.
+
+    Identical requests running at the same time are coalesced: only the first one calls the
+    model and the others wait for its response.
+    """
+
+    def __init__(self, path: str, mode: str = 'read-write'):
+        """
+        :param path: Path to the SQLite database.
+        :param mode: 'read-write' to serve and store responses, 'replay' to only serve stored responses.
+        """
+        if mode not in CACHE_MODES or mode == 'off':
+            raise ValueError(f"Unsupported cache mode: {mode}. Expected 'read-write' or 'replay'.")
+
+        self.path = path
+        self.mode = mode
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'writes': 0}
+
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL)"
+            )
+
+    @staticmethod
+    def key(model_name: str, messages: list, **kwargs) -> str:
+        """
+        Cache key of a request.
+
+        :param model_name: Model of the request.
+        :param messages: Messages of the request.
+        :param kwargs: Other arguments of the request, logger arguments are ignored.
+        :return: Hex digest of the request.
+        """
+        payload = {
+            'model': model_name,
+            'messages': _normalize(messages),
+            'kwargs': _normalize({key: value for key, value in kwargs.items() if key not in LOGGER_KWARGS})
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Stored response of a request, None if not stored.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, model_name: str, response: str) -> None:
+        """
+        Store the response of a request.
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, response, created) VALUES (?, ?, ?, ?)",
+                    (key, model_name, json.dumps(response), time.time())
+                )
+            self.stats['writes'] += 1
+
+    def join(self, key: str) -> Tuple[bool, Future]:
+        """
+        Join the in-flight request with the same key, or start one.
+
+        :return: Tuple of whether the caller leads the request (and must resolve the future) and the future of the response.
+        """
+        with self._lock:
+            if key in self._in_flight:
+                self.stats['coalesced'] += 1
+                return False, self._in_flight[key]
+            future = Future()
+            self._in_flight[key] = future
+            return True, future
+
+    def leave(self, key: str) -> None:
+        """
+        Mark the request as finished.
+        """
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def count(self, stat: str) -> None:
+        """
+        Increment a counter of the cache stats.
+        """
+        with self._lock:
+            self.stats[stat] += 1
+
+    def hit_rate(self) -> float:
+        """
+        Share of the requests served without calling the model (stored or coalesced).
+        """
+        with self._lock:
+            served = self.stats['hits'] + self.stats['coalesced']
+            total = served + self.stats['misses']
+        return served / total if total else 0.0
+
+
+class CachedLLM:
+    """
+    Wraps an LLM wrapper to serve repeated requests from an LLMResponseCache.
+    """
+
+    def __init__(self, llm, cache: LLMResponseCache, model_name: str):
+        self.llm = llm
+        self.cache = cache
+        self.model_name = model_name
+
+    def complete_with_usage(self, messages: list, **kwargs) -> Tuple[str, Optional[dict]]:
+        """
+        Serve the request from the cache, or call the model and store the response.
+
+        :return: Tuple of the response and the token usage of this call, zero when the cache answered.
+        """
+        key = self.cache.key(self.model_name, messages, **kwargs)
+        kwargs.pop(SAMPLE_KWARG, None)
+
+        response = self.cache.get(key)
+        if response is not None:
+            self.cache.count('hits')
+            return response, dict(NO_USAGE)
+
+        leader, future = self.cache.join(key)
+        if not leader:
+            return future.result(), dict(NO_USAGE)
+
+        try:
+            # The previous leader may have stored the response in the meantime
+            response = self.cache.get(key)
+            usage = dict(NO_USAGE)
+            if response is not None:
+                self.cache.count('hits')
+            elif self.cache.mode == 'replay':
+                raise ValueError(f"No cached response for this request to {self.model_name} in replay mode.")
+            else:
+                self.cache.count('misses')
+                response, usage = call_with_usage(self.llm, messages, **kwargs)
+                self.cache.put(key, self.model_name, response)
+            future.set_result(response)
+            return response, usage
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.cache.leave(key)
+
+    def __call__(self, messages: list, **kwargs) -> str:
+        return self.complete_with_usage(messages, **kwargs)[0]
+
+
+_caches: Dict[Tuple[str, str], LLMResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(path: str, mode: str = 'read-write') -> LLMResponseCache:
+    """
+    Get the process-wide response cache of a database, so that every agent using it shares the in-flight requests.
+
+    :param path: Path to the SQLite database.
+    :param mode: 'read-write' or 'replay'.
+    :return: The shared response cache.
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        if (path, mode) not in _caches:
+            _caches[(path, mode)] = LLMResponseCache(path, mode)
+        return _caches[(path, mode)]
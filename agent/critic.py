@@ -1,24 +1,126 @@
 from pydantic import BaseModel, Field
-from typing import Union
+from typing import Union, List, Optional, Callable
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
 
 import os
 import sys 
+import threading
+from concurrent.futures import Future
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from agent.base import AgentConfig, Agent
+from agent.executor import get_critic_executor
+from agent.tracing import traced
 from agent.prompt.get_sys_prompt import get_sys_prompt
-from utils import open_image, extract_critique_and_score
+from utils import open_image, extract_critique_and_score, split_combined_critique, split_ranking, parse_critique, salvage_score
 import logging
 logging.basicConfig(level=logging.INFO)
 
+JSON_OUTPUT_PROMPT = """### Output format:
+Ignore the format above and return only a JSON object: {"critique": "<your critique>", "score": <integer from 0 to 5>}"""
+
+REPAIR_PROMPT = """Read the evaluation below and return only its final score, an integer from 0 to 5, as a JSON object: {"score": <score>}"""
+
+# Parse outcome of the critic responses per model: parsed by the strict parser, repaired, or failed.
+# PARSE_STATS counts every call of the process, RUN_PARSE_STATS the calls of each run
+PARSE_STATS = {}
+RUN_PARSE_STATS = {}
+_parse_stats_lock = threading.Lock()
+
+
+def parse_failure_rate(model_name: str = None, run_name: str = None) -> dict:
+    """
+    Parse outcomes and failure rate of the critic responses, per model.
+
+    :param model_name: Model to report, every model when None.
+    :param run_name: Run to report, every call of the process when None.
+    :return: Dictionary of the parsed, repaired and failed counts and the failure rate, keyed by model.
+    """
+    with _parse_stats_lock:
+        source = PARSE_STATS if run_name is None else RUN_PARSE_STATS.get(run_name, {})
+        stats = {model: dict(counts) for model, counts in source.items() if model_name in (None, model)}
+    for counts in stats.values():
+        total = counts['parsed'] + counts['repaired'] + counts['failed']
+        counts['failure_rate'] = counts['failed'] / total if total else 0.0
+    return stats
+
+
+def clear_parse_stats(run_name: str) -> None:
+    """
+    Forget the parse outcomes counted under a run name, called when the run starts.
+    """
+    with _parse_stats_lock:
+        RUN_PARSE_STATS.pop(run_name, None)
+
+
+def json_request(agent: Agent) -> tuple:
+    """
+    System prompt suffix and request arguments asking a critic for JSON output, when its config enables it.
+    JSON mode is requested from the providers known to support it, the others only get the prompt.
+
+    :return: Tuple of the prompt suffix and the keyword arguments for call_llm.
+    """
+    if not getattr(agent.config, 'json_output', False):
+        return '', {}
+    kwargs = {}
+    if agent.config.model_name.startswith(('gpt', 'gemini')):
+        kwargs['response_format'] = {'type': 'json_object'}
+    return f"\n\n{JSON_OUTPUT_PROMPT}", kwargs
+
+
+def parse_critic_response(agent: Agent, raw_response: str, run_name: str = None, tag: str = None, repair: bool = True) -> dict:
+    """
+    Parse the critique and score of a critic response.
+
+    The strict parser runs first. If it fails, the score is searched in the free text, then
+    (when repair is set and the config allows it) a short request asks the model for the score
+    alone. A response that still has no score is scored 0 and flagged with 'parse_error'
+    instead of being mistaken for a failed render.
+
+    :param agent: Critic that produced the response.
+    :param raw_response: The raw response string.
+    :param repair: Whether the repair request may be sent.
+    :return: A dictionary with the critique, the score and the parse_error flag.
+    """
+    result = parse_critique(raw_response or '')
+    outcome = 'parsed'
+
+    if result is None:
+        critique = extract_critique_and_score(raw_response or '')['critique']
+        score = salvage_score(raw_response or '')
+        if score is None and repair and getattr(agent.config, 'repair_parse', False) and raw_response:
+            messages = [
+                {'role': 'system', 'content': REPAIR_PROMPT},
+                {'role': 'user', 'content': raw_response[-4000:]}
+            ]
+            repaired, _ = agent.call_llm(messages, run_name=run_name, tag=f'repair_{tag}')
+            parsed = parse_critique(repaired or '')
+            score = parsed['score'] if parsed is not None else salvage_score(repaired or '')
+
+        if score is None:
+            result, outcome = {'critique': critique, 'score': 0}, 'failed'
+            logging.warning(f"Could not parse the score of a {agent.config.model_name} critique, scoring it 0")
+        else:
+            result, outcome = {'critique': critique, 'score': score}, 'repaired'
+
+    with _parse_stats_lock:
+        for stats in (PARSE_STATS, RUN_PARSE_STATS.setdefault(run_name, {})):
+            counts = stats.setdefault(agent.config.model_name, {'parsed': 0, 'repaired': 0, 'failed': 0})
+            counts[outcome] += 1
+
+    result['parse_error'] = outcome == 'failed'
+    return result
+
+
 class VisionCriticConfig(AgentConfig):
     """
     Configuration for the visual critic.
     """
     name: str = Field(default='Vision Critic Agent', description="Purpose of the agent")
     module_name: str = 'vision_critic'
+    multi_image: bool = Field(default=False, description="Send the input, previous and transition images as separate labelled images instead of one merged canvas")
+    json_output: bool = Field(default=False, description="Ask for the critique and score as a JSON object, in JSON mode where the provider supports it. Opt-in: the format instructions add input tokens to every call and change the prompt, so cached responses of the free-text format no longer match")
+    repair_parse: bool = Field(default=True, description="Ask the model for the score alone when it cannot be parsed or salvaged from the critique. Each such failure costs one extra LLM call, with up to the last 4000 characters of the critique as input")
 
 
 class TextCriticConfig(AgentConfig):
@@ -28,6 +130,36 @@ class TextCriticConfig(AgentConfig):
     name: str = Field(default='Text Critic Agent', description="Purpose of the agent")
     module_name: str = 'text_critic'
     code: str = Field(default='python', description="Code type: either python or html")
+    json_output: bool = Field(default=False, description="Ask for the critique and score as a JSON object, in JSON mode where the provider supports it. Opt-in: the format instructions add input tokens to every call and change the prompt, so cached responses of the free-text format no longer match")
+    repair_parse: bool = Field(default=True, description="Ask the model for the score alone when it cannot be parsed or salvaged from the critique. Each such failure costs one extra LLM call, with up to the last 4000 characters of the critique as input")
+
+class CombinedCriticConfig(VisionCriticConfig):
+    """
+    Configuration for the combined critic, reading the image and the code in a single request.
+    """
+    name: str = Field(default='Combined Critic Agent', description="Purpose of the agent")
+    module_name: str = 'combined_critic'
+    code: str = Field(default='python', description="Code type: either python or html")
+
+class RankingCriticConfig(VisionCriticConfig):
+    """
+    Configuration for the ranking critic, scoring several candidate renders in a single request.
+    """
+    name: str = Field(default='Ranking Critic Agent', description="Purpose of the agent")
+    module_name: str = 'ranking_critic'
+
+class CascadeConfig(BaseModel):
+    """
+    Configuration of the cascaded critic: the text critic scores first and gates the vision critic.
+    """
+    enabled: bool = Field(default=False, description="Run the text critic first and call the vision critic only when needed")
+    fail_below: float = Field(default=1, description="Gate score at or below which the step is clearly failing and the vision critic is skipped")
+    pass_above: float = Field(default=5, description="Gate score at or above which the step is clearly passing")
+    pass_action: str = Field(default='downgrade', description="What to do with a clearly passing step: 'skip' the vision critic, 'downgrade' it to downgrade_model, or run the 'full' vision critic")
+    downgrade_model: Optional[str] = Field(default=None, description="Cheaper vision model used for clearly passing steps, the full vision critic is used when not set")
+    escalate_below: Optional[float] = Field(default=3, description="Downgraded vision score below which the full vision critic is called again, None to never escalate")
+    disagreement_margin: float = Field(default=2, description="Score difference between two critics counted as a disagreement")
+
 
 class CriticConfig(AgentConfig):
     """
@@ -40,6 +172,13 @@ class CriticConfig(AgentConfig):
     vision: VisionCriticConfig = Field(default_factory=VisionCriticConfig)
     text: TextCriticConfig = Field(default_factory=TextCriticConfig)
 
+    mode: str = Field(default='separate', description="'separate' for a vision and a text request per step, 'combined' for a single multimodal request reading both")
+    max_rank_candidates: int = Field(default=4, description="Maximum candidates scored in one ranking request, models that cannot read that many images fall back to one request per candidate. Below 2 always falls back")
+    cascade: CascadeConfig = Field(default_factory=CascadeConfig, description="Cascade policy of the 'separate' mode")
+
+    max_workers: int = Field(default=16, description="Threads of the process-wide critic executor, set by the first critic created")
+    max_concurrency_per_model: int = Field(default=8, description="Maximum in-flight critic requests per model across the process")
+
     def __init__(self, **data):
         """
         Initialize the CriticConfig with the given parameters.
@@ -81,31 +220,74 @@ class VisionCritic(Agent):
         self.sys_prompt = get_sys_prompt('vision_critic')
 
 
+    def image_content(self, action_image: Union[str, Image.Image, List[Union[str, Image.Image]]], image_titles: List[str] = None) -> tuple:
+        """
+        Build the image part of the user message, with every image fitted to the model budget.
+
+        A single image is sent as is, a list of images is sent as separate images, each preceded by its title.
+
+        :param action_image: Image or list of images for the critic.
+        :param image_titles: Titles of the images when a list is given.
+        :return: Tuple of the content parts, the image paths (for the message logger) and the estimated image tokens.
+        """
+        image_tokens = {'tokens_before': 0, 'tokens_after': 0, 'tokens_saved': 0}
+
+        def fit(image):
+            image, tokens = self.fit_image(image)
+            for key, value in (tokens or {}).items():
+                image_tokens[key] += value
+            return image
+
+        if not isinstance(action_image, list):
+            action_image = fit(action_image)
+            image_path = action_image if isinstance(action_image, str) and os.path.exists(action_image) else None
+            return [{'type': 'image', 'image': action_image}], image_path, image_tokens
+
+        image_titles = image_titles or [f"Image {i + 1}" for i in range(len(action_image))]
+
+        content = []
+        images_path = []
+        for title, image in zip(image_titles, action_image):
+            if image is None:
+                continue
+            image = fit(image)
+            content.append({'type': 'text', 'text': f"{title}:"})
+            content.append({'type': 'image', 'image': image})
+            if isinstance(image, str):
+                images_path.append(image)
+
+        return content, images_path or None, image_tokens
+
+    @traced('vision_critic', 'critic')
     def act_with_prev_state(self, 
                             request: str, 
-                            action_image : Union[str, Image.Image] = None, 
+                            action_image : Union[str, Image.Image, List[Union[str, Image.Image]]] = None, 
                             prev_vision_critique: str = None,
                             run_name: str = None,
-                            tag: str = None
+                            tag: str = None,
+                            image_titles: List[str] = None
                             ) -> dict:
         """
         Perform an action with the given parameters, Given previous state critique.
 
         :param request: The action to perform.
-        :param image: Image input for the critic.
+        :param action_image: Image input for the critic, or a list of images when multi_image is set.
         :param prev_state_critique: Previous critique on the image.
+        :param image_titles: Titles of the images when a list of images is given.
         :return: Result of the action.
         """
 
-        if isinstance(image, str):
-            if os.path.exists(image):
-                image = open_image(image)
+        if isinstance(action_image, str) and not self.config.image_path:
+            if os.path.exists(action_image):
+                action_image = open_image(action_image)
             else:
-                raise ValueError(f"Image path {image} does not exist.")
+                raise ValueError(f"Image path {action_image} does not exist.")
 
 
         # Implement the logic for vision critique here
         sys_prompt = get_sys_prompt(self.config.module_name)
+        json_suffix, json_kwargs = json_request(self)
+        sys_prompt += json_suffix
         
         prev_vision_critique = f"### Previous critique on the image: \n\n{prev_vision_critique}\n" if prev_vision_critique else ""
 
@@ -118,6 +300,21 @@ class VisionCritic(Agent):
 { prev_vision_critique if prev_vision_critique else "" }
 """
 
+        image_content, image_path, image_tokens = self.image_content(action_image, image_titles)
+
+        if self.config.message_layout == 'cache':
+            # Task first, then the images (input image first), then the previous critique
+            user_content = [{'type': 'text', 'text': f"### Task:\n{request}"}] + image_content
+            if prev_vision_critique:
+                user_content.append({'type': 'text', 'text': prev_vision_critique.strip()})
+        else:
+            user_content = image_content + [
+                {
+                    'type': 'text',
+                    'text': user_prompt.strip()
+                }
+            ]
+
         messages = [
             {
                 'role': 'system',
@@ -125,50 +322,54 @@ class VisionCritic(Agent):
             },
             {
                 'role': 'user',
-                'content': [
-                    {
-                        'type': 'image',
-                        'image': action_image
-                    },
-                    {
-                        'type': 'text',
-                        'text': user_prompt.strip()
-                    }
-                ]
+                'content': user_content
             }
         ]
-        if self.config.logger:
-            raw_response = self.llm(messages, run_name=run_name, tag=f'vision_critic_{tag}', images_path=action_image)
-        else:
-            raw_response = self.llm(messages)
+        raw_response, usage = self.call_llm(messages, run_name=run_name, tag=f'vision_critic_{tag}', images_path=image_path, image_tokens=image_tokens['tokens_after'], **json_kwargs)
         
         if self.config.debug:
             print(f"Raw response from Vision Critic: {raw_response}")
 
-        return extract_critique_and_score(raw_response)
+        result = parse_critic_response(self, raw_response, run_name=run_name, tag=tag)
+        result['image_tokens'] = image_tokens
+        result['usage'] = usage
+        return result
 
 
+    @traced('vision_critic', 'critic')
     def act(self, 
             request: str, 
-            action_image: Union[str, Image.Image] = None,
+            action_image: Union[str, Image.Image, List[Union[str, Image.Image]]] = None,
             run_name: str = None,
-            tag: str = None
+            tag: str = None,
+            image_titles: List[str] = None
             ) -> dict:
         
-        if isinstance(action_image, str) and os.path.exists(action_image):
-            image_path = action_image
+        image_content, image_path, image_tokens = self.image_content(action_image, image_titles)
+        if image_path:
             print(f"Using image path: {image_path} in Vision Critic")
-        else:
-            image_path = None
             
 
         sys_prompt = get_sys_prompt(self.config.module_name)
+        json_suffix, json_kwargs = json_request(self)
+        sys_prompt += json_suffix
 
         user_prompt = f"""
 ### Task:
 {request}
 """
 
+        if self.config.message_layout == 'cache':
+            # Task first, then the images (input image first)
+            user_content = [{'type': 'text', 'text': user_prompt.strip()}] + image_content
+        else:
+            user_content = image_content + [
+                {
+                    'type': 'text',
+                    'text': user_prompt
+                }
+            ]
+
         messages = [
             {
                 'role': 'system',
@@ -176,28 +377,19 @@ class VisionCritic(Agent):
             },
             {
                 'role': 'user',
-                'content': [
-                    {
-                        'type': 'image',
-                        'image': action_image
-                    },
-                    {
-                        'type': 'text',
-                        'text': user_prompt
-                    }
-                ]
+                'content': user_content
             }
         ]
 
-        if self.config.logger:
-            raw_response = self.llm(messages, run_name=run_name, tag=f'vision_critic_{tag}', images_path=image_path)
-        else:
-            raw_response = self.llm(messages)
+        raw_response, usage = self.call_llm(messages, run_name=run_name, tag=f'vision_critic_{tag}', images_path=image_path, image_tokens=image_tokens['tokens_after'], **json_kwargs)
 
         if self.config.debug:
             print(f"Raw response from Vision Critic: {raw_response}")
 
-        return extract_critique_and_score(raw_response)
+        result = parse_critic_response(self, raw_response, run_name=run_name, tag=tag)
+        result['image_tokens'] = image_tokens
+        result['usage'] = usage
+        return result
 
 class TextCritic(Agent):
     """
@@ -209,18 +401,43 @@ class TextCritic(Agent):
         super().__init__(config)
         self.sys_prompt = get_sys_prompt('text_critic')
 
+    def code_section(self, action_code: str, code_diff: str = None) -> str:
+        """
+        Code part of the prompt: the unified diff against the previous code when it is given and shorter than the code.
+        """
+        if code_diff is not None and len(code_diff) < len(action_code or ''):
+            if not code_diff.strip():
+                return "### Code changes against the previous code: \n\nThe code is unchanged."
+            return f"### Code changes against the previous code (unified diff): \n\n```diff\n{code_diff}\n```"
+        return f"### Code: \n\n```{self.config.code}\n{action_code}\n```"
+
+    @staticmethod
+    def cache_content(request: str, sections: List[str]) -> list:
+        """
+        User content for the 'cache' message layout: the task as its own leading part, then the code sections.
+        """
+        content = [{'type': 'text', 'text': f"### Task:\n{request}"}]
+        for section in sections:
+            if section and section.strip():
+                content.append({'type': 'text', 'text': section.strip()})
+        return content
+
+    @traced('text_critic', 'critic')
     def act_with_prev_state(self, 
                             request: str, 
                             action_code: str = None, 
                             prev_code: str = None, 
                             prev_code_critique: str = None,
                             run_name: str = None,
-                            tag: str = None) -> dict:
+                            tag: str = None,
+                            code_diff: str = None) -> dict:
 
         sys_prompt = get_sys_prompt(self.config.module_name)
         sys_prompt += f"\n\n### Code language: {self.config.code}\n"
+        json_suffix, json_kwargs = json_request(self)
+        sys_prompt += json_suffix
 
-        action_code = f"### Code: \n\n```{self.config.code}\n{action_code}\n```"
+        action_code = self.code_section(action_code, code_diff)
         prev_code = f"### Previous code: \n\n```{self.config.code}\n{prev_code}\n```" if prev_code else ""
         prev_code_critique = f"### Previous critique on the code: \n\n{prev_code_critique}\n" if prev_code_critique else ""
 
@@ -235,6 +452,11 @@ class TextCritic(Agent):
 { prev_code_critique if prev_code_critique else "" }
 """
 
+        if self.config.message_layout == 'cache':
+            user_content = self.cache_content(request, [prev_code, prev_code_critique, action_code])
+        else:
+            user_content = user_prompt.strip()
+
         messages = [
             {
                 'role': 'system',
@@ -242,30 +464,33 @@ class TextCritic(Agent):
             },
             {
                 'role': 'user',
-                'content': user_prompt.strip()
+                'content': user_content
             }
         ]
-        if self.config.logger:
-            raw_response = self.llm(messages, run_name=run_name, tag=f'text_critic_{tag}')
-        else:
-            raw_response = self.llm(messages)
+        raw_response, usage = self.call_llm(messages, run_name=run_name, tag=f'text_critic_{tag}', **json_kwargs)
 
         if self.config.debug:
             print(f"Raw response from Text Critic: {raw_response}")
 
-        return extract_critique_and_score(raw_response)
+        result = parse_critic_response(self, raw_response, run_name=run_name, tag=tag)
+        result['usage'] = usage
+        return result
     
 
+    @traced('text_critic', 'critic')
     def act(self, 
             request: str, 
             action_code: str = None,
             run_name: str = None,
-            tag: str = None) -> dict:
+            tag: str = None,
+            code_diff: str = None) -> dict:
 
         sys_prompt = get_sys_prompt(self.config.module_name)
         sys_prompt += f"\n\n### Code language: {self.config.code}\n"
+        json_suffix, json_kwargs = json_request(self)
+        sys_prompt += json_suffix
 
-        action_code = f"### Code: \n\n```{self.config.code}\n{action_code}\n```"
+        action_code = self.code_section(action_code, code_diff)
         user_prompt = f"""
 ### Task:
 {request}
@@ -273,6 +498,11 @@ class TextCritic(Agent):
 { action_code if action_code else "" }
 """
 
+        if self.config.message_layout == 'cache':
+            user_content = self.cache_content(request, [action_code])
+        else:
+            user_content = user_prompt
+
         messages = [
             {
                 'role': 'system',
@@ -280,18 +510,169 @@ class TextCritic(Agent):
             },
             {
                 'role': 'user',
-                'content': user_prompt
+                'content': user_content
             }
         ]
-        if self.config.logger:
-            raw_response = self.llm(messages, run_name=run_name, tag=f'text_critic_{tag}')
-        else:
-            raw_response = self.llm(messages)
+        raw_response, usage = self.call_llm(messages, run_name=run_name, tag=f'text_critic_{tag}', **json_kwargs)
 
         if self.config.debug:
             print(f"Raw response from Text Critic: {raw_response}")
 
-        return extract_critique_and_score(raw_response)
+        result = parse_critic_response(self, raw_response, run_name=run_name, tag=tag)
+        result['usage'] = usage
+        return result
+
+
+class CombinedCritic(VisionCritic):
+    """
+    Critic Agent that evaluates the rendered chart and its code in a single multimodal request.
+    """
+
+    def __init__(self, config: CombinedCriticConfig):
+        super().__init__(config)
+        self.sys_prompt = get_sys_prompt('combined_critic')
+
+    @traced('combined_critic', 'critic')
+    def act_with_prev_state(self,
+                            request: str,
+                            action_image: Union[str, Image.Image, List[Union[str, Image.Image]]] = None,
+                            action_code: str = None,
+                            prev_vision_critique: str = None,
+                            prev_text_critique: str = None,
+                            run_name: str = None,
+                            tag: str = None,
+                            image_titles: List[str] = None
+                            ) -> dict:
+        """
+        Evaluate the image and the code together, given the previous critiques.
+
+        :param request: The action to perform.
+        :param action_image: Image input for the critic, or a list of images when multi_image is set.
+        :param action_code: Code input for the critic.
+        :param prev_vision_critique: Previous critique on the image.
+        :param prev_text_critique: Previous critique on the code.
+        :param image_titles: Titles of the images when a list of images is given.
+        :return: Dictionary with the 'vision_critic' and 'text_critic' results and the usage of the request.
+        """
+        if isinstance(action_image, str) and not self.config.image_path and os.path.exists(action_image):
+            action_image = open_image(action_image)
+
+        sys_prompt = get_sys_prompt(self.config.module_name)
+        sys_prompt += f"\n\n### Code language: {self.config.code}\n"
+
+        sections = [f"### Code: \n\n```{self.config.code}\n{action_code}\n```"]
+        if prev_vision_critique:
+            sections.append(f"### Previous critique on the image: \n\n{prev_vision_critique}\n")
+        if prev_text_critique:
+            sections.append(f"### Previous critique on the code: \n\n{prev_text_critique}\n")
+
+        image_content, image_path, image_tokens = self.image_content(action_image, image_titles)
+
+        if self.config.message_layout == 'cache':
+            # Task first, then the images (input image first), then the code and previous critiques
+            user_content = [{'type': 'text', 'text': f"### Task:\n{request}"}] + image_content
+        else:
+            user_content = image_content + [{'type': 'text', 'text': f"### Task:\n{request}"}]
+        user_content += [{'type': 'text', 'text': section.strip()} for section in sections]
+
+        messages = [
+            {
+                'role': 'system',
+                'content': sys_prompt
+            },
+            {
+                'role': 'user',
+                'content': user_content
+            }
+        ]
+        raw_response, usage = self.call_llm(messages, run_name=run_name, tag=f'combined_critic_{tag}', images_path=image_path, image_tokens=image_tokens['tokens_after'])
+
+        if self.config.debug:
+            print(f"Raw response from Combined Critic: {raw_response}")
+
+        # Each section goes through the strict parser, the salvage and the repair request
+        result = {key: parse_critic_response(self, section, run_name=run_name, tag=f'{key}_{tag}')
+                  for key, section in split_combined_critique(raw_response or '').items()}
+        result['vision_critic']['image_tokens'] = image_tokens
+        result['usage'] = usage
+        return result
+
+    def act(self,
+            request: str,
+            action_image: Union[str, Image.Image, List[Union[str, Image.Image]]] = None,
+            action_code: str = None,
+            run_name: str = None,
+            tag: str = None,
+            image_titles: List[str] = None
+            ) -> dict:
+        return self.act_with_prev_state(request, action_image, action_code, run_name=run_name, tag=tag, image_titles=image_titles)
+
+
+class RankingCritic(VisionCritic):
+    """
+    Vision critic that scores several candidate renders of the same request in one request,
+    sending the system prompt, task and input image once.
+    """
+
+    def __init__(self, config: RankingCriticConfig):
+        super().__init__(config)
+        self.sys_prompt = get_sys_prompt('ranking_critic')
+
+    @traced('ranking_critic', 'critic')
+    def rank(self,
+             request: str,
+             image: Union[str, Image.Image] = None,
+             candidates: List[Union[str, Image.Image]] = None,
+             run_name: str = None,
+             tag: str = None) -> dict:
+        """
+        Score the candidates against the input image.
+
+        :param request: The request the candidates answer.
+        :param image: Input image of the request.
+        :param candidates: Candidate renders.
+        :return: Dictionary with the result of each candidate ('candidates', None for the candidates missing
+                 from the response or whose score could not be parsed), the usage and the estimated image tokens.
+        """
+        images = [image] + list(candidates)
+        titles = ['Input Image'] + [f"Candidate {i + 1}" for i in range(len(candidates))]
+        if image is None:
+            images, titles = images[1:], titles[1:]
+
+        image_content, image_path, image_tokens = self.image_content(images, titles)
+
+        user_prompt = f"### Task:\n{request}\n\n### Number of candidates: {len(candidates)}"
+        if self.config.message_layout == 'cache':
+            user_content = [{'type': 'text', 'text': user_prompt}] + image_content
+        else:
+            user_content = image_content + [{'type': 'text', 'text': user_prompt}]
+
+        messages = [
+            {
+                'role': 'system',
+                'content': get_sys_prompt(self.config.module_name)
+            },
+            {
+                'role': 'user',
+                'content': user_content
+            }
+        ]
+        raw_response, usage = self.call_llm(messages, run_name=run_name, tag=f'ranking_critic_{tag}', images_path=image_path, image_tokens=image_tokens['tokens_after'])
+
+        if self.config.debug:
+            print(f"Raw response from Ranking Critic: {raw_response}")
+
+        # A section without a score after the repair is dropped, the candidate falls back to its own vision request
+        results = []
+        for i, section in enumerate(split_ranking(raw_response, len(candidates))):
+            result = parse_critic_response(self, section, run_name=run_name, tag=f'candidate_{i + 1}_{tag}') if section else None
+            results.append(result if result is not None and not result['parse_error'] else None)
+
+        return {
+            'candidates': results,
+            'image_tokens': image_tokens,
+            'usage': usage
+        }
 
 
 class Critic(Agent):
@@ -301,14 +682,245 @@ class Critic(Agent):
     """
     vision_critic: VisionCritic = None
     text_critic: TextCritic = None
+    combined_critic: CombinedCritic = None
+    downgraded_vision_critic: VisionCritic = None
+    ranking_critic: RankingCritic = None
+    cascade_stats: dict = Field(default_factory=lambda: {
+        'steps': 0, 'vision_skipped': 0, 'vision_downgraded': 0, 'escalated': 0,
+        'compared': 0, 'disagreements': 0, 'downgrade_compared': 0, 'downgrade_disagreements': 0
+    }, description="Counters of the cascade policy")
+    cascade_lock: object = Field(default_factory=threading.Lock, exclude=True)
 
     def __init__(self, config: CriticConfig):
         super().__init__(config)
         self.vision_critic = VisionCritic(config.vision)
         self.text_critic = TextCritic(config.text)
 
+        if config.max_rank_candidates > 1:
+            ranking_config = config.vision.model_dump(exclude={'name', 'module_name'})
+            self.ranking_critic = RankingCritic(RankingCriticConfig(**ranking_config))
+
+        if config.cascade.enabled and config.cascade.downgrade_model:
+            downgraded_config = config.vision.model_copy(update={'model_name': config.cascade.downgrade_model, 'image_budget': None})
+            self.downgraded_vision_critic = VisionCritic(downgraded_config)
+
+        if config.mode == 'combined':
+            combined_config = config.vision.model_dump(exclude={'name', 'module_name'})
+            self.combined_critic = CombinedCritic(CombinedCriticConfig(**combined_config, code=config.text.code))
+        elif config.mode != 'separate':
+            raise ValueError(f"Unsupported critic mode: {config.mode}. Expected 'separate' or 'combined'.")
+
+    def count(self, **counts) -> None:
+        """
+        Add to the cascade counters.
+        """
+        with self.cascade_lock:
+            for key, value in counts.items():
+                self.cascade_stats[key] += value
+
+    def cascade_rates(self) -> dict:
+        """
+        Share of the steps where the vision critic was skipped or downgraded, and disagreement rates between critics.
+        """
+        with self.cascade_lock:
+            stats = dict(self.cascade_stats)
+
+        def rate(count, total):
+            return stats[count] / stats[total] if stats[total] else 0.0
 
-    def act(self, request: str, action_image: Union[str, Image.Image] = None, action_code: str = None, run_name: str = None, tag: str = None) -> dict:
+        return {
+            'skip_rate': rate('vision_skipped', 'steps'),
+            'downgrade_rate': rate('vision_downgraded', 'steps'),
+            'escalation_rate': rate('escalated', 'vision_downgraded'),
+            'disagreement_rate': rate('disagreements', 'compared'),
+            'downgrade_disagreement_rate': rate('downgrade_disagreements', 'downgrade_compared')
+        }
+
+    def cascade_act(self, text_call: tuple, vision_call: tuple) -> dict:
+        """
+        Run the text critic as a gate, then the vision critic only when the gate score is not conclusive.
+
+        :param text_call: Tuple of the arguments and keyword arguments of the text critic call.
+        :param vision_call: Tuple of the method name, arguments and keyword arguments of the vision critic call.
+        :return: Result in the format of the two-critic mode, with the cascade decision.
+        """
+        cascade = self.config.cascade
+        executor = get_critic_executor(self.config.max_workers, self.config.max_concurrency_per_model)
+        method, vision_args, vision_kwargs = vision_call
+        text_args, text_kwargs = text_call
+
+        text_method = getattr(self.text_critic, method)
+        text_future = executor.submit(self.text_critic.config.model_name, text_method, *text_args, **text_kwargs)
+        text_critique = text_future.result()
+        gate_score = text_critique['score']
+
+        timing = {'text_critic': text_future.timing}
+        requests = 1
+
+        def run(critic: VisionCritic, key: str) -> dict:
+            nonlocal requests
+            future = executor.submit(critic.config.model_name, getattr(critic, method), *vision_args, **vision_kwargs)
+            requests += 1
+            result = future.result()
+            timing[key] = future.timing
+            return result
+
+        if gate_score <= cascade.fail_below:
+            decision = 'skipped'
+        elif gate_score >= cascade.pass_above and cascade.pass_action == 'skip':
+            decision = 'skipped'
+        elif gate_score >= cascade.pass_above and cascade.pass_action == 'downgrade' and self.downgraded_vision_critic is not None:
+            decision = 'downgraded'
+        else:
+            decision = 'full'
+
+        if decision == 'skipped':
+            vision_critique = {
+                'critique': f"Vision critique skipped by the cascade, the code critic scored {gate_score}.",
+                'score': gate_score,
+                'skipped': True
+            }
+            self.count(steps=1, vision_skipped=1)
+        elif decision == 'downgraded':
+            vision_critique = run(self.downgraded_vision_critic, 'downgraded_vision_critic')
+            self.count(steps=1, vision_downgraded=1, downgrade_compared=1,
+                       downgrade_disagreements=int(abs(vision_critique['score'] - gate_score) >= cascade.disagreement_margin))
+            if cascade.escalate_below is not None and vision_critique['score'] < cascade.escalate_below:
+                decision = 'escalated'
+                vision_critique = run(self.vision_critic, 'vision_critic')
+                self.count(escalated=1)
+        else:
+            vision_critique = run(self.vision_critic, 'vision_critic')
+            self.count(steps=1, compared=1,
+                       disagreements=int(abs(vision_critique['score'] - gate_score) >= cascade.disagreement_margin))
+
+        return {
+            'vision_critic': vision_critique,
+            'text_critic': text_critique,
+            'mode': 'cascade',
+            'cascade': decision,
+            'requests': requests,
+            'timing': timing
+        }
+
+    @traced('critic.rank', 'critic')
+    def rank(self,
+             request: str,
+             image: Union[str, Image.Image] = None,
+             candidates: List[Union[str, Image.Image]] = None,
+             action_codes: List[str] = None,
+             prepare: Callable[[int], tuple] = None,
+             run_name: str = None,
+             tag: str = None) -> List[dict]:
+        """
+        Critique several candidates of the same request: one ranking request for the vision critique
+        of every candidate, and one text critique per candidate.
+
+        Candidates beyond max_rank_candidates, or missing from the ranking response, fall back to
+        one vision critic request each.
+
+        :param request: The request the candidates answer.
+        :param image: Input image of the request.
+        :param candidates: Candidate renders.
+        :param action_codes: Code of each candidate.
+        :param prepare: Function returning the vision critic image and image titles of a candidate, for the fallback requests.
+        :return: Critic result of each candidate, in the format of act.
+        """
+        executor = get_critic_executor(self.config.max_workers, self.config.max_concurrency_per_model)
+        action_codes = action_codes or [None] * len(candidates)
+
+        text_futures = [executor.submit(self.text_critic.config.model_name, self.text_critic.act, request, code, run_name=run_name, tag=tag)
+                        for code in action_codes]
+
+        vision_critiques = [None] * len(candidates)
+        batched = self.ranking_critic is not None and 1 < len(candidates) <= self.config.max_rank_candidates
+        ranking = None
+        if batched:
+            ranking = self.ranking_critic.rank(request, image, candidates, run_name=run_name, tag=tag)
+            vision_critiques = ranking['candidates']
+
+        fallback_futures = {}
+        for i, critique in enumerate(vision_critiques):
+            if critique is None:
+                action_image, image_titles = prepare(i) if prepare is not None else ([image, candidates[i]], ['Input Image', 'Transition Image'])
+                fallback_futures[i] = executor.submit(self.vision_critic.config.model_name, self.vision_critic.act, request, action_image,
+                                                      run_name=run_name, tag=tag, image_titles=image_titles)
+        for i, future in fallback_futures.items():
+            vision_critiques[i] = future.result()
+
+        results = []
+        for i, text_future in enumerate(text_futures):
+            results.append({
+                'vision_critic': vision_critiques[i],
+                'text_critic': text_future.result(),
+                'mode': 'ranking' if i not in fallback_futures else 'separate',
+                'requests': 1 + (1 if i in fallback_futures else 0),
+                'timing': {'text_critic': text_future.timing}
+            })
+
+        if ranking is not None:
+            # The ranking request is shared by the candidates
+            results[0]['ranking'] = {'usage': ranking['usage'], 'image_tokens': ranking['image_tokens'], 'candidates': len(candidates)}
+            results[0]['requests'] += 1
+        return results
+
+    def combined_act(self, *args, **kwargs) -> dict:
+        """
+        Run the combined critic on the shared executor and return the result in the two-critic format.
+        """
+        executor = get_critic_executor(self.config.max_workers, self.config.max_concurrency_per_model)
+        future = executor.submit(self.combined_critic.config.model_name, self.combined_critic.act_with_prev_state, *args, **kwargs)
+        result = future.result()
+        result['mode'] = 'combined'
+        result['requests'] = 1
+        result['timing'] = {'combined_critic': future.timing}
+        return result
+
+
+    def can_overlap(self) -> bool:
+        """
+        Whether the text critic can run on its own before the image is ready: only in the 'separate' mode without cascade.
+        """
+        return self.combined_critic is None and not self.config.cascade.enabled
+
+    def submit_text(self, request: str, action_code: str = None, prev_text_critique: str = None, run_name: str = None, tag: str = None, code_diff: str = None, with_prev_state: bool = False) -> Future:
+        """
+        Submit the text critic alone to the critic executor, so that it can start before the render is done.
+        The future can be cancelled while the request is still queued.
+
+        :param with_prev_state: Whether the critique is for act_with_prev_state.
+        :return: Future of the text critic result, read with text_result.
+        """
+        executor = get_critic_executor(self.config.max_workers, self.config.max_concurrency_per_model)
+        if not with_prev_state:
+            return executor.submit(self.text_critic.config.model_name, self.text_critic.act, request, action_code, run_name=run_name, tag=tag, code_diff=code_diff)
+        return executor.submit(self.text_critic.config.model_name, self.text_critic.act_with_prev_state, request, action_code, prev_code_critique=prev_text_critique, run_name=run_name, tag=tag, code_diff=code_diff)
+
+    @staticmethod
+    def text_result(future: Future) -> dict:
+        """
+        Wait for a text critic submitted with submit_text.
+
+        :return: Result of the text critic, with its executor timing.
+        """
+        result = future.result()
+        result['timing'] = future.timing
+        return result
+
+    @traced('critic.text_act', 'critic')
+    def text_act(self, request: str, action_code: str = None, prev_text_critique: str = None, run_name: str = None, tag: str = None, code_diff: str = None, with_prev_state: bool = False) -> dict:
+        """
+        Run the text critic alone, so that it can start before the render is done.
+        The result is passed back to act or act_with_prev_state as text_critique.
+
+        :param with_prev_state: Whether the critique is for act_with_prev_state.
+        :return: Result of the text critic, with its executor timing.
+        """
+        return self.text_result(self.submit_text(request, action_code, prev_text_critique, run_name=run_name, tag=tag,
+                                                 code_diff=code_diff, with_prev_state=with_prev_state))
+
+    @traced('critic.act', 'critic')
+    def act(self, request: str, action_image: Union[str, Image.Image, List[Union[str, Image.Image]]] = None, action_code: str = None, run_name: str = None, tag: str = None, image_titles: List[str] = None, code_diff: str = None, text_critique: dict = None) -> dict:
 
         if isinstance(action_image, Image.Image) and self.config.image_path:
             raise ValueError("Image should be a path string, since force use image_path is set to True.")
@@ -317,28 +929,66 @@ class Critic(Agent):
         Perform an action with the given parameters.
 
         :param request: The action to perform.
-        :param action_image: Image input for the critic.
+        :param action_image: Image input for the critic, or a list of images when the vision critic uses multi_image.
         :param action_code: Code input for the critic.
+        :param image_titles: Titles of the images when a list of images is given.
+        :param code_diff: Unified diff against the previous code, sent to the text critic instead of the full code.
+        :param text_critique: Result of text_act when the text critic already ran, only the vision critic is called then.
         :return: Result of the action.
         """
-        vision_critique = None
-        text_critique = None
+        if self.combined_critic is not None:
+            return self.combined_act(request, action_image, action_code, run_name=run_name, tag=tag, image_titles=image_titles)
+
+        if self.config.cascade.enabled:
+            return self.cascade_act(((request, action_code), {'run_name': run_name, 'tag': tag, 'code_diff': code_diff}),
+                                    ('act', (request, action_image), {'run_name': run_name, 'tag': tag, 'image_titles': image_titles}))
+
+        executor = get_critic_executor(self.config.max_workers, self.config.max_concurrency_per_model)
 
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            # Submit both tasks
-            vision_future = executor.submit(self.vision_critic.act, request, action_image, run_name=run_name, tag=tag)
-            text_future = executor.submit(self.text_critic.act, request, action_code, run_name=run_name, tag=tag)
+        if text_critique is not None:
+            return self.vision_act(executor, text_critique, self.vision_critic.act, request, action_image, run_name=run_name, tag=tag, image_titles=image_titles)
 
-            # Get results
-            vision_critique = vision_future.result()
-            text_critique = text_future.result()
+        # Submit both tasks
+        vision_future = executor.submit(self.vision_critic.config.model_name, self.vision_critic.act, request, action_image, run_name=run_name, tag=tag, image_titles=image_titles)
+        text_future = executor.submit(self.text_critic.config.model_name, self.text_critic.act, request, action_code, run_name=run_name, tag=tag, code_diff=code_diff)
+
+        # Get results
+        vision_critique = vision_future.result()
+        text_critique = text_future.result()
 
         return {
             'vision_critic': vision_critique,
-            'text_critic': text_critique
+            'text_critic': text_critique,
+            'mode': 'separate',
+            'requests': 2,
+            'timing': {
+                'vision_critic': vision_future.timing,
+                'text_critic': text_future.timing
+            }
         }
 
-    def act_with_prev_state(self, request: str, action_image: Union[str, Image.Image] = None, action_code: str = None, prev_vision_critique: str = None, prev_text_critique: str = None, run_name: str = None, tag: str = None) -> dict:
+    def vision_act(self, executor, text_critique: dict, method: Callable, *args, **kwargs) -> dict:
+        """
+        Run the vision critic and merge its result with a text critique produced by text_act.
+        """
+        vision_future = executor.submit(self.vision_critic.config.model_name, method, *args, **kwargs)
+        vision_critique = vision_future.result()
+        text_critique = dict(text_critique)
+        text_timing = text_critique.pop('timing', None)
+
+        return {
+            'vision_critic': vision_critique,
+            'text_critic': text_critique,
+            'mode': 'separate',
+            'requests': 2,
+            'timing': {
+                'vision_critic': vision_future.timing,
+                'text_critic': text_timing
+            }
+        }
+
+    @traced('critic.act_with_prev_state', 'critic')
+    def act_with_prev_state(self, request: str, action_image: Union[str, Image.Image, List[Union[str, Image.Image]]] = None, action_code: str = None, prev_vision_critique: str = None, prev_text_critique: str = None, run_name: str = None, tag: str = None, image_titles: List[str] = None, code_diff: str = None, text_critique: dict = None) -> dict:
         """
         Perform an action with the given parameters, considering previous critiques.
         :param request: The action to perform.
@@ -346,25 +996,44 @@ class Critic(Agent):
         :param action_code: Code input for the critic.
         :param prev_vision_critique: Previous critique on the image.    
         :param prev_text_critique: Previous critique on the code.
+        :param image_titles: Titles of the images when a list of images is given.
+        :param code_diff: Unified diff against the previous code, sent to the text critic instead of the full code.
+        :param text_critique: Result of text_act when the text critic already ran, only the vision critic is called then.
         :return: Result of the action.
         """
 
         if isinstance(action_image, Image.Image) and self.config.image_path:
             raise ValueError("Image should be a path string, since force use image_path is set to True.")
 
-        vision_critique = None
-        text_critique = None
+        if self.combined_critic is not None:
+            return self.combined_act(request, action_image, action_code, prev_vision_critique, prev_text_critique,
+                                     run_name=run_name, tag=tag, image_titles=image_titles)
+
+        if self.config.cascade.enabled:
+            return self.cascade_act(((request, action_code), {'prev_code_critique': prev_text_critique, 'run_name': run_name, 'tag': tag, 'code_diff': code_diff}),
+                                    ('act_with_prev_state', (request, action_image, prev_vision_critique), {'run_name': run_name, 'tag': tag, 'image_titles': image_titles}))
+
+        executor = get_critic_executor(self.config.max_workers, self.config.max_concurrency_per_model)
 
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            # Submit both tasks
-            vision_future = executor.submit(self.vision_critic.act_with_prev_state, request, action_image, prev_vision_critique, run_name=run_name, tag=tag)
-            text_future = executor.submit(self.text_critic.act_with_prev_state, request, action_code, prev_text_critique, run_name=run_name, tag=tag)
+        if text_critique is not None:
+            return self.vision_act(executor, text_critique, self.vision_critic.act_with_prev_state, request, action_image, prev_vision_critique,
+                                   run_name=run_name, tag=tag, image_titles=image_titles)
 
-            # Get results
-            vision_critique = vision_future.result()
-            text_critique = text_future.result()
+        # Submit both tasks
+        vision_future = executor.submit(self.vision_critic.config.model_name, self.vision_critic.act_with_prev_state, request, action_image, prev_vision_critique, run_name=run_name, tag=tag, image_titles=image_titles)
+        text_future = executor.submit(self.text_critic.config.model_name, self.text_critic.act_with_prev_state, request, action_code, prev_code_critique=prev_text_critique, run_name=run_name, tag=tag, code_diff=code_diff)
+
+        # Get results
+        vision_critique = vision_future.result()
+        text_critique = text_future.result()
             
         return {
             'vision_critic': vision_critique,
-            'text_critic': text_critique
+            'text_critic': text_critique,
+            'mode': 'separate',
+            'requests': 2,
+            'timing': {
+                'vision_critic': vision_future.timing,
+                'text_critic': text_future.timing
+            }
         }
\ No newline at end of file
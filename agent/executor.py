@@ -0,0 +1,131 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Tuple
+
+
+class CriticExecutor:
+    """
+    Process-wide thread pool for critic calls, with a bound on the in-flight requests per model.
+
+    Calls over the bound of their model wait in a queue of that model and are only handed to
+    the pool when a call of the same model finishes, so a busy model never holds pool threads
+    and never delays the calls of the other models.
+
+    The timing of every call is split into the queue wait (waiting for the model slot and for
+    a worker) and the execution time, and attached to the returned future as `future.timing`.
+    """
+
+    def __init__(self, max_workers: int = 16, max_concurrency_per_model: int = 8):
+        """
+        :param max_workers: Number of threads shared by every critic.
+        :param max_concurrency_per_model: Maximum number of in-flight requests per model.
+        """
+        self.max_workers = max_workers
+        self.max_concurrency_per_model = max_concurrency_per_model
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='critic')
+        self._lock = threading.Lock()
+        self._queues: Dict[str, deque] = {}
+        self._stats: Dict[str, dict] = {}
+
+    def _model(self, model_name: str) -> None:
+        if model_name not in self._queues:
+            self._queues[model_name] = deque()
+            self._stats[model_name] = {'calls': 0, 'in_flight': 0, 'queued': 0, 'queue_wait': 0.0, 'execution': 0.0}
+
+    def _dispatch(self, model_name: str, future: Future, fn: Callable, args: tuple, kwargs: dict, submitted: float) -> None:
+        """
+        Hand a call to the pool, its model slot is already taken.
+        """
+        timing = future.timing
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                self._release(model_name)
+                return
+            started = time.perf_counter()
+            timing['queue_wait'] = started - submitted
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                timing['execution'] = time.perf_counter() - started
+                with self._lock:
+                    stats = self._stats[model_name]
+                    stats['calls'] += 1
+                    stats['queue_wait'] += timing['queue_wait']
+                    stats['execution'] += timing['execution']
+                self._release(model_name)
+
+        self._executor.submit(run)
+
+    def _release(self, model_name: str) -> None:
+        """
+        Free the slot of a finished call, or pass it to the next queued call of the model.
+        """
+        with self._lock:
+            stats = self._stats[model_name]
+            queue = self._queues[model_name]
+            if not queue:
+                stats['in_flight'] -= 1
+                return
+            call = queue.popleft()
+            stats['queued'] -= 1
+        self._dispatch(model_name, *call)
+
+    def submit(self, model_name: str, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Submit a critic call.
+
+        :param model_name: Model used by the call, used to bound the concurrency.
+        :param fn: Function to call.
+        :return: Future of the result, with the call timing in `future.timing`.
+        """
+        future = Future()
+        future.timing = {'queue_wait': None, 'execution': None}
+        call = (future, fn, args, kwargs, time.perf_counter())
+
+        with self._lock:
+            self._model(model_name)
+            stats = self._stats[model_name]
+            if stats['in_flight'] >= self.max_concurrency_per_model:
+                self._queues[model_name].append(call)
+                stats['queued'] += 1
+                return future
+            stats['in_flight'] += 1
+
+        self._dispatch(model_name, *call)
+        return future
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Cumulative calls, in-flight and queued requests, queue wait and execution time per model.
+        """
+        with self._lock:
+            return {model: dict(stats) for model, stats in self._stats.items()}
+
+
+_critic_executors: Dict[Tuple[int, int], CriticExecutor] = {}
+_critic_executor_lock = threading.Lock()
+
+
+def get_critic_executor(max_workers: int = 16, max_concurrency_per_model: int = 8) -> CriticExecutor:
+    """
+    Get the process-wide critic executor of a pair of limits, created on first use.
+
+    Critics configured with the same limits share one executor and its per-model bound; critics
+    with other limits get an executor of their own instead of silently running under the first limits.
+
+    :param max_workers: Number of threads shared by every critic with these limits.
+    :param max_concurrency_per_model: Maximum number of in-flight requests per model.
+    :return: The shared critic executor.
+    """
+    key = (max_workers, max_concurrency_per_model)
+    with _critic_executor_lock:
+        if key not in _critic_executors:
+            _critic_executors[key] = CriticExecutor(max_workers, max_concurrency_per_model)
+        return _critic_executors[key]
@@ -0,0 +1,358 @@
+import time
+import random
+import threading
+from typing import Callable, Dict, Optional
+
+from pydantic import BaseModel, Field
+
+from agent.usage import call_with_usage
+
+import logging
+
+
+class ProviderLimits(BaseModel):
+    """
+    Rate limits and retry policy of a provider.
+    """
+    requests_per_minute: Optional[float] = Field(default=500, description="Requests allowed per minute, None for no limit")
+    tokens_per_minute: Optional[float] = Field(default=200000, description="Input tokens allowed per minute, None for no limit")
+    max_concurrency: int = Field(default=16, description="Upper bound of the adaptive concurrency limit")
+    min_concurrency: int = Field(default=1, description="Lower bound of the adaptive concurrency limit")
+    initial_concurrency: int = Field(default=8, description="Concurrency limit before any feedback")
+    latency_target: Optional[float] = Field(default=60.0, description="Latency in seconds above which the concurrency stops growing, None to ignore latency")
+    max_retries: int = Field(default=5, description="Retries of a rate limited request")
+    backoff_base: float = Field(default=1.0, description="First backoff delay in seconds, doubled at every retry")
+    backoff_max: float = Field(default=60.0, description="Maximum backoff delay in seconds")
+
+
+# Conservative defaults of the providers we use, for one API key. Pass the limits of your keys
+# to the agents (AgentConfig.gateway_limits) when they differ
+PROVIDER_LIMITS = {
+    'openai': ProviderLimits(requests_per_minute=500, tokens_per_minute=200000, max_concurrency=32, initial_concurrency=16),
+    'gemini': ProviderLimits(requests_per_minute=150, tokens_per_minute=1000000, max_concurrency=16),
+    'google': ProviderLimits(requests_per_minute=30, tokens_per_minute=15000, max_concurrency=4, initial_concurrency=2),
+    'nim': ProviderLimits(requests_per_minute=40, tokens_per_minute=None, max_concurrency=8, initial_concurrency=4),
+}
+
+
+def get_provider(model_name: str) -> str:
+    """
+    Provider of a model: the prefix before ':' (e.g. 'nim:meta/llama-4'), or inferred from the model family.
+    """
+    if ':' in model_name:
+        return model_name.split(':', 1)[0]
+    if model_name.startswith(('gpt', 'o1', 'o3', 'o4')):
+        return 'openai'
+    if model_name.startswith('gemini'):
+        return 'gemini'
+    return model_name
+
+
+# Rate limit exceptions of the provider SDKs (openai and anthropic, google-api-core), matched by class name
+# so that the SDKs stay optional
+RATE_LIMIT_ERRORS = ('RateLimitError', 'ResourceExhausted', 'TooManyRequests')
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Whether an exception raised by a provider client is a rate limit error: an HTTP 429 status on
+    the exception or on its response, or one of the rate limit exception types of the provider SDKs.
+    The message is never read, a 429 in the text of another error is not a rate limit.
+    """
+    if any(cls.__name__ in RATE_LIMIT_ERRORS for cls in type(error).__mro__):
+        return True
+    response = getattr(error, 'response', None)
+    statuses = (getattr(error, 'status_code', None), getattr(error, 'status', None),
+                getattr(error, 'code', None), getattr(response, 'status_code', None))
+    return any(status == 429 or status == 'RESOURCE_EXHAUSTED' for status in statuses)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Delay requested by the provider in the Retry-After header of a rate limit error, if any.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        return float(value) if value is not None else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def estimate_tokens(messages: list) -> int:
+    """
+    Rough input token count of messages: 4 characters per token and a flat cost per image.
+    """
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get('content', '') if isinstance(message, dict) else message
+        parts = content if isinstance(content, list) else [content]
+        for part in parts:
+            if isinstance(part, dict) and part.get('type') == 'image':
+                images += 1
+            elif isinstance(part, dict):
+                chars += len(str(part.get('text', '')))
+            else:
+                chars += len(str(part))
+    return chars // 4 + images * 1000
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Take amount tokens, waiting for the bucket to refill if needed.
+
+        A request larger than the bucket waits for a full bucket and leaves it empty.
+
+        :return: Time waited in seconds.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit adjusted from the provider feedback (additive increase, multiplicative decrease):
+    it grows by one slot per limit of successful requests and halves on a rate limit error
+    or when the latency exceeds the target.
+    """
+
+    def __init__(self, limits: ProviderLimits):
+        self.limits = limits
+        self.limit = float(limits.initial_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self, latency: Optional[float] = None, rate_limited: bool = False) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            target = self.limits.latency_target
+            if rate_limited or (latency is not None and target is not None and latency > target):
+                self.limit = max(self.limits.min_concurrency, self.limit / 2)
+            elif latency is not None:
+                self.limit = min(self.limits.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class ProviderGateway:
+    """
+    Gateway of every request to a provider: token bucket limits on requests and input tokens,
+    adaptive concurrency, and retries with exponential backoff on rate limit errors.
+    """
+
+    def __init__(self, provider: str, limits: ProviderLimits):
+        self.provider = provider
+        self.limits = limits
+        self.limiter = AdaptiveLimiter(limits)
+        self.request_bucket = TokenBucket(limits.requests_per_minute) if limits.requests_per_minute else None
+        self.token_bucket = TokenBucket(limits.tokens_per_minute) if limits.tokens_per_minute else None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queued = 0
+        self.stats = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'failures': 0, 'throttle_wait': 0.0, 'latency': 0.0}
+
+    def _count(self, **counts) -> None:
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def _admit(self, tokens: int) -> float:
+        """
+        Wait for the rate limits and a concurrency slot.
+
+        :return: Time waited in seconds.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+        try:
+            waited = 0.0
+            if self.request_bucket is not None:
+                waited += self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                waited += self.token_bucket.acquire(tokens)
+            self.limiter.acquire()
+            self._count(throttle_wait=waited)
+        finally:
+            with self._lock:
+                self._queued -= 1
+        return time.perf_counter() - start
+
+    def call(self, fn: Callable, *args, tokens: int = 0, **kwargs):
+        """
+        Call fn through the gateway.
+
+        :param fn: Function sending the request.
+        :param tokens: Estimated input tokens of the request, for the token bucket.
+        :return: Result of fn.
+        """
+        queue_time = 0.0
+        self._local.last_call = None
+        for attempt in range(self.limits.max_retries + 1):
+            queue_time += self._admit(tokens)
+            self._local.last_call = {'queue_time': queue_time, 'retries': attempt}
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                rate_limited = is_rate_limit_error(e)
+                self.limiter.release(rate_limited=rate_limited)
+                if not rate_limited:
+                    self._count(failures=1)
+                    raise
+                self._count(rate_limited=1)
+                if attempt == self.limits.max_retries:
+                    self._count(failures=1)
+                    raise
+                delay = retry_after(e) or min(self.limits.backoff_max, self.limits.backoff_base * 2 ** attempt)
+                delay *= random.uniform(1.0, 1.25)
+                logging.warning(f"Rate limited by {self.provider}, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.limits.max_retries})")
+                self._count(retries=1)
+                time.sleep(delay)
+                continue
+
+            latency = time.perf_counter() - start
+            self.limiter.release(latency=latency)
+            self._count(requests=1, latency=latency)
+            return result
+
+    def stream(self, fn: Callable, *args, tokens: int = 0, **kwargs):
+        """
+        Stream the chunks of fn through the gateway, holding a concurrency slot until the stream ends or is closed.
+        A stream cannot be retried once started, so rate limit errors are only reported to the limiter.
+        """
+        self._local.last_call = {'queue_time': self._admit(tokens), 'retries': 0}
+        start = time.perf_counter()
+        rate_limited = False
+        try:
+            yield from fn(*args, **kwargs)
+        except Exception as e:
+            rate_limited = is_rate_limit_error(e)
+            self._count(rate_limited=int(rate_limited), failures=1)
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            self.limiter.release(latency=None if rate_limited else latency, rate_limited=rate_limited)
+            if not rate_limited:
+                self._count(requests=1, latency=latency)
+
+    def last_call(self) -> Optional[dict]:
+        """
+        Queue time and retries of the last call made through the gateway from the current thread.
+        """
+        return getattr(self._local, 'last_call', None)
+
+    def queue_depth(self) -> int:
+        """
+        Number of requests waiting for the rate limits or a concurrency slot.
+        """
+        with self._lock:
+            return self._queued
+
+    def snapshot(self) -> dict:
+        """
+        Stats, queue depth, in-flight requests and current concurrency limit of the gateway.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue_depth()
+        stats['in_flight'] = self.limiter.in_flight
+        stats['concurrency_limit'] = int(self.limiter.limit)
+        return stats
+
+
+class GatewayLLM:
+    """
+    Wraps an LLM wrapper so that every call goes through the gateway of its provider.
+    """
+
+    def __init__(self, llm, gateway: ProviderGateway):
+        self.llm = llm
+        self.gateway = gateway
+
+    def complete_with_usage(self, messages: list, **kwargs):
+        """
+        Call the model through the gateway.
+
+        :return: Tuple of the response and the token usage of this call.
+        """
+        return self.gateway.call(call_with_usage, self.llm, messages, tokens=estimate_tokens(messages), **kwargs)
+
+    def __call__(self, messages: list, **kwargs):
+        return self.complete_with_usage(messages, **kwargs)[0]
+
+    def __getattr__(self, name):
+        llm = self.__dict__['llm']
+        if name == 'stream' and callable(getattr(llm, 'stream', None)):
+            return lambda messages, **kwargs: self.gateway.stream(llm.stream, messages, tokens=estimate_tokens(messages), **kwargs)
+        return getattr(llm, name)
+
+
+_gateways: Dict[str, ProviderGateway] = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway(model_name: str, key_pool: str = 'default', limits: Optional[ProviderLimits] = None) -> ProviderGateway:
+    """
+    Get the process-wide gateway of the provider of a model and of an API key pool, created on first use.
+
+    Rate limits apply per key, so every key pool gets its own gateway: a rotating client
+    (key_pool='rotate') never shares the budget of the single-key clients of the same provider.
+
+    The limits of the first call are kept, later calls with different limits only log a warning.
+
+    :param model_name: Name of the model.
+    :param key_pool: API keys the client uses, 'default' for the single key, 'rotate' for the rotated keys.
+    :param limits: Limits of the gateway, PROVIDER_LIMITS of the provider when None.
+    :return: The shared gateway of the provider and key pool.
+    """
+    provider = get_provider(model_name)
+    key = f"{provider}/{key_pool}"
+    with _gateways_lock:
+        if key not in _gateways:
+            _gateways[key] = ProviderGateway(key, limits or PROVIDER_LIMITS.get(provider, ProviderLimits()))
+        elif limits is not None and _gateways[key].limits != limits:
+            logging.warning(f"Gateway {key} already running with other limits, ignoring the new limits.")
+        return _gateways[key]
+
+
+def gateway_stats() -> Dict[str, dict]:
+    """
+    Snapshot of every gateway, keyed by 'provider/key_pool'.
+    """
+    with _gateways_lock:
+        gateways = dict(_gateways)
+    return {key: gateway.snapshot() for key, gateway in gateways.items()}
@@ -0,0 +1,230 @@
+import time
+import queue
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from agent.usage import call_with_usage
+
+import logging
+
+
+class LatencyTracker:
+    """
+    Recent call latencies of a model, used to decide when a call is late.
+    """
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        """
+        Latency percentile of the recent calls, None until min_samples calls are recorded.
+
+        :param q: Percentile between 0 and 1.
+        """
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            return float(np.quantile(list(self._latencies), q))
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+_trackers_lock = threading.Lock()
+
+def _unwrap(client):
+    """
+    Identity of the innermost client of a chain of wrappers (gateway, logger), followed through their `llm` attribute.
+
+    Pooled clients of the registry stand for their key: two agents' clients of the same model, rotation and logger are the same client.
+    """
+    while hasattr(client, '__dict__') and client.__dict__.get('llm') is not None:
+        client = client.__dict__['llm']
+    return getattr(client, 'key', client)
+
+
+def get_latency_tracker(model_name: str) -> LatencyTracker:
+    """
+    Get the process-wide latency tracker of a model.
+    """
+    with _trackers_lock:
+        if model_name not in _trackers:
+            _trackers[model_name] = LatencyTracker()
+        return _trackers[model_name]
+
+
+class HedgedLLM:
+    """
+    Wraps a client to hedge slow calls: when the call has not returned after the given percentile
+    of the recent latencies of the model, the same request is sent to a hedge client (another key
+    or a fallback model) and the first answer wins.
+
+    Calls that cannot be hedged (too few latencies observed, no hedge client, budget spent) run
+    on the calling thread. The others run the primary request on a thread of its own, so that the
+    caller can return the hedge answer without waiting for it; the hedge thread is only started
+    once the delay is over. A request in flight cannot be aborted through the provider wrappers:
+    the losing request runs to completion, its answer is dropped and its tokens are counted in
+    stats['dropped_tokens'].
+
+    The usage and the gateway queue time and retries are read on the thread that made the request
+    and handed back with the answer: complete_with_usage returns the usage of the winning request
+    and last_call() gives its gateway call for the calling thread.
+    """
+
+    def __init__(self,
+                 llm,
+                 hedges: List[object],
+                 model_name: str,
+                 percentile: float = 0.95,
+                 budget: float = 0.1,
+                 min_samples: int = 20):
+        """
+        :param llm: Primary client.
+        :param hedges: Clients the hedge requests are sent to, in order. Clients sharing the primary client are dropped.
+        :param model_name: Model of the primary client, its latencies set the hedge delay.
+        :param percentile: Latency percentile after which a call is hedged.
+        :param budget: Maximum share of the calls that can be hedged.
+        :param min_samples: Calls to observe before hedging.
+        """
+        self.llm = llm
+        primary = _unwrap(llm)
+        self.hedges = [hedge for hedge in hedges if _unwrap(hedge) != primary]
+        if len(self.hedges) < len(hedges):
+            logging.warning(f"Not hedging {model_name} onto its own client, set hedge_models or use a client with other keys.")
+        self.model_name = model_name
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.tracker = get_latency_tracker(model_name)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'primary_wins': 0, 'over_budget': 0, 'dropped_tokens': 0}
+
+    def last_call(self) -> Optional[dict]:
+        """
+        Gateway queue time and retries of the request that answered the last call of the current thread.
+        """
+        return getattr(self._local, 'call', None)
+
+    def _timed(self, client, messages: list, **kwargs):
+        """
+        Call a client on a hedge thread.
+
+        :return: Tuple of the answer, its usage and its gateway call, read on the thread that made the request.
+        """
+        from agent.base import gateway_call
+
+        start = time.perf_counter()
+        result, usage = call_with_usage(client, messages, **kwargs)
+        if client is self.llm:
+            self.tracker.add(time.perf_counter() - start)
+        return result, usage, gateway_call(client)
+
+    def _start(self, client, messages: list, answers: queue.Queue, answered: threading.Event, **kwargs) -> None:
+        """
+        Send a request on a thread of its own, putting (client, answer, error) on answers.
+
+        The first successful answer sets answered; an answer arriving after it is dropped and its tokens counted.
+        """
+        def run():
+            try:
+                answer, error = self._timed(client, messages, **kwargs), None
+            except Exception as e:
+                answer, error = None, e
+            with self._lock:
+                if answered.is_set():
+                    usage = answer[1] if answer else None
+                    if usage:
+                        self.stats['dropped_tokens'] += usage['input_tokens'] + usage['output_tokens']
+                    return
+                if error is None:
+                    answered.set()
+            answers.put((client, answer, error))
+
+        threading.Thread(target=run, name=f'hedge-{self.model_name}', daemon=True).start()
+
+    def _answer(self, answer) -> tuple:
+        """
+        Answer and usage of a request, keeping its gateway call for the calling thread.
+        """
+        result, usage, self._local.call = answer
+        return result, usage
+
+    def _budget_left(self) -> bool:
+        with self._lock:
+            return self.stats['hedged'] + 1 <= self.budget * self.stats['calls']
+
+    def _can_hedge(self) -> bool:
+        with self._lock:
+            if self.stats['hedged'] + 1 > self.budget * self.stats['calls']:
+                self.stats['over_budget'] += 1
+                return False
+            self.stats['hedged'] += 1
+            return True
+
+    def complete_with_usage(self, messages: list, **kwargs):
+        """
+        Call the primary client, hedged when it is late.
+
+        :return: Tuple of the first answer and its token usage.
+        """
+        with self._lock:
+            self.stats['calls'] += 1
+
+        self._local.call = None
+        delay = self.tracker.percentile(self.percentile, self.min_samples)
+        if delay is None or not self.hedges or not self._budget_left():
+            return self._answer(self._timed(self.llm, messages, **kwargs))
+
+        answers, answered = queue.Queue(), threading.Event()
+        self._start(self.llm, messages, answers, answered, **kwargs)
+        try:
+            _, answer, error = answers.get(timeout=delay)
+        except queue.Empty:
+            pass
+        else:
+            if error is not None:
+                raise error
+            return self._answer(answer)
+
+        if not self._can_hedge():
+            _, answer, error = answers.get()
+            if error is not None:
+                raise error
+            return self._answer(answer)
+
+        with self._lock:
+            hedge_client = self.hedges[(self.stats['hedged'] - 1) % len(self.hedges)]
+        logging.info(f"Hedging a call to {self.model_name} after {delay:.1f}s")
+        self._start(hedge_client, messages, answers, answered, **kwargs)
+
+        error = None
+        for _ in range(2):
+            client, answer, error = answers.get()
+            if error is not None:
+                continue
+            with self._lock:
+                self.stats['primary_wins' if client is self.llm else 'hedge_wins'] += 1
+            return self._answer(answer)
+        raise error
+
+    def __call__(self, messages: list, **kwargs):
+        return self.complete_with_usage(messages, **kwargs)[0]
+
+    def __getattr__(self, name):
+        # Streaming and any other method go to the primary client only
+        return getattr(self.__dict__['llm'], name)
+
+    def win_rate(self) -> float:
+        """
+        Share of the hedged calls answered first by the hedge request.
+        """
+        with self._lock:
+            return self.stats['hedge_wins'] / self.stats['hedged'] if self.stats['hedged'] else 0.0
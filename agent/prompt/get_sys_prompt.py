@@ -1,9 +1,94 @@
 import os
 import sys
+import time
+import threading
+from typing import Callable, Dict, Tuple
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(CURRENT_DIR, '..', '..'))
 
+PROMPT_FILES = {
+    "actor": 'actor_prompt.md',
+    "text_critic": 'text_critic_prompt.md',
+    "vision_critic": 'vision_critic_prompt.md',
+    "combined_critic": 'combined_critic_prompt.md',
+    "ranking_critic": 'ranking_critic_prompt.md',
+    "evaluator": 'evaluator_prompt.md',
+}
+
+
+class PromptRegistry:
+    """
+    Loads prompt files once and keeps them in memory.
+
+    A file is read again only when its modification time changes, and the modification time
+    is checked at most once every check_interval seconds, so the hot path does no file I/O.
+    Assembled prompts are cached the same way, keyed by the files they are built from.
+    """
+
+    def __init__(self, check_interval: float = 1.0):
+        """
+        :param check_interval: Minimum time in seconds between two modification time checks of a file.
+        """
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._files: Dict[str, Tuple[float, float, str]] = {}
+        self._assembled: Dict[str, Tuple[tuple, str]] = {}
+
+    def _load(self, path: str) -> Tuple[float, str]:
+        """
+        Get the modification time and content of a file, reading it only if it changed.
+        """
+        now = time.monotonic()
+        cached = self._files.get(path)
+        if cached is not None and now - cached[1] < self.check_interval:
+            return cached[0], cached[2]
+
+        mtime = os.path.getmtime(path)
+        if cached is not None and cached[0] == mtime:
+            self._files[path] = (mtime, now, cached[2])
+            return mtime, cached[2]
+
+        with open(path, 'r') as f:
+            content = f.read()
+        self._files[path] = (mtime, now, content)
+        return mtime, content
+
+    def read(self, path: str) -> str:
+        """
+        Get the content of a file.
+
+        :param path: Path to the file.
+        :return: Content of the file.
+        """
+        with self._lock:
+            return self._load(path)[1]
+
+    def assemble(self, key: str, paths: Tuple[str, ...], build: Callable[..., str]) -> str:
+        """
+        Get a prompt built from several files, built again only when one of the files changes.
+
+        :param key: Cache key of the assembled prompt.
+        :param paths: Files the prompt is built from.
+        :param build: Function building the prompt from the contents of the files, in order.
+        :return: Assembled prompt.
+        """
+        with self._lock:
+            loaded = [self._load(path) for path in paths]
+            versions = tuple(mtime for mtime, _ in loaded)
+
+            cached = self._assembled.get(key)
+            if cached is not None and cached[0] == versions:
+                return cached[1]
+
+            prompt = build(*[content for _, content in loaded])
+            self._assembled[key] = (versions, prompt)
+            return prompt
+
+
+PROMPT_REGISTRY = PromptRegistry()
+
+
 def get_sys_prompt(module_name: str) -> str:
     """
     Get the system prompt for the specified module.
@@ -11,22 +96,8 @@ def get_sys_prompt(module_name: str) -> str:
     :param module_name: Name of the module to get the system prompt for.
     :return: System prompt string.
     """
-    sys_prompt = f"You are a helpful assistant"
-
-    if module_name == "actor":
-        with open(os.path.join(CURRENT_DIR, 'actor_prompt.md'), 'r') as f:
-            sys_prompt = f.read()
-    
-    elif module_name == "text_critic":
-        with open(os.path.join(CURRENT_DIR, 'text_critic_prompt.md'), 'r') as f:
-            sys_prompt = f.read()
-    
-    elif module_name == "vision_critic":
-        with open(os.path.join(CURRENT_DIR, 'vision_critic_prompt.md'), 'r') as f:
-            sys_prompt = f.read()
-
-    elif module_name == "evaluator":
-        with open(os.path.join(CURRENT_DIR, 'evaluator_prompt.md'), 'r') as f:
-            sys_prompt = f.read()
-
-    return sys_prompt.strip()
\ No newline at end of file
+    if module_name not in PROMPT_FILES:
+        return "You are a helpful assistant"
+
+    path = os.path.join(CURRENT_DIR, PROMPT_FILES[module_name])
+    return PROMPT_REGISTRY.assemble(module_name, (path,), lambda content: content.strip())
@@ -0,0 +1,207 @@
+import os
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from llm import get_llm_wrapper, get_rotate_llm_wrapper
+from agent.usage import call_with_usage
+
+import logging
+
+
+# Attributes the provider wrappers keep their SDK client (and its HTTP connection pool) in
+SDK_CLIENT_ATTRIBUTES = ('client',)
+
+
+def sdk_client_owner(llm) -> Tuple[Optional[object], Optional[str]]:
+    """
+    Find the wrapper holding the SDK client of a wrapper chain, followed through the `llm` attribute of the message loggers.
+
+    :return: Tuple of the wrapper and the name of its SDK client attribute, (None, None) if no SDK client is exposed.
+    """
+    while llm is not None and hasattr(llm, '__dict__'):
+        for name in SDK_CLIENT_ATTRIBUTES:
+            if llm.__dict__.get(name) is not None:
+                return llm, name
+        llm = llm.__dict__.get('llm')
+    return None, None
+
+
+class PooledLLM:
+    """
+    LLM wrapper of one agent, handing every call a wrapper of its own.
+
+    The provider wrappers keep state between calls: the usage of the last call, the position in the
+    key rotation, the message logger buffers. A call checks out an idle wrapper (built on demand
+    when every wrapper is busy), reads the usage on it before giving it back, and returns it with
+    the response. No two threads ever use the same wrapper at the same time, and no wrapper is
+    shared between agents; only the SDK client inside is shared through the ClientRegistry.
+    """
+
+    def __init__(self, build: Callable[[], object], key: tuple):
+        """
+        :param build: Function building a new wrapper.
+        :param key: Registry key of the wrappers (model, multimodal, rotate, logger).
+        """
+        self.build = build
+        self.key = key
+        self._lock = threading.Lock()
+        self._idle: List[object] = []
+        self.size = 0
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.size += 1
+        return self.build()
+
+    def _checkin(self, llm) -> None:
+        with self._lock:
+            self._idle.append(llm)
+
+    def complete_with_usage(self, messages: list, **kwargs) -> Tuple[object, Optional[dict]]:
+        """
+        Call the model.
+
+        :return: Tuple of the response and the token usage of this call (None if the wrapper does not report it).
+        """
+        llm = self._checkout()
+        try:
+            return call_with_usage(llm, messages, **kwargs)
+        finally:
+            self._checkin(llm)
+
+    def __call__(self, messages: list, **kwargs):
+        return self.complete_with_usage(messages, **kwargs)[0]
+
+    def _stream(self, messages: list, **kwargs):
+        """
+        Stream the response chunk by chunk on a wrapper held until the stream ends or is closed.
+        """
+        llm = self._checkout()
+        try:
+            yield from llm.stream(messages, **kwargs)
+        finally:
+            self._checkin(llm)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # Attributes are read on an idle wrapper, e.g. whether the wrapper can stream
+        llm = self._checkout()
+        try:
+            value = getattr(llm, name)
+        finally:
+            self._checkin(llm)
+        if name == 'stream' and callable(value):
+            return self._stream
+        return value
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of the provider SDK clients, shared by every agent using the same model.
+
+    Sharing the SDK client shares its HTTP connection pool, so agents built per question reuse the
+    open connections instead of opening new ones. The wrappers around it are never shared: every
+    agent gets a PooledLLM with its own wrappers and message loggers, each used by one thread at a time.
+    Rotating wrappers switch SDK clients with the API key and keep their own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple, object] = {}
+        self.stats = {'requests': 0, 'builds': 0, 'shared': 0}
+
+    @staticmethod
+    def build(model_name: str, multimodal: bool = False, rotate: bool = False, logger: Optional[str] = None):
+        """
+        Build a new wrapper, wrapped in the message logger if one is set.
+        """
+        if rotate:
+            llm = get_rotate_llm_wrapper(model_name, multimodal=multimodal)
+        else:
+            llm = get_llm_wrapper(model_name, multimodal=multimodal)
+
+        if logger == 'mongodb':
+            logging.info("Using MongoDB logger")
+            from llm.logger.log_mongodb import LLMLogMongoDB
+            llm = LLMLogMongoDB(llm)
+
+        elif logger == 'postgres':
+            logging.info("Using PostgreSQL logger")
+            from llm.logger.log_postgres import LLMLogPostgres
+            llm = LLMLogPostgres(llm)
+
+        return llm
+
+    def share(self, llm, model_name: str, multimodal: bool = False):
+        """
+        Point a new wrapper at the shared SDK client of its model, the first wrapper's client becomes the shared one.
+
+        :return: The same wrapper.
+        """
+        owner, name = sdk_client_owner(llm)
+        if owner is None:
+            return llm
+        key = (model_name, multimodal)
+        with self._lock:
+            shared = self._clients.setdefault(key, getattr(owner, name))
+            if shared is not getattr(owner, name):
+                setattr(owner, name, shared)
+                self.stats['shared'] += 1
+        return llm
+
+    def get(self, model_name: str, multimodal: bool = False, rotate: bool = False, logger: Optional[str] = None) -> PooledLLM:
+        """
+        Get a new LLM for an agent, its wrappers built on the shared SDK client of the model.
+
+        :param model_name: Name of the model.
+        :param multimodal: Whether the client must accept images.
+        :param rotate: Whether the client rotates over several API keys.
+        :param logger: Message logger wrapping the client: None, mongodb or postgres.
+        :return: The agent's pooled LLM.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+
+        def build():
+            llm = self.build(model_name, multimodal=multimodal, rotate=rotate, logger=logger)
+            with self._lock:
+                self.stats['builds'] += 1
+            return llm if rotate else self.share(llm, model_name, multimodal)
+
+        return PooledLLM(build, (model_name, multimodal, rotate, logger))
+
+    def live_clients(self) -> int:
+        """
+        Number of SDK clients held by the registry.
+        """
+        with self._lock:
+            return len(self._clients)
+
+    def clear(self) -> None:
+        """
+        Drop every SDK client, the next wrappers built keep their own.
+        """
+        with self._lock:
+            self._clients.clear()
+
+
+CLIENT_REGISTRY = ClientRegistry()
+
+
+def get_client(model_name: str, multimodal: bool = False, rotate: bool = False, logger: Optional[str] = None) -> PooledLLM:
+    """
+    Get a new LLM for an agent from the process-wide registry, sharing the SDK client of the model.
+
+    :param model_name: Name of the model.
+    :param multimodal: Whether the client must accept images.
+    :param rotate: Whether the client rotates over several API keys.
+    :param logger: Message logger wrapping the client: None, mongodb or postgres.
+    :return: The agent's pooled LLM.
+    """
+    return CLIENT_REGISTRY.get(model_name, multimodal=multimodal, rotate=rotate, logger=logger)
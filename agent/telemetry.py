@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import logging
+
+# Upper bounds of the histogram buckets of each metric
+BUCKETS = {
+    'queue_time': (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60),
+    'time_to_first_token': (0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+    'latency': (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+    'input_tokens': (100, 500, 1000, 2000, 5000, 10000, 20000, 50000),
+    'output_tokens': (50, 100, 250, 500, 1000, 2000, 4000, 8000),
+    'image_tokens': (100, 250, 500, 1000, 2000, 4000, 8000),
+    'retries': (0, 1, 2, 3, 5, 10),
+}
+
+
+def _label(value) -> str:
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, in the Prometheus layout.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Telemetry:
+    """
+    In-process registry of per-call agent metrics: queue time, time to first token, latency,
+    input/output/image tokens and retries, as histograms per metric, agent and model.
+
+    Disabled by default: record() returns immediately, so the instrumented calls pay one attribute check.
+    Turned on by AgentConfig.telemetry or by calling configure().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self._calls: Dict[Tuple[str, str], int] = {}
+        self._records = []
+        self._jsonl_path = None
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def configure(self, enabled: bool = True, jsonl_path: Optional[str] = None, flush_interval: float = 60.0) -> None:
+        """
+        Enable or disable the telemetry.
+
+        :param enabled: Whether calls are recorded.
+        :param jsonl_path: File every call record is appended to, every flush_interval seconds. None to keep only the histograms.
+        :param flush_interval: Seconds between two writes of the JSONL file.
+        """
+        if self._flusher is not None and (not enabled or jsonl_path != self._jsonl_path):
+            # The pending records go to the file they were recorded for
+            self._stop.set()
+            self._flusher = None
+            self.flush()
+        self.enabled = enabled
+        self._jsonl_path = jsonl_path
+        if enabled and jsonl_path and self._flusher is None:
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True, name='telemetry')
+            self._flusher.start()
+
+    def record(self, agent: str, model: str, run_name: str = None, tag: str = None, **metrics) -> None:
+        """
+        Record one call.
+
+        :param agent: Agent making the call (actor, vision_critic, router, ...).
+        :param model: Model called.
+        :param metrics: Values of the metrics in BUCKETS, None for the unknown ones.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._calls[(agent, model)] = self._calls.get((agent, model), 0) + 1
+            for metric, value in metrics.items():
+                if value is None or metric not in BUCKETS:
+                    continue
+                key = (metric, agent, model)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(BUCKETS[metric])
+                self._histograms[key].observe(value)
+            if self._jsonl_path:
+                self._records.append({'time': time.time(), 'agent': agent, 'model': model,
+                                      'run_name': run_name, 'tag': tag, **metrics})
+
+    def flush(self) -> None:
+        """
+        Append the pending call records to the JSONL file.
+        """
+        with self._lock:
+            records, self._records = self._records, []
+        if not records or not self._jsonl_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self._jsonl_path)), exist_ok=True)
+        with open(self._jsonl_path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def _flush_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logging.warning(f"Failed to write telemetry: {e}")
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Count, sum and mean of every metric, keyed by 'agent/model'.
+        """
+        with self._lock:
+            summary = {}
+            for (metric, agent, model), histogram in self._histograms.items():
+                summary.setdefault(f"{agent}/{model}", {'calls': self._calls.get((agent, model), 0)})[metric] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'mean': histogram.sum / histogram.count if histogram.count else 0.0
+                }
+            return summary
+
+    def prometheus(self) -> str:
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        lines = ['# TYPE agent_calls_total counter']
+        with self._lock:
+            for (agent, model), count in sorted(self._calls.items()):
+                lines.append(f'agent_calls_total{{agent="{_label(agent)}",model="{_label(model)}"}} {count}')
+
+            for metric in BUCKETS:
+                entries = sorted((key, histogram) for key, histogram in self._histograms.items() if key[0] == metric)
+                if not entries:
+                    continue
+                lines.append(f'# TYPE agent_{metric} histogram')
+                for (_, agent, model), histogram in entries:
+                    labels = f'agent="{_label(agent)}",model="{_label(model)}"'
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'agent_{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'agent_{metric}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'agent_{metric}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9464) -> ThreadingHTTPServer:
+        """
+        Serve the Prometheus text format on /metrics in a background thread.
+
+        :param port: Port to listen on.
+        :return: The running server, call shutdown() to stop it.
+        """
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name='telemetry-http').start()
+        return server
+
+    def reset(self) -> None:
+        """
+        Drop every recorded metric.
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._calls.clear()
+            self._records.clear()
+
+
+TELEMETRY = Telemetry()
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Set
+
+import logging
+
+_NO_SPAN = nullcontext()
+
+
+class Tracer:
+    """
+    Per-run tracing of the stages of a run, exported in the Chrome trace-event format
+    (chrome://tracing, Perfetto).
+
+    Only the runs started with start() are traced: span() on any other run returns a shared
+    no-op context, so the instrumented code pays one set lookup when tracing is off.
+    Spans record the thread they run in, so work spread over the executors shows up as one row per
+    thread, the spans of a thread nested by time. Threads get their own trace id rather than their OS
+    ident, which is reused once a thread exits: short-lived threads (hedge requests, streamed steps)
+    never share a row.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs: Set[str] = set()
+        self._events: Dict[str, List[dict]] = {}
+        self._threads: Dict[str, Dict[int, str]] = {}
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._next_tid = 0
+
+    def _tid(self) -> int:
+        """
+        Trace id of the current thread, drawn on its first span.
+        """
+        tid = getattr(self._local, 'tid', None)
+        if tid is None:
+            with self._lock:
+                self._next_tid += 1
+                tid = self._local.tid = self._next_tid
+        return tid
+
+    def start(self, run_name: str) -> None:
+        """
+        Start tracing a run.
+        """
+        with self._lock:
+            self._runs.add(run_name)
+            self._events.setdefault(run_name, [])
+            self._threads.setdefault(run_name, {})
+
+    def enabled(self, run_name: Optional[str]) -> bool:
+        return run_name in self._runs
+
+    def span(self, name: str, run_name: Optional[str], category: str = '', **args):
+        """
+        Context manager timing a span of a run.
+
+        :param name: Name of the span.
+        :param run_name: Run the span belongs to, nothing is recorded if the run is not traced.
+        :param category: Category of the span (pipeline, module, env, critic, llm, ...).
+        :param args: Values shown with the span in the viewer.
+        """
+        if run_name not in self._runs:
+            return _NO_SPAN
+        return self._span(name, run_name, category, args)
+
+    @contextmanager
+    def _span(self, name: str, run_name: str, category: str, args: dict):
+        thread = threading.current_thread()
+        tid = self._tid()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': {key: str(value) for key, value in args.items() if value is not None}
+            }
+            with self._lock:
+                if run_name in self._events:
+                    self._events[run_name].append(event)
+                    self._threads[run_name].setdefault(tid, thread.name)
+
+    def export(self, run_name: str, path: str) -> Optional[str]:
+        """
+        Stop tracing a run and write its spans to a trace file.
+
+        :param run_name: Run to export.
+        :param path: Path of the trace file, usually .../trace.json.
+        :return: The path written, None if the run was not traced.
+        """
+        with self._lock:
+            self._runs.discard(run_name)
+            events = self._events.pop(run_name, None)
+            threads = self._threads.pop(run_name, {})
+        if events is None:
+            return None
+
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                    for tid, name in threads.items()]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + sorted(events, key=lambda event: event['ts']),
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'run_name': run_name}}, f)
+        logging.info(f"Trace of run {run_name} written to {path}")
+        return path
+
+
+TRACER = Tracer()
+
+
+def traced(name: str, category: str = ''):
+    """
+    Decorator tracing every call of a function taking run_name (and optionally tag) arguments.
+
+    The positions and defaults of the arguments read are resolved once, when the function is decorated.
+    """
+    def decorator(fn):
+        parameters = list(inspect.signature(fn).parameters.values())
+        positions = {parameter.name: index for index, parameter in enumerate(parameters)}
+        defaults = {parameter.name: parameter.default for parameter in parameters if parameter.default is not inspect.Parameter.empty}
+
+        def argument(args: tuple, kwargs: dict, key: str):
+            if key in kwargs:
+                return kwargs[key]
+            index = positions.get(key)
+            if index is not None and index < len(args):
+                return args[index]
+            return defaults.get(key)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER._runs:
+                return fn(*args, **kwargs)
+            run_name = argument(args, kwargs, 'run_name')
+            if run_name not in TRACER._runs:
+                return fn(*args, **kwargs)
+            owner = argument(args, kwargs, 'self')
+            model = getattr(getattr(owner, 'config', None), 'model_name', None) or getattr(owner, 'model_name', None)
+            with TRACER.span(name, run_name, category, tag=argument(args, kwargs, 'tag'), model=model):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def trace_run(run_name: str, path: str, enabled: bool = True):
+    """
+    Trace everything a run does inside the block and write it to path when the block exits.
+
+    Blocks can nest: a block on a run already traced by an enclosing block (e.g. a pipeline run
+    inside a Text2Chart request) records into it and leaves the export to the enclosing block.
+
+    :param run_name: Name of the run.
+    :param path: Path of the trace file.
+    :param enabled: Whether to trace, the block runs untraced otherwise.
+    """
+    if not enabled or TRACER.enabled(run_name):
+        yield
+        return
+
+    TRACER.start(run_name)
+    try:
+        with TRACER.span('run', run_name, 'pipeline'):
+            yield
+    finally:
+        TRACER.export(run_name, path)
@@ -0,0 +1,70 @@
+from typing import Optional, Tuple
+
+
+def _field(obj, *names):
+    """
+    First attribute or key of obj found among names, None if none is set.
+    """
+    for name in names:
+        value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+        if value is not None:
+            return value
+    return None
+
+
+def extract_usage(llm) -> Optional[dict]:
+    """
+    Read the token usage of the last call from an LLM wrapper, if the wrapper exposes it.
+
+    OpenAI, Gemini and Anthropic style usage objects are supported. Wrappers around another
+    wrapper (e.g. the message loggers) are searched through their `llm` attribute.
+    The wrapper must not be called by another thread in between, use call_with_usage on shared wrappers.
+
+    :param llm: LLM wrapper.
+    :return: A dictionary with the input, output and cached input tokens, or None if no usage is available.
+    """
+    usage = None
+    while llm is not None and usage is None:
+        usage = _field(llm, 'last_usage', 'usage', 'usage_metadata')
+        llm = getattr(llm, 'llm', None)
+
+    if usage is None or isinstance(usage, (int, float, str)):
+        return None
+
+    input_tokens = _field(usage, 'prompt_tokens', 'input_tokens', 'prompt_token_count') or 0
+    output_tokens = _field(usage, 'completion_tokens', 'output_tokens', 'candidates_token_count') or 0
+
+    cached_tokens = _field(usage, 'cached_content_token_count', 'cache_read_input_tokens')
+    if cached_tokens is None:
+        details = _field(usage, 'prompt_tokens_details', 'input_tokens_details')
+        cached_tokens = _field(details, 'cached_tokens') if details is not None else None
+
+    return {
+        'input_tokens': int(input_tokens),
+        'output_tokens': int(output_tokens),
+        'cached_tokens': int(cached_tokens or 0),
+        'cached_ratio': (cached_tokens or 0) / input_tokens if input_tokens else 0.0
+    }
+
+
+# Usage of a call answered without reaching the provider
+NO_USAGE = {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'cached_ratio': 0.0}
+
+
+def call_with_usage(llm, messages: list, **kwargs) -> Tuple[object, Optional[dict]]:
+    """
+    Call an LLM wrapper and return the response with the token usage of this very call.
+
+    Our wrappers (pooled, gateway, hedged, cached) hand the usage back from their complete_with_usage
+    method, so no state is read after the call. Other wrappers are called and their usage read right after,
+    which is only safe when no other thread uses them.
+
+    :param llm: LLM wrapper.
+    :param messages: Messages to send.
+    :return: Tuple of the response and the token usage (None if not available).
+    """
+    # Looked up on the class, the wrappers forward unknown attributes to the wrapper they hold
+    if callable(getattr(type(llm), 'complete_with_usage', None)):
+        return llm.complete_with_usage(messages, **kwargs)
+    response = llm(messages, **kwargs)
+    return response, extract_usage(llm)
@@ -70,8 +70,8 @@ def load_questions(jsonl_file='chart_modification.jsonl', done_file=None):
                 questions.append(data)
     return questions
 
-def setup_pipeline(actor_model, critic_model, env_type, logger='mongodb'):
-    """Setup pipeline with randomly selected parameters"""
+def setup_pipeline(actor_model, critic_model, env_type, logger='mongodb', pipeline_type='mcts'):
+    """Setup pipeline with randomly selected parameters, pipeline_type is 'mcts' or 'iterative'"""
     # Set up environment
     if env_type == 'html':
         env = HtmlEnv(config=HtmlEnvConfig(name="HTML Environment"))
@@ -103,9 +103,12 @@ def setup_pipeline(actor_model, critic_model, env_type, logger='mongodb'):
     run_id = str(uuid.uuid4())[:8]
     run_name = f"chart_run_{timestamp}_{run_id}"
     
-    # pipeline = IterativePipeline(module=module, env=env, run_name=run_name, debug=True)
-    
-    pipeline = MCTSPipeline(module=module, env=env, run_name=run_name, debug=False, max_iterations = 8)
+    if pipeline_type == 'iterative':
+        pipeline = IterativePipeline(module=module, env=env, run_name=run_name, debug=False)
+    elif pipeline_type == 'mcts':
+        pipeline = MCTSPipeline(module=module, env=env, run_name=run_name, debug=False, max_iterations = 8)
+    else:
+        raise ValueError(f"Unsupported pipeline: {pipeline_type}")
 
 
     return pipeline
@@ -144,7 +147,11 @@ def save_results(question_data, actor, critic, env_type, results, output_dir="re
 
     return output_file
 
-def save_evaluation_results(question_data, actor, critic, env_type, **kwargs):
+def evaluation_file(actor, critic, env_type, pipeline_type='mcts'):
+    """Evaluation results file of a pipeline, the prefix tells the pipelines apart when the stopping thresholds are learned"""
+    return f"results/{pipeline_type}_{actor.replace('/', '_')}_{critic.replace('/', '_')}_{env_type}_eval.jsonl"
+
+def save_evaluation_results(question_data, actor, critic, env_type, pipeline_type='mcts', **kwargs):
     """Save the results of processing a question"""
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -155,11 +162,12 @@ def save_evaluation_results(question_data, actor, critic, env_type, **kwargs):
         "actor_model": actor,
         "critic_model": critic,
         "environment": env_type,
+        "pipeline": pipeline_type,
         "timestamp": timestamp,
         **kwargs
     }
 
-    output_file = f"results/mcts_{actor.replace('/', '_')}_{critic.replace('/', '_')}_{env_type}_eval.jsonl"
+    output_file = evaluation_file(actor, critic, env_type, pipeline_type)
     with open(output_file, 'a') as f:
         f.write(json.dumps(result_data) + '\n')
 
@@ -171,9 +179,9 @@ import concurrent.futures
 import threading
 
 
-def solve_question(question_data, actor_model, critic_model, env_type):
+def solve_question(question_data, actor_model, critic_model, env_type, pipeline_type='mcts'):
     # Setup pipeline
-    pipeline = setup_pipeline(actor_model, critic_model, env_type, logger=None)
+    pipeline = setup_pipeline(actor_model, critic_model, env_type, logger=None, pipeline_type=pipeline_type)
 
     # Process the question
     image_path = question_data["image_path"]
@@ -206,7 +214,7 @@ def process_question(question_data, idx, total):
         result = solve_question(question_data, actor, critic, env_type)
         
         # Save results
-        output_file = save_evaluation_results(question_data, actor, critic, env_type, result)
+        output_file = save_evaluation_results(question_data, actor, critic, env_type, results=result)
         with print_lock:
             print(f"  - Results saved to: {output_file}")
         
@@ -218,7 +226,7 @@ def process_question(question_data, idx, total):
     
 
 
-def evaluate_question(question_data, actor_model, critic_model, env_type, idx, total):
+def evaluate_question(question_data, actor_model, critic_model, env_type, idx, total, pipeline_type='mcts'):
     try:
         print_lock = threading.Lock()
         with print_lock:
@@ -234,7 +242,7 @@ def evaluate_question(question_data, actor_model, critic_model, env_type, idx, t
         evaluator = setup_evaluation('gpt-4.1')
         
 
-        results = solve_question(question_data, actor_model, critic_model, env_type)
+        results = solve_question(question_data, actor_model, critic_model, env_type, pipeline_type)
 
         save_params = dict()
 
@@ -244,7 +252,8 @@ def evaluate_question(question_data, actor_model, critic_model, env_type, idx, t
             save_params['first_score'] = 0
 
         else:
-            last_image = results[-1].get('output_image', None)
+            best = getattr(results, 'best', None) or results[-1]
+            last_image = best.get('output_image', None)
 
             combined_image = merge_images([open_image(question_data["image_path"]), open_image(last_image)],
                                            titles=[f"Original Image", f"Generated Image"])
@@ -254,6 +263,13 @@ def evaluate_question(question_data, actor_model, critic_model, env_type, idx, t
 
             save_params['score'] = score
             save_params['number_iter'] = number_iter
+            save_params['stop_reason'] = getattr(results, 'stop_reason', None)
+            # Scores of the pipeline's own critic, the stopping thresholds are learned from them
+            save_params['critic_score'] = best.get('critic_result', best).get('score')
+            save_params['first_critic_score'] = results[0].get('critic_result', results[0]).get('score')
+            save_params['critic_scores'] = [result.get('critic_result', result).get('score') for result in results]
+            # Critic calls and renders skipped on duplicates during the run
+            save_params['dedupe'] = getattr(results, 'dedupe', None) or best.get('dedupe')
 
             # if len(results) == 1:
             #     # If only one iteration, use the first score
@@ -265,7 +281,7 @@ def evaluate_question(question_data, actor_model, critic_model, env_type, idx, t
 
 
         # Save results
-        output_file = save_evaluation_results(question_data, actor_model, critic_model, env_type, **save_params)
+        output_file = save_evaluation_results(question_data, actor_model, critic_model, env_type, pipeline_type, **save_params)
         with print_lock:
             print(f"  - Results saved to: {output_file}")
 
@@ -300,18 +316,18 @@ def main_threaded(max_workers=2):
     print("\nAll questions processed!")
 
 
-def eval_threaded(max_workers=2, dataset='chart_modification_eval.jsonl', actor_model='gpt-4.1-mini', critic_model='gpt-4.1-mini', env_type='html'):
+def eval_threaded(max_workers=2, dataset='chart_modification_eval.jsonl', actor_model='gpt-4.1-mini', critic_model='gpt-4.1-mini', env_type='html', pipeline_type='mcts'):
     """Multithreaded version of main function to process questions concurrently"""
     # Load all questions
     evaluation_path = os.path.join('test', dataset)
-    questions = load_questions(jsonl_file=evaluation_path, done_file=f"results/mcts_{actor_model}_{critic_model}_{env_type}_eval.jsonl")[::-1]
+    questions = load_questions(jsonl_file=evaluation_path, done_file=evaluation_file(actor_model, critic_model, env_type, pipeline_type))[::-1]
     print(f"Loaded {len(questions)} questions")
     print(f"Using {max_workers} threads")
     
     # Use ThreadPoolExecutor for concurrent execution
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Submit all tasks
-        futures = {executor.submit(evaluate_question,  q_data, actor_model, critic_model, env_type, i, len(questions)): i
+        futures = {executor.submit(evaluate_question,  q_data, actor_model, critic_model, env_type, i, len(questions), pipeline_type): i
                   for i, q_data in enumerate(questions)}
         
         # Process results as they complete
@@ -0,0 +1,197 @@
+import os
+import sys
+import copy
+import threading
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Optional, Dict, List, Tuple, NamedTuple
+
+import numpy as np
+
+from utils import hamming_distance, thumbnail_distance
+
+
+class RenderKey(NamedTuple):
+    """
+    What identifies a render in the RenderIndex: its perceptual hash, its color thumbnail and the hash of the code that drew it.
+    """
+    hash: int
+    thumbnail: np.ndarray
+    code: Optional[str] = None
+
+
+class RenderIndex(BaseModel):
+    """
+    Per-run index of rendered charts and the critique they received.
+
+    Used by the Module to skip the critics when a new render looks the same as one already critiqued.
+    The pipelines clear the renders of a run when it starts (Module.start_run), so a lookup only
+    scans the renders of the current run and the index does not grow over the life of the module.
+    Two renders are duplicates when their perceptual hashes are close and their color thumbnails
+    match cell by cell, so recolored series or a new legend are never taken for duplicates.
+    """
+    threshold: int = Field(default=2, description="Maximum Hamming distance between two hashes to consider the renders duplicates")
+    color_tolerance: int = Field(default=12, description="Maximum difference of a color channel between two thumbnail cells to consider the renders duplicates")
+    entries: Dict[str, List[tuple]] = Field(default_factory=dict, description="Render keys and critic results, grouped by run name")
+    stats: Dict[str, int] = Field(default_factory=lambda: {'lookups': 0, 'hits': 0, 'critic_calls_saved': 0}, description="Counters of the index usage over every run")
+    run_stats: Dict[str, Dict[str, int]] = Field(default_factory=dict, description="Counters of the index usage, per run name")
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _count(self, run_name: str, **counts) -> None:
+        # Called with the lock held
+        stats = self.run_stats.setdefault(run_name, {key: 0 for key in self.stats})
+        for key, value in counts.items():
+            self.stats[key] += value
+            stats[key] += value
+
+    def lookup(self, run_name: str, key: RenderKey) -> Optional[dict]:
+        """
+        Find the critique of a duplicate render in the same run.
+
+        The text critique only holds for the same code: when the code differs, the result is
+        flagged 'code_match' False and only its vision critique should be reused.
+
+        :param run_name: Name of the run.
+        :param key: Key of the new render.
+        :return: A copy of the cached critic result, or None if no duplicate was found.
+        """
+        with self._lock:
+            self._count(run_name, lookups=1)
+
+            best = None
+            for cached_key, critic_result in self.entries.get(run_name, []):
+                distance = hamming_distance(cached_key.hash, key.hash)
+                if distance > self.threshold or thumbnail_distance(cached_key.thumbnail, key.thumbnail) > self.color_tolerance:
+                    continue
+                code_match = key.code is not None and cached_key.code == key.code
+                # Prefer the same code, then the closest hash
+                if best is None or (not code_match, distance) < (not best[2], best[0]):
+                    best = (distance, critic_result, code_match)
+
+            if best is None:
+                return None
+
+            distance, critic_result, code_match = best
+            self._count(run_name, hits=1, critic_calls_saved=1 + int(code_match) if 'text_critic' in critic_result else 1)
+
+        critic_result = copy.deepcopy(critic_result)
+        critic_result['reused'] = True
+        critic_result['hamming_distance'] = distance
+        critic_result['code_match'] = code_match
+        return critic_result
+
+    def add(self, run_name: str, key: RenderKey, critic_result: dict) -> None:
+        """
+        Store the critique of a render.
+
+        :param run_name: Name of the run.
+        :param key: Key of the render.
+        :param critic_result: Critic result for the render.
+        """
+        with self._lock:
+            self.entries.setdefault(run_name, []).append((key, copy.deepcopy(critic_result)))
+
+    def clear(self, run_name: str = None) -> None:
+        """
+        Drop the cached renders and the counters of a run, or of every run if no run name is given.
+        The counters over every run are kept.
+        """
+        with self._lock:
+            if run_name is None:
+                self.entries.clear()
+                self.run_stats.clear()
+            else:
+                self.entries.pop(run_name, None)
+                self.run_stats.pop(run_name, None)
+
+    def stats_of(self, run_name: str) -> Dict[str, int]:
+        """
+        Counters of the index usage in a run.
+        """
+        with self._lock:
+            return dict(self.run_stats.get(run_name, {key: 0 for key in self.stats}))
+
+
+class CodeIndex(BaseModel):
+    """
+    Per-run index of the hashes of the normalized code already rendered, with their transition and critique.
+
+    Used by the Module to skip the render and the critics when the actor returns code it already wrote in the run.
+    """
+    entries: Dict[str, Dict[str, Tuple[dict, dict]]] = Field(default_factory=dict, description="Transitions and critic results, keyed by run name and code hash")
+    stats: Dict[str, int] = Field(default_factory=lambda: {'lookups': 0, 'hits': 0, 'renders_saved': 0, 'critic_calls_saved': 0, 'retries': 0, 'retries_changed': 0}, description="Counters of the index usage and of the avoided work over every run")
+    run_stats: Dict[str, Dict[str, int]] = Field(default_factory=dict, description="Counters of the index usage and of the avoided work, per run name")
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _count(self, run_name: str, **counts) -> None:
+        # Called with the lock held
+        stats = self.run_stats.setdefault(run_name, {key: 0 for key in self.stats})
+        for key, value in counts.items():
+            self.stats[key] += value
+            stats[key] += value
+
+    def lookup(self, run_name: str, key: str) -> Optional[Tuple[dict, dict]]:
+        """
+        Find the transition and critique of the same code in the same run.
+
+        :param run_name: Name of the run.
+        :param key: Hash of the normalized code.
+        :return: Copies of the transition and of the critic result, or None if the code is new.
+        """
+        with self._lock:
+            self._count(run_name, lookups=1)
+            entry = self.entries.get(run_name, {}).get(key)
+            if entry is None:
+                return None
+
+            transition, critic_result = entry
+            self._count(run_name, hits=1, renders_saved=1)
+            if not critic_result.get('canned') and not critic_result.get('reused'):
+                self._count(run_name, critic_calls_saved=critic_result.get('requests', 2))
+
+        critic_result = copy.deepcopy(critic_result)
+        critic_result['reused'] = True
+        critic_result['unchanged_code'] = True
+        return copy.deepcopy(transition), critic_result
+
+    def contains(self, run_name: str, key: str) -> bool:
+        with self._lock:
+            return key in self.entries.get(run_name, {})
+
+    def add(self, run_name: str, key: str, transition: dict, critic_result: dict) -> None:
+        """
+        Store the transition and critique of some code.
+
+        :param run_name: Name of the run.
+        :param key: Hash of the normalized code.
+        """
+        with self._lock:
+            self.entries.setdefault(run_name, {}).setdefault(key, (copy.deepcopy(transition), copy.deepcopy(critic_result)))
+
+    def count(self, run_name: str, **counts) -> None:
+        with self._lock:
+            self._count(run_name, **counts)
+
+    def clear(self, run_name: str = None) -> None:
+        """
+        Drop the indexed code of a run, or of every run if no run name is given, with the counters of the run.
+        The counters over every run are kept.
+        """
+        with self._lock:
+            if run_name is None:
+                self.entries.clear()
+                self.run_stats.clear()
+            else:
+                self.entries.pop(run_name, None)
+                self.run_stats.pop(run_name, None)
+
+    def stats_of(self, run_name: str) -> Dict[str, int]:
+        """
+        Counters of the index usage in a run.
+        """
+        with self._lock:
+            return dict(self.run_stats.get(run_name, {key: 0 for key in self.stats}))
@@ -1,4 +1,6 @@
 from pydantic import BaseModel, Field, ConfigDict
+from typing import ClassVar, Optional
+from PIL import Image
 
 import os
 import sys 
@@ -6,6 +8,11 @@ import random
 import string
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..', '..'))
+
+from llm.llm_utils import get_code_from_text_response
+from utils import autocrop_image
+from agent.tracing import TRACER
 
 
 def random_string(length=10):
@@ -25,6 +32,8 @@ class EnvConfig(BaseModel):
     name: str = Field(default='Environment', description="Purpose of the environment")
     module_name: str = 'env'
     cache_folder: str = Field(default=os.path.join(current_dir, '..', '..', 'temp', 'env'), description="Folder to cache environment files")
+    autocrop: bool = Field(default=True, description="Crop the background margins of every render")
+    autocrop_padding: int = Field(default=10, description="Margin kept around the chart when cropping, in pixels")
     
     def __init__(self, **data):
         super().__init__(**data)
@@ -41,6 +50,8 @@ class Env(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
     
     config: EnvConfig
+    # Whether several steps can run at the same time, e.g. renders in separate processes
+    parallel_steps: ClassVar[bool] = False
 
     def step(self, action: str, run_name: str = '', tag: str = '') -> str:
         """
@@ -51,4 +62,43 @@ class Env(BaseModel):
         """
         raise NotImplementedError("The step method must be implemented in subclasses.")
 
+    def executed_code(self, action: str) -> Optional[str]:
+        """
+        Code step executes for an action: the last fenced block of the response, whatever blocks come before it.
+
+        :param action: The action, a response of the actor.
+        :return: Code of the last block, None if the response has no block.
+        """
+        blocks = get_code_from_text_response(action or '')
+        return blocks[-1]['code'] if blocks else None
+
+    def postprocess_render(self, transition: dict) -> dict:
+        """
+        Crop the margins of the rendered image, once per render, so merging, encoding and display
+        all use the trimmed chart. The crop is written next to the render as <name>_crop.png and
+        the render itself is left untouched.
+
+        :param transition: Transition returned by step. When the render is cropped, transition['image_file_path'] points to the crop and transition['raw_image_file_path'] to the render; the crop ratio and padding are stored in transition['crop_ratio'] and transition['crop_padding'].
+        :return: The transition.
+        """
+        image_file_path = transition.get('image_file_path', None)
+        if not self.config.autocrop or not image_file_path or not os.path.exists(image_file_path):
+            return transition
+
+        with TRACER.span('autocrop', transition.get('run_name'), 'env'):
+            with Image.open(image_file_path) as image:
+                image.load()
+                cropped, crop_ratio = autocrop_image(image, padding=self.config.autocrop_padding)
+
+            if crop_ratio < 1.0:
+                root, extension = os.path.splitext(image_file_path)
+                crop_file_path = f"{root}_crop{extension}"
+                cropped.save(crop_file_path)
+                transition['raw_image_file_path'] = image_file_path
+                transition['image_file_path'] = crop_file_path
+
+        transition['crop_ratio'] = crop_ratio
+        transition['crop_padding'] = self.config.autocrop_padding
+        return transition
+
 
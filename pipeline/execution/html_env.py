@@ -18,6 +18,7 @@ sys.path.append(os.path.join(current_dir, '..', '..'))
 
 from llm.llm_utils import get_code_from_text_response
 from pipeline.execution.env import EnvConfig, Env, random_string
+from agent.tracing import TRACER, traced
 
 class HtmlEnvConfig(EnvConfig):
     """
@@ -100,6 +101,7 @@ class HtmlEnv(Env):
                 pass
             return False
     
+    @traced('env.step', 'env')
     def step(self, action: str, run_name: str = '', tag: str = '') -> Dict[str, Any]:
         """
         Perform an action in the HTML environment.
@@ -145,17 +147,18 @@ class HtmlEnv(Env):
             f.write(code)
         
         # Render with Selenium
-        success = self.render_with_selenium(html_file_path, image_file_path)
+        with TRACER.span('selenium', run_name, 'env', wait=self.config.render_wait_time):
+            success = self.render_with_selenium(html_file_path, image_file_path)
             
         if not success:
             raise Exception("Failed to render HTML to image using Selenium")
         
-        return {
+        return self.postprocess_render({
             'code': code,
             'code_file_path': html_file_path,
             'image_file_path': image_file_path,
             'run_name': run_name,
-        }
+        })
     
     def __del__(self):
         """Clean up resources when the object is destroyed"""
@@ -1,4 +1,5 @@
 from pydantic import BaseModel, Field
+from typing import ClassVar
 
 import os
 import sys 
@@ -8,6 +9,7 @@ sys.path.append(os.path.join(current_dir, '..', '..'))
 
 from llm.llm_utils import get_code_from_text_response
 from pipeline.execution.env import EnvConfig, Env, random_string
+from agent.tracing import traced
 
 
 # From @github.com/metal-chart-generation/metal/blob/main/src/agents/utils.py#L62
@@ -75,7 +77,10 @@ class PythonEnv(Env):
     Represents a Python environment that can execute actions based on the provided configuration.
     """
     config: PythonEnvConfig
+    # Every step runs in its own process and writes its own files
+    parallel_steps: ClassVar[bool] = True
 
+    @traced('env.step', 'env')
     def step(self, action: str, run_name: str = '', tag: str = '') -> str:
         """
         Perform an action in the Python environment.
@@ -101,14 +106,22 @@ class PythonEnv(Env):
         code = html_code['code']
 
         extract_validate_run_code(code, python_file_path, image_file_path)
-        
-        return {
+
+        transition = {
             'code': code,
             'code_file_path': python_file_path,
             'image_file_path': image_file_path,
             'run_name': run_name,
         }
 
+        # The wrapped code writes the exception next to the image when it fails
+        error_file_path = f"{image_file_path}_error.txt"
+        if os.path.exists(error_file_path):
+            with open(error_file_path, 'r') as f:
+                transition['error'] = f.read()
+
+        return self.postprocess_render(transition)
+
 
     def __str__(self):
         """
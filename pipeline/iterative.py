@@ -6,6 +6,9 @@ from uuid import uuid4
 
 from pipeline.execution import Env
 from pipeline.module import Module
+from pipeline.stopping import StoppingPolicy, RunResults, usage_delta
+from agent.base import RUN_USAGE
+from agent.tracing import trace_run
 
 from typing import Optional, List, Dict, Any, Union, Generator
 from pydantic import BaseModel, Field
@@ -21,7 +24,10 @@ class IterativePipeline(BaseModel):
     tag: str = Field(default='', description="Tag for the run")
     max_iterations: int = Field(default=5, description="Maximum number of iterations to run the pipeline")
     debug: bool = Field(default=False, description="Enable debug mode for the pipeline")
-    run_name: str = Field(default=str(uuid4()), description="Name of the run")
+    run_name: str = Field(default_factory=lambda: str(uuid4()), description="Name of the run, the token budgets count the calls made under it")
+    stopping: StoppingPolicy = Field(default_factory=StoppingPolicy, description="When to stop before max_iterations: target score, plateau or budgets")
+    trace: bool = Field(default=False, description="Trace the stages of every run and write them to trace_dir/<run_name>/trace.json in the Chrome trace-event format")
+    trace_dir: str = Field(default=os.path.join(current_dir, '..', 'temp', 'traces'), description="Folder of the trace files")
 
 
     def __init__(self, **data):
@@ -42,41 +48,63 @@ class IterativePipeline(BaseModel):
         """
         return "\n".join([f"### {key}: \n{value}\n\n" for key, value in critique_list.items()])
     
-    def act(self, request: str, image: Union[str, Image.Image] = None) -> Dict[str, Any]:
+    def start_stopping(self, target_score: Optional[float] = None):
+        """
+        Start tracking a run against the stopping policy, with the thresholds of the module models.
+        """
+        return self.stopping.start(self.module.actor.config.model_name,
+                                   self.module.critic.config.model_name,
+                                   environment=self.module.config.actor_config.code,
+                                   pipeline='iterative',
+                                   target_score=target_score)
+
+    def act(self, request: str, image: Union[str, Image.Image] = None, target_score: Optional[float] = None) -> RunResults:
         """
         Run the pipeline with the given inputs.
+
+        :param target_score: Score to stop at for this request, the stopping policy target when None.
+        :return: Results of every iteration, with the best one in .best and the reason the run stopped in .stop_reason.
         """
+        with trace_run(self.run_name, os.path.join(self.trace_dir, self.run_name, 'trace.json'), self.trace):
+            prev_state_critique = None
+            prev_state_code = None
         
-        prev_state_critique = None
-        prev_state_code = None
-        
-        results = []
+            results = RunResults(stop_reason='max_iterations')
+            state = self.start_stopping(target_score)
+            self.module.start_run(self.run_name)
         
-        for i in range(self.max_iterations):
-            result = self.module.act(
-                env=self.env,
-                request=request,
-                image=image,
-                prev_state_code=prev_state_code,
-                prev_state_critique=prev_state_critique,
-                run_name=self.run_name,
-                tag=f"{self.tag}_iteration_{i + 1}"
-            )
+            for i in range(self.max_iterations):
+                usage = RUN_USAGE.get(self.run_name)
+                result = self.module.act(
+                    env=self.env,
+                    request=request,
+                    image=image,
+                    prev_state_code=prev_state_code,
+                    prev_state_critique=prev_state_critique,
+                    run_name=self.run_name,
+                    tag=f"{self.tag}_iteration_{i + 1}"
+                )
 
-            if self.debug:
-                print(f"Iteration {i + 1}: {result}")
+                if self.debug:
+                    print(f"Iteration {i + 1}: {result}")
 
-            results.append(result)
+                results.append(result)
 
-            prev_state_code = result['actor_result']['action']
-            prev_state_critique = self.concatenate_critiques({
-                'Vision critique': result['critic_result']['vision_critic']['critique'],
-                'Text critique': result['critic_result']['text_critic']['critique']
-            })
-            
-            if result['critic_result']['score'] >= 4:
-                break
-            
+                prev_state_code = result['actor_result']['action']
+                prev_state_critique = self.concatenate_critiques({
+                    'Vision critique': result['critic_result']['vision_critic']['critique'],
+                    'Text critique': result['critic_result']['text_critic']['critique']
+                })
+
+                stop_reason = state.update(result, usage_delta(usage, RUN_USAGE.get(self.run_name)))
+                results.best_index = state.best_index
+                if stop_reason is not None:
+                    results.stop_reason = stop_reason
+                    break
+
+            results.dedupe = self.module.dedupe_stats(self.run_name)
+            if self.debug:
+                print(f"Stopped after {len(results)} iterations ({results.stop_reason}), best score {state.best_score} at iteration {(state.best_index or 0) + 1}")
         
         return results
     
@@ -85,120 +113,138 @@ class IterativePipeline(BaseModel):
         """
         Run the pipeline with the given inputs in a streaming manner.
         """
+        with trace_run(self.run_name, os.path.join(self.trace_dir, self.run_name, 'trace.json'), self.trace):
+            prev_state_critique = None
+            prev_state_code = None
         
-        prev_state_critique = None
-        prev_state_code = None
+            results = RunResults(stop_reason='max_iterations')
+            state = self.start_stopping()
+            self.module.start_run(self.run_name)
         
-        results = []
-        
-        current_iteration = 0
-        while current_iteration <= self.max_iterations:
-            current_iteration += 1
-            if self.debug:
-                print(f"Starting iteration {current_iteration}")
+            current_iteration = 0
+            while current_iteration <= self.max_iterations:
+                current_iteration += 1
+                usage = RUN_USAGE.get(self.run_name)
+                if self.debug:
+                    print(f"Starting iteration {current_iteration}")
             
-            result = None
-            error_occurred = False
+                result = None
+                error_occurred = False
             
-            for chunk in self.module.stream_act(
-                env=self.env,
-                request=request,
-                image=image,
-                prev_state_code=prev_state_code,
-                prev_state_critique=prev_state_critique,
-                run_name=self.run_name,
-                tag=f"stream_{self.tag}_iteration_{current_iteration}"
-            ):
-                # Handle error cases
-                if chunk.get('status') == 'error':
-                    error_occurred = True
+                for chunk in self.module.stream_act(
+                    env=self.env,
+                    request=request,
+                    image=image,
+                    prev_state_code=prev_state_code,
+                    prev_state_critique=prev_state_critique,
+                    run_name=self.run_name,
+                    tag=f"stream_{self.tag}_iteration_{current_iteration}"
+                ):
+                    # Handle error cases
+                    if chunk.get('status') == 'error':
+                        error_occurred = True
                     
-                    # Yield intermediate status updates
-                yield {
-                    'iteration': current_iteration,
-                    **chunk,
-                }
+                        # Yield intermediate status updates
+                    yield {
+                        'iteration': current_iteration,
+                        **chunk,
+                    }
 
-                if chunk.get('status') == 'completed':
-                    result = chunk
+                    if chunk.get('status') == 'completed':
+                        result = chunk
+                        break
+
+                if self.debug:
+                    print(f"Iteration {current_iteration}: {result}")
+
+                # Break if error occurred or no result
+                if error_occurred or result is None:
+                    if self.debug:
+                        if error_occurred:
+                            print(f"Error occurred in iteration {current_iteration}, stopping pipeline")
+                        else:
+                            print(f"No result from iteration {current_iteration}, breaking")
                     break
 
-            if self.debug:
-                print(f"Iteration {current_iteration}: {result}")
+                results.append(result)
 
-            # Break if error occurred or no result
-            if error_occurred or result is None:
-                if self.debug:
-                    if error_occurred:
-                        print(f"Error occurred in iteration {current_iteration}, stopping pipeline")
-                    else:
-                        print(f"No result from iteration {current_iteration}, breaking")
-                break
-
-
-            prev_state_code = result['actor_result']['action']
-            prev_state_critique = self.concatenate_critiques({
-                'Vision critique': result['critic_result']['vision_critic']['critique'],
-                'Text critique': result['critic_result']['text_critic']['critique']
-            })
+                prev_state_code = result['actor_result']['action']
+                prev_state_critique = self.concatenate_critiques({
+                    'Vision critique': result['critic_result']['vision_critic']['critique'],
+                    'Text critique': result['critic_result']['text_critic']['critique']
+                })
             
 
-            yield {
-                'status': 'score',
-                'type': 'score',
-                'iteration': current_iteration,
-                'score': result['critic_result']['score'],
-            }
+                yield {
+                    'status': 'score',
+                    'type': 'score',
+                    'iteration': current_iteration,
+                    'score': result['critic_result']['score'],
+                }
 
-            # Check if we've reached a good enough score
-            if result['critic_result']['score'] >= 4:
-                if self.debug:
-                    print(f"Score threshold reached: {result['critic_result']['score']}")
-                break
+                # Check if we've reached a good enough score, a plateau or a budget
+                stop_reason = state.update(result, usage_delta(usage, RUN_USAGE.get(self.run_name)))
+                results.best_index = state.best_index
+                if stop_reason is not None:
+                    results.stop_reason = stop_reason
+                    if self.debug:
+                        print(f"Stopping ({stop_reason}) at score {result['critic_result']['score']}")
+                    break
             
 
 
-        yield {
-            'status': 'finished',
-            'total_iterations': len(results),
-            'results': results,
-            'iteration': current_iteration,
-        }
+            results.dedupe = self.module.dedupe_stats(self.run_name)
+            yield {
+                'status': 'finished',
+                'total_iterations': len(results),
+                'results': results,
+                'best_index': results.best_index,
+                'stop_reason': results.stop_reason,
+                'dedupe': results.dedupe,
+                'iteration': current_iteration,
+            }
     
     
-    def act_with_prev_state(self, request: str, image: Union[str, Image.Image] = None, prev_state_code: str = None, prev_state_critique: str = None) -> Dict[str, Any]:
+    def act_with_prev_state(self, request: str, image: Union[str, Image.Image] = None, prev_state_code: str = None, prev_state_critique: str = None) -> RunResults:
         """
         Run the pipeline with the given inputs and previous state.
         """
-        prev_state_critique = None
-        prev_state_code = None
+        with trace_run(self.run_name, os.path.join(self.trace_dir, self.run_name, 'trace.json'), self.trace):
+            prev_state_critique = None
+            prev_state_code = None
         
-        results = []
+            results = RunResults(stop_reason='max_iterations')
+            state = self.start_stopping()
+            self.module.start_run(self.run_name)
         
-        for i in range(self.max_iterations):
-            result = self.module.act(
-                env=self.env,
-                request=request,
-                image=image,
-                prev_state_code=prev_state_code,
-                prev_state_critique=prev_state_critique,
-                run_name=self.run_name,
-                tag=f"{self.tag}_iteration_{i + 1}"
-            )
+            for i in range(self.max_iterations):
+                usage = RUN_USAGE.get(self.run_name)
+                result = self.module.act(
+                    env=self.env,
+                    request=request,
+                    image=image,
+                    prev_state_code=prev_state_code,
+                    prev_state_critique=prev_state_critique,
+                    run_name=self.run_name,
+                    tag=f"{self.tag}_iteration_{i + 1}"
+                )
 
-            if self.debug:
-                print(f"Iteration {i + 1}: {result}")
+                if self.debug:
+                    print(f"Iteration {i + 1}: {result}")
 
-            results.append(result)
+                results.append(result)
 
-            prev_state_code = result['actor_result']['action']
-            prev_state_critique = self.concatenate_critiques({
-                'Vision critique': result['critic_result']['vision_critic']['critique'],
-                'Text critique': result['critic_result']['text_critic']['critique']
-            })
+                prev_state_code = result['actor_result']['action']
+                prev_state_critique = self.concatenate_critiques({
+                    'Vision critique': result['critic_result']['vision_critic']['critique'],
+                    'Text critique': result['critic_result']['text_critic']['critique']
+                })
             
-            if result['critic_result']['score'] >= 4:
-                break
+                stop_reason = state.update(result, usage_delta(usage, RUN_USAGE.get(self.run_name)))
+                results.best_index = state.best_index
+                if stop_reason is not None:
+                    results.stop_reason = stop_reason
+                    break
             
-        
-        return results
\ No newline at end of file
+            results.dedupe = self.module.dedupe_stats(self.run_name)
+            return results
@@ -6,6 +6,7 @@ from uuid import uuid4
 
 from pipeline.execution import Env
 from pipeline.module import Module
+from agent.tracing import trace_run
 from PIL import Image
 
 from typing import Optional, List, Dict, Any, Union, Generator, Tuple
@@ -67,7 +68,10 @@ class MCTSPipeline(BaseModel):
     tag: str = Field(default='', description="Tag for the run")
     max_iterations: int = Field(default=5, description="Maximum number of iterations to run the pipeline")
     debug: bool = Field(default=False, description="Enable debug mode for the pipeline")
-    run_name: str = Field(default=str(uuid4()), description="Name of the run")
+    run_name: str = Field(default_factory=lambda: str(uuid4()), description="Name of the run")
+    num_candidates: int = Field(default=1, description="Candidates generated per expansion, scored together by the ranking critic when above 1")
+    trace: bool = Field(default=False, description="Trace the stages of every run and write them to trace_dir/<run_name>/trace.json in the Chrome trace-event format")
+    trace_dir: str = Field(default=os.path.join(current_dir, '..', 'temp', 'traces'), description="Folder of the trace files")
 
     def __init__(self, **data):
         """
@@ -158,102 +162,126 @@ class MCTSPipeline(BaseModel):
         
 
     def act(self, request: str, image: Union[str, Image.Image] = None) -> Dict[str, Any]:
+        with trace_run(self.run_name, os.path.join(self.trace_dir, self.run_name, 'trace.json'), self.trace):
+            prev_state_critique = None
+            prev_state_code = None
+            self.module.start_run(self.run_name)
 
-
-        prev_state_critique = None
-        prev_state_code = None
-
-        initial_result = self.module.act(
-            env=self.env,
-            request=request,
-            image=image,
-            prev_state_code=prev_state_code,
-            prev_state_critique=prev_state_critique,
-            run_name=self.run_name,
-            tag=f"{self.tag}_iteration_1"
-        )
-
-        critique = self.concatenate_critiques({
-            'Vision critique': initial_result['critic_result']['vision_critic']['critique'],
-            'Text critique': initial_result['critic_result']['text_critic']['critique']
-        })
-        code = initial_result['actor_result']['action']
-        score = initial_result['critic_result']['score']
-        output_image = initial_result['output_image']
-
-        initial_node = ReasoningNode(
-            code=code,
-            critique=critique,
-            rank=0,
-            Q=score,
-            N=1,
-            image=output_image
-        )
-
-        number_of_4 = score >= 4
-
-        for _ in range(self.max_iterations):
-
-            # Select node based on UCB
-            selected_node = self.select_node(initial_node, search_policy=SEARCH_POLICY)
-
-
-            if self.debug:
-                logging.info(f"Selected Node: {selected_node.id}, Q: {selected_node.Q}, N: {selected_node.N}")
-
-            # Act on the selected node
-            result = self.module.act(
+            initial_result = self.module.act(
                 env=self.env,
                 request=request,
                 image=image,
-                prev_state_code=selected_node.code,
-                prev_state_critique=selected_node.critique,
+                prev_state_code=prev_state_code,
+                prev_state_critique=prev_state_critique,
                 run_name=self.run_name,
-                tag=f"{self.tag}_iteration_{selected_node.rank + 1}"
+                tag=f"{self.tag}_iteration_1"
             )
 
             critique = self.concatenate_critiques({
-                'Vision critique': result['critic_result']['vision_critic']['critique'],
-                'Text critique': result['critic_result']['text_critic']['critique']
+                'Vision critique': initial_result['critic_result']['vision_critic']['critique'],
+                'Text critique': initial_result['critic_result']['text_critic']['critique']
             })
-            code = result['actor_result']['action']
-            score = result['critic_result']['score']
-
-            if score == 0:
-                if self.debug:
-                    logging.info(f"Score is 0, skipping node: {selected_node.id}")
-                break
-            output_image = result['output_image']
+            code = initial_result['actor_result']['action']
+            score = initial_result['critic_result']['score']
+            output_image = initial_result['output_image']
 
-            # Create a new node
-            new_node = ReasoningNode(
+            initial_node = ReasoningNode(
                 code=code,
                 critique=critique,
-                rank=selected_node.rank + 1,
+                rank=0,
                 Q=score,
                 N=1,
                 image=output_image
             )
 
-            # Add the new node to the selected node
-            selected_node.add_child(new_node)
+            # Expansions that reached a 4, the search stops at the third one
+            number_of_4 = int(score >= 4)
+
+            for _ in range(self.max_iterations):
+
+                # Select node based on UCB
+                selected_node = self.select_node(initial_node, search_policy=SEARCH_POLICY)
+
 
-            # Update the Q value of the selected node
-            selected_node.add_reward(score)
-            
-            # Backward update the Q value of the parent nodes
-            self.backward_Q_value(selected_node)
-
-            if self.debug:
-                logging.info(f"New Node: {new_node.id}, Q: {new_node.Q}, N: {new_node.N}")
-                logging.info(f"Selected Node after update: {selected_node.id}, Q: {selected_node.Q}, N: {selected_node.N}")
-            if score >= 4:
-                number_of_4 += 1
                 if self.debug:
-                    logging.info(f"Score >= 4: {score}, Number of 4s: {number_of_4}")
-                if number_of_4 >= 3:
+                    logging.info(f"Selected Node: {selected_node.id}, Q: {selected_node.Q}, N: {selected_node.N}")
+
+                # Act on the selected node
+                if self.num_candidates > 1:
+                    results = self.module.propose(
+                        env=self.env,
+                        request=request,
+                        image=image,
+                        prev_state_code=selected_node.code,
+                        prev_state_critique=selected_node.critique,
+                        num_candidates=self.num_candidates,
+                        run_name=self.run_name,
+                        tag=f"{self.tag}_iteration_{selected_node.rank + 1}"
+                    )
+                else:
+                    results = [self.module.act(
+                        env=self.env,
+                        request=request,
+                        image=image,
+                        prev_state_code=selected_node.code,
+                        prev_state_critique=selected_node.critique,
+                        run_name=self.run_name,
+                        tag=f"{self.tag}_iteration_{selected_node.rank + 1}"
+                    )]
+
+                scores = [result['critic_result']['score'] for result in results]
+                # A 0 from an unparsable critique says nothing about the render, it must not end the search
+                parsed_scores = [score for result, score in zip(results, scores) if not result['critic_result'].get('parse_error')]
+                if not parsed_scores:
+                    if self.debug:
+                        logging.info(f"Could not parse the critiques, skipping node: {selected_node.id}")
+                    continue
+                if max(parsed_scores) == 0:
+                    if self.debug:
+                        logging.info(f"Score is 0, skipping node: {selected_node.id}")
                     break
 
+                for result, score in zip(results, scores):
+                    if score == 0:
+                        continue
+
+                    critique = self.concatenate_critiques({
+                        'Vision critique': result['critic_result']['vision_critic']['critique'],
+                        'Text critique': result['critic_result']['text_critic']['critique']
+                    })
+
+                    # Create a new node
+                    new_node = ReasoningNode(
+                        code=result['actor_result']['action'],
+                        critique=critique,
+                        rank=selected_node.rank + 1,
+                        Q=score,
+                        N=1,
+                        image=result['output_image']
+                    )
+
+                    # Add the new node to the selected node
+                    selected_node.add_child(new_node)
+
+                    # Update the Q value of the selected node
+                    selected_node.add_reward(score)
+
+                    if self.debug:
+                        logging.info(f"New Node: {new_node.id}, Q: {new_node.Q}, N: {new_node.N}")
+
+                # Backward update the Q value of the parent nodes
+                self.backward_Q_value(selected_node)
+
+                if self.debug:
+                    logging.info(f"Selected Node after update: {selected_node.id}, Q: {selected_node.Q}, N: {selected_node.N}")
+                # One per expansion whatever the number of candidates, so num_candidates does not shorten the search
+                if max(parsed_scores) >= 4:
+                    number_of_4 += 1
+                    if self.debug:
+                        logging.info(f"Score >= 4: {max(parsed_scores)}, Number of 4s: {number_of_4}")
+                    if number_of_4 >= 3:
+                        break
+
         # return the final result
         best_node = None
         best_q = -float('inf')
@@ -272,5 +300,6 @@ class MCTSPipeline(BaseModel):
                 'output_image': best_node.image,
                 'code': best_node.code,
                 'score': best_node.Q,
+                'dedupe': self.module.dedupe_stats(self.run_name),
             }
         ]
@@ -1,9 +1,14 @@
 import os 
 import sys
+import time
+import queue
+import threading
+import logging
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(current_dir, '..'))
 from pydantic import Field, BaseModel
-from typing import Optional, Union, Generator
+from typing import Callable, Optional, Union, Generator, List
+from concurrent.futures import ThreadPoolExecutor, CancelledError
 from PIL import Image
 
 from agent import (
@@ -16,11 +21,15 @@ from agent import (
     TextCriticConfig,
     TextCritic,
     VisionCriticConfig,
-    VisionCritic
+    VisionCritic,
+    clear_parse_stats
 )
 
 from pipeline.execution import Env, PythonEnv, PythonEnvConfig
-from utils import merge_images
+from pipeline.dedupe import RenderIndex, RenderKey, CodeIndex
+from pipeline.stages import StageGraph
+from agent.tracing import traced
+from utils import autocrop_image, merge_images, merge_layout, image_hash, color_thumbnail, inspect_render, image_similarity, extract_code, parse_edits, apply_edits, code_diff, code_hash
 
 class ModuleConfig(BaseModel):
     """
@@ -31,6 +40,20 @@ class ModuleConfig(BaseModel):
     actor_config: ActorConfig = Field(default_factory=ActorConfig, description="Configuration for the actor module")
     critic_config: CriticConfig = Field(default_factory=CriticConfig, description="Configuration for the critic module")
     image_path: Optional[bool] = Field(default=False, description="Whether to force use image_path to communicate with the agent, default is False")
+    dedupe_renders: bool = Field(default=False, description="Reuse the critique of a duplicate render in the same run instead of calling the critics again, the text critique only for the same code")
+    dedupe_threshold: int = Field(default=2, description="Maximum Hamming distance between perceptual hashes for two renders to be duplicates")
+    dedupe_color_tolerance: int = Field(default=12, description="Maximum difference of a color channel between the 32x32 thumbnails of two renders for them to be duplicates")
+    detect_blank_renders: bool = Field(default=True, description="Score blank or broken renders 0 without calling the critics")
+    blank_min_content_ratio: float = Field(default=0.002, description="Minimum fraction of non-background pixels for a render not to be blank")
+    compute_similarity: bool = Field(default=True, description="Compute a pixel-level similarity between the input image and the render")
+    min_similarity: Optional[float] = Field(default=None, description="Renders less similar than this to the input image are scored 0 without calling the critics")
+    unchanged_similarity: Optional[float] = Field(default=None, description="Renders at least this similar to the input image are treated as unchanged and scored 1 without calling the critics")
+    num_samples: int = Field(default=1, description="Actions drawn per step; the renders are screened with the cheap checks and only the best go to the critics")
+    dedupe_code: bool = Field(default=True, description="Reuse the render and critique of code the actor already returned in the same run, compared after normalization")
+    unchanged_retry_temperature: Optional[float] = Field(default=None, description="Re-prompt the actor once at this temperature when it returns code already rendered in the run, None to reuse the previous result directly")
+    overlap_stages: bool = Field(default=True, description="Start the text critic as soon as the actor returns, while the render runs and the critic image is merged")
+    stage_workers: int = Field(default=32, description="Threads of the process-wide stage executor shared by every module, a step uses up to 3; set by the first module run")
+    critique_top_k: int = Field(default=1, description="Screened samples sent to the critics per step, scored together by the ranking critic when above 1")
 
 class Module(BaseModel):
     """
@@ -40,10 +63,14 @@ class Module(BaseModel):
     actor: Optional[Actor] = None
     critic: Optional[Critic] = None
     debug: bool = Field(default=False, description="Enable debug mode for the module")
+    render_index: RenderIndex = Field(default_factory=RenderIndex, description="Index of the critiqued renders, by perceptual hash, color thumbnail and code")
+    code_index: CodeIndex = Field(default_factory=CodeIndex, description="Index of the normalized code already rendered, with its transition and critique")
     
 
     def __init__(self, config: ModuleConfig):
         super().__init__(config=config)
+        self.render_index.threshold = self.config.dedupe_threshold
+        self.render_index.color_tolerance = self.config.dedupe_color_tolerance
 
         # Force use of image_path if specified in the configuration
         if self.config.image_path:
@@ -53,6 +80,367 @@ class Module(BaseModel):
         self.actor = Actor(config=config.actor_config)
         self.critic = Critic(config=config.critic_config)
 
+    @staticmethod
+    def canned_critique(critique: str, score: int = 0) -> dict:
+        """
+        Build a critic result with a fixed critique and score, for renders not worth a critic call.
+        """
+        return {
+            'vision_critic': {'critique': critique, 'score': score},
+            'text_critic': {'critique': critique, 'score': score},
+            'score': score,
+            'canned': True
+        }
+
+    def screen_render(self, transition: dict, image: Union[str, Image.Image] = None) -> Optional[dict]:
+        """
+        Run the cheap checks on a render before it reaches the critics.
+
+        The similarity to the input image is stored in transition['similarity'].
+
+        :param transition: Transition returned by the environment.
+        :param image: Input image of the request.
+        :return: A canned critic result if the render is broken, blank, hopeless or unchanged, None otherwise.
+        """
+        image_file_path = transition.get('image_file_path', None)
+        rendered = bool(image_file_path) and os.path.exists(image_file_path)
+
+        critique = None
+        if self.config.detect_blank_renders:
+            if transition.get('error'):
+                critique = f"The code failed to run and no chart was rendered. Error: {transition['error'].strip()}"
+            elif not rendered:
+                critique = "The code did not produce any image."
+            else:
+                inspection = inspect_render(image_file_path, min_content_ratio=self.config.blank_min_content_ratio)
+                if inspection['blank']:
+                    critique = f"The rendered chart is blank ({inspection['reason']}), the code does not draw the requested chart."
+
+        if critique is None and rendered and image is not None and self.config.compute_similarity:
+            if 'crop_ratio' in transition:
+                # The environment cropped the render, compare it with the input cropped the same way
+                image = autocrop_image(image, padding=transition.get('crop_padding', 10))[0]
+            similarity = image_similarity(image, image_file_path)
+            transition['similarity'] = similarity
+
+            if self.config.unchanged_similarity is not None and similarity['score'] >= self.config.unchanged_similarity:
+                critique = "The rendered chart is the same as the input chart, the requested modification was not applied."
+                if self.debug:
+                    print(f"Skipping critics: {critique}")
+                return self.canned_critique(critique, score=1)
+
+            if self.config.min_similarity is not None and similarity['score'] < self.config.min_similarity:
+                critique = "The rendered chart has almost nothing in common with the input chart."
+
+        if critique is None:
+            return None
+
+        if self.debug:
+            print(f"Skipping critics: {critique}")
+
+        return self.canned_critique(critique)
+
+    @traced('module.screen', 'module')
+    def lookup_render(self, transition: dict, run_name: str = '', image: Union[str, Image.Image] = None, partial: bool = False) -> tuple:
+        """
+        Check the render before calling the critics.
+
+        Broken, blank, hopeless or unchanged renders get a canned critique, duplicates of a
+        render already critiqued in the same run reuse that critique.
+
+        A duplicate drawn by different code only keeps its vision critique. With partial set,
+        and when the text critic can run alone, it is returned with 'text_pending' so that the
+        caller runs the text critic and calls complete_reused. Otherwise it is not reused.
+
+        :param transition: Transition returned by the environment.
+        :param run_name: Name of the run.
+        :param image: Input image of the request.
+        :param partial: Whether the caller can complete a reused vision critique with a new text critique.
+        :return: Tuple of the render key and the critic result to use (None if the critics must be called).
+        """
+        critic_result = self.screen_render(transition, image)
+        if critic_result is not None:
+            return None, critic_result
+
+        image_file_path = transition.get('image_file_path', None)
+        if not self.config.dedupe_renders or not image_file_path or not os.path.exists(image_file_path):
+            return None, None
+
+        with Image.open(image_file_path) as render:
+            render.load()
+            code = transition.get('code', None)
+            render_key = RenderKey(hash=image_hash(render),
+                                   thumbnail=color_thumbnail(render),
+                                   code=code_hash(code, self.config.actor_config.code) if code else None)
+        critic_result = self.render_index.lookup(run_name, render_key)
+
+        if critic_result is not None and not critic_result['code_match']:
+            if not partial or not self.critic.can_overlap():
+                return render_key, None
+            critic_result['text_critic'] = None
+            critic_result['text_pending'] = True
+
+        if critic_result is not None and self.debug:
+            print(f"Reusing critique of a duplicate render (distance {critic_result['hamming_distance']}, same code: {critic_result['code_match']}), stats: {self.render_index.stats}")
+
+        return render_key, critic_result
+
+    def complete_reused(self, critic_result: dict, text_critique: dict, render_key: Optional[RenderKey] = None, run_name: str = '') -> dict:
+        """
+        Complete a reused vision critique flagged 'text_pending' with the text critique of the new code.
+
+        :param critic_result: Critic result returned by lookup_render.
+        :param text_critique: Result of Critic.text_act for the code of the render.
+        :return: The critic result, scored.
+        """
+        text_critique = dict(text_critique)
+        critic_result.pop('text_pending', None)
+        critic_result['text_critic'] = text_critique
+        critic_result.setdefault('timing', {})['text_critic'] = text_critique.pop('timing', None)
+        critic_result['requests'] = 1
+        critic_result['score'] = min(text_critique['score'], critic_result['vision_critic']['score'])
+        critic_result['parse_error'] = any(critic_result[key].get('parse_error', False) for key in ('text_critic', 'vision_critic'))
+        self.remember_render(render_key, critic_result, run_name)
+        return critic_result
+
+    def remember_render(self, render_key: Optional[RenderKey], critic_result: dict, run_name: str = '') -> None:
+        """
+        Store the critique of a render so that duplicates can reuse it.
+        """
+        if render_key is not None:
+            self.render_index.add(run_name, render_key, critic_result)
+
+    def usage(self) -> dict:
+        """
+        Tokens reported by the providers for every agent of the module so far, summed per model.
+        """
+        agents = [self.actor, self.critic]
+        agents += [getattr(self.critic, name, None) for name in ('vision_critic', 'text_critic', 'ranking_critic', 'combined_critic', 'downgraded_vision_critic')]
+
+        usage = {}
+        for agent in agents:
+            if agent is None:
+                continue
+            model_usage = usage.setdefault(agent.config.model_name, {'input_tokens': 0, 'output_tokens': 0})
+            model_usage['input_tokens'] += agent.usage_stats['input_tokens']
+            model_usage['output_tokens'] += agent.usage_stats['output_tokens']
+        return usage
+
+    def start_run(self, run_name: str) -> None:
+        """
+        Forget the renders and the code indexed under a run name, called by the pipelines when a run
+        starts, so that a run never reuses the critiques of an earlier run and the indexes do not grow
+        for the life of the module. The parse outcomes of the critics counted under the run are reset too.
+        """
+        self.render_index.clear(run_name)
+        self.code_index.clear(run_name)
+        clear_parse_stats(run_name)
+
+    def dedupe_stats(self, run_name: str = None) -> dict:
+        """
+        Counters of the work avoided by the render and code indexes, in a run or over every run.
+        """
+        return {
+            'renders': self.render_index.stats_of(run_name) if run_name is not None else dict(self.render_index.stats),
+            'code': self.code_index.stats_of(run_name) if run_name is not None else dict(self.code_index.stats)
+        }
+
+    def resolve_action(self, actor_result: dict, prev_state_code: str = None, request: str = '') -> tuple:
+        """
+        Turn the search/replace edits of the actor into the full code for the environment.
+
+        The actor result is updated in place: 'action' becomes the full code in a code block, so that
+        it can be the previous code of the next step, and 'edits' keeps the raw edits and how many applied.
+
+        :param actor_result: Result of the actor.
+        :param prev_state_code: Previous code the edits apply to.
+        :return: Tuple of the action for the environment and the unified diff against the previous code (None for a full program).
+        """
+        action = actor_result.get('action', request)
+        if self.actor.config.edit_format != 'search_replace' or not prev_state_code:
+            return action, None
+
+        edits = parse_edits(action)
+        if not edits:
+            # The actor answered with a full program
+            return action, None
+
+        language = self.actor.config.code
+        prev_code = extract_code(prev_state_code, language)
+        code, failed = apply_edits(prev_code, edits)
+
+        actor_result['edits'] = {
+            'raw': action,
+            'applied': len(edits) - len(failed),
+            'failed': len(failed)
+        }
+        if failed and self.debug:
+            print(f"{len(failed)} of {len(edits)} edits did not match the previous code")
+
+        actor_result['action'] = f"```{language}\n{code}\n```"
+        return actor_result['action'], code_diff(prev_code, code)
+
+    def render(self, env: Env, actions: List[str], run_name: str = '', tags: List[str] = None) -> List[dict]:
+        """
+        Render several actions, in parallel when the environment allows it and one after the other otherwise.
+
+        :param env: Environment to execute the actions in.
+        :param actions: Actions to render.
+        :param tags: Tag of each render.
+        :return: Transition of each action, with an 'error' for the actions the environment rejected.
+        """
+        def step(index: int) -> dict:
+            try:
+                return env.step(actions[index], run_name=run_name, tag=tags[index])
+            except ValueError as e:
+                return {'code': None, 'image_file_path': None, 'error': str(e)}
+
+        if env.parallel_steps and len(actions) > 1:
+            with ThreadPoolExecutor(max_workers=len(actions)) as executor:
+                return list(executor.map(step, range(len(actions))))
+        return [step(i) for i in range(len(actions))]
+
+    @traced('module.best_of', 'module')
+    def best_of(self,
+                env: Env,
+                request: str,
+                image: Union[str, Image.Image] = None,
+                prev_state_code: str = None,
+                prev_state_critique: str = None,
+                run_name: str = '',
+                tag: str = '') -> tuple:
+        """
+        Draw config.num_samples actions, render them and keep the most promising one.
+
+        Samples with the same code are rendered once. Broken, blank or hopeless renders are
+        dropped by the cheap checks, the others are ordered by their similarity to the input
+        image. With critique_top_k above 1 the top renders are scored together by the ranking
+        critic and the best scored one is kept, otherwise the top render is returned uncritiqued.
+
+        :return: Tuple of the actor result, action diff, transition, render hash and critic result (None if the critics still have to run).
+        """
+        actor_results = self.actor.sample(request, image, prev_state_code, prev_state_critique,
+                                          num_samples=self.config.num_samples, run_name=run_name, tag=tag)
+
+        samples = {}
+        for actor_result in actor_results:
+            action, action_diff = self.resolve_action(actor_result, prev_state_code, request)
+            key = (extract_code(action) or action or '').strip()
+            if key not in samples:
+                samples[key] = (actor_result, action, action_diff)
+        samples = list(samples.values())
+
+        sample_tags = [f"{tag}_sample_{i + 1}" for i in range(len(samples))]
+        transitions = self.render(env, [action for _, action, _ in samples], run_name=run_name, tags=sample_tags)
+
+        candidates = []
+        for (actor_result, _, action_diff), transition, sample_tag in zip(samples, transitions, sample_tags):
+            render_key, critic_result = self.lookup_render(transition, run_name, image)
+            candidates.append({
+                'tag': sample_tag,
+                'actor_result': actor_result,
+                'action_diff': action_diff,
+                'transition': transition,
+                'render_key': render_key,
+                'critic_result': critic_result
+            })
+
+        if self.debug:
+            print(f"Best of {len(actor_results)}: {len(samples)} distinct samples, "
+                  f"{sum(candidate['critic_result'] is None for candidate in candidates)} passed the checks")
+
+        def similarity(candidate: dict) -> float:
+            return (candidate['transition'].get('similarity') or {}).get('score', 0.0)
+
+        fresh = sorted([candidate for candidate in candidates if candidate['critic_result'] is None], key=similarity, reverse=True)
+        top = fresh[:max(1, self.config.critique_top_k)]
+
+        if len(top) > 1:
+            def prepare(index: int) -> tuple:
+                combined_image, image_titles, _ = self.prepare_critic_image(env,
+                                                                            [image, top[index]['transition']['image_file_path']],
+                                                                            ['Input Image', 'Transition Image'],
+                                                                            run_name=run_name,
+                                                                            tag=top[index]['tag'])
+                return combined_image, image_titles
+
+            critic_results = self.critic.rank(request,
+                                              image=image,
+                                              candidates=[candidate['transition']['image_file_path'] for candidate in top],
+                                              action_codes=[candidate['transition'].get('code', None) for candidate in top],
+                                              prepare=prepare,
+                                              run_name=run_name,
+                                              tag=tag)
+            for candidate, critic_result in zip(top, critic_results):
+                critic_result['score'] = min(critic_result['text_critic']['score'], critic_result['vision_critic']['score'])
+                critic_result['parse_error'] = any(critic_result[key].get('parse_error', False) for key in ('text_critic', 'vision_critic'))
+                self.remember_render(candidate['render_key'], critic_result, run_name)
+                candidate['critic_result'] = critic_result
+
+        scored = [candidate for candidate in candidates if candidate['critic_result'] is not None]
+        if len(top) == 1:
+            best = top[0]
+        else:
+            best = max(scored, key=lambda candidate: candidate['critic_result']['score'])
+
+        return best['actor_result'], best['action_diff'], best['transition'], best['render_key'], best['critic_result']
+
+    @traced('module.merge_images', 'module')
+    def prepare_critic_image(self, env: Env, images: list, titles: list, run_name: str = '', tag: str = '') -> tuple:
+        """
+        Prepare the images for the vision critic.
+
+        By default the images are composited into one canvas with merge_images. When the vision
+        critic is configured with multi_image, the images are passed as they are with their titles.
+
+        :param env: Environment, its cache folder keeps the merged images.
+        :param images: Input, previous and transition images (missing entries are dropped).
+        :param titles: Title of each image.
+        :return: Tuple of the critic image (or list of images), the image titles (None when merged) and the image input stats.
+        """
+        pairs = [(img, title) for img, title in zip(images, titles)
+                 if img is not None and not (isinstance(img, str) and not os.path.exists(img))]
+        images = [img for img, _ in pairs]
+        titles = [title for _, title in pairs]
+
+        sizes = []
+        for img in images:
+            if isinstance(img, str):
+                with Image.open(img) as opened:
+                    sizes.append(opened.size)
+            else:
+                sizes.append(img.size)
+        image_tokens = self.critic.vision_critic.image_tokens
+        merged_tokens = image_tokens(merge_layout(sizes, titles)['canvas'])
+
+        if self.critic.config.vision.multi_image:
+            image_tokens = sum(image_tokens(size) for size in sizes)
+            image_input = {
+                'mode': 'multi',
+                'compose_time': 0.0,
+                'image_tokens': image_tokens,
+                'merged_image_tokens': merged_tokens,
+                'image_tokens_saved': merged_tokens - image_tokens
+            }
+            return images, titles, image_input
+
+        start = time.perf_counter()
+        combined_image = merge_images(images,
+                                       titles=titles,
+                                       run_name=run_name,
+                                       tag=tag,
+                                       save_folder=env.config.cache_folder,
+                                       return_path=self.config.image_path
+                                       )
+        image_input = {
+            'mode': 'merged',
+            'compose_time': time.perf_counter() - start,
+            'image_tokens': merged_tokens
+        }
+
+        logging.debug(f"Combined image path: {combined_image}")
+        return combined_image, None, image_input
+
 
     def stream_act(self,
             env: Env,
@@ -66,6 +454,10 @@ class Module(BaseModel):
         """
         Perform an action with the given parameters in a streaming manner.
 
+        The step runs through run_stages, like act: code dedupe, the cheap checks and the overlapped
+        text critic apply. The graph runs on a thread of its own and the stage results are yielded
+        as they come.
+
         :param env: Environment to execute actions in
         :param request: The request/action to perform.
         :param image: Optional image input for the actor.
@@ -75,94 +467,88 @@ class Module(BaseModel):
         :param tag: Tag for the run
         :return: Generator yielding intermediate and final results.
         """
-        try:
-            # Step 1: Get actor result
-            actor_result = self.actor.act(request, image, prev_state_code, prev_state_critique)
-            action = actor_result.get('action', request)
+        events = queue.Queue()
 
-            if self.debug:
-                print(f"Actor action: {action}")
+        def on_stage(name: str, result) -> None:
+            events.put((name, result))
+            if name == 'actor' and 'render' not in result and not (result['action'] or '').strip():
+                # Stops the graph before the render
+                raise ValueError("Actor returned empty action")
 
-            # Yield intermediate result with actor action
-            yield {
-                "status": "actor_completed",
-                "actor_result": actor_result,
-                "language": self.actor.config.code
-            }
+        def run() -> None:
+            try:
+                events.put(('done', self.run_stages(env, request, image, prev_state_code, prev_state_critique,
+                                                    run_name=run_name, tag=tag, on_stage=on_stage)))
+            except Exception as e:
+                events.put(('error', e))
 
-            # Check if action is empty or invalid
-            if not action or action.strip() == "":
-                yield {
-                    "status": "error",
-                    "error": "Actor returned empty action",
-                    "message": "Actor failed to generate valid code. This might be due to API limits or model issues."
-                }
-                return
+        threading.Thread(target=run, name='stream-step', daemon=True).start()
 
-            # Step 2: Execute in environment
-            try:
-                transition = env.step(action, run_name=run_name, tag=tag)
-                print(f"Transition: {transition}")
-            except ValueError as e:
+        finished = set()
+        try:
+            while True:
+                name, result = events.get()
+                if name == 'error':
+                    raise result
+                finished.add(name)
+
+                if name == 'actor':
+                    if self.debug:
+                        print(f"Actor action: {result.get('action')}")
+                    yield {
+                        "status": "actor_completed",
+                        "actor_result": result['actor_result'],
+                        "language": self.actor.config.code
+                    }
+                    if 'render' not in result and not (result['action'] or '').strip():
+                        yield {
+                            "status": "error",
+                            "error": "Actor returned empty action",
+                            "message": "Actor failed to generate valid code. This might be due to API limits or model issues."
+                        }
+                        return
+
+                elif name == 'render':
+                    transition = result['transition']
+                    logging.debug(f"Transition: {transition}")
+                    yield {
+                        'status': 'environment_executed',
+                        'type': 'code',
+                        'language': self.actor.config.code,
+                        'code': transition.get('code', None),
+                        'image_file_path': transition.get('image_file_path', None)
+                    }
+
+                elif name == 'done':
+                    yield {
+                        "status": "completed",
+                        'type': 'flag',
+                        "actor_result": result['actor_result'],
+                        "critic_result": result['critic_result'],
+                        "output_image": result['output_image'],
+                        "similarity": result['similarity'],
+                        "crop_ratio": result['crop_ratio'],
+                        "stages": result['stages'],
+                        "language": self.actor.config.code
+                    }
+                    return
+
+        except ValueError as e:
+            if 'actor' in finished and 'render' not in finished:
                 # Handle environment errors (like unsupported language)
                 yield {
                     "status": "error",
                     "error": str(e),
                     "message": "Environment failed to execute the action. The generated code might be invalid."
                 }
-                return
-            
-            # Yield intermediate result with environment transition
-            if self.actor.config.code == 'html':
+            else:
                 yield {
-                    'status': 'environment_executed',
-                    'type': 'code',
-                    'language': 'html',
-                    'code': transition['code'],
-                    'image_file_path': transition.get('image_file_path', None)
-                }
-            elif self.actor.config.code == 'python':
-                yield {
-                    'status': 'environment_executed',
-                    'type': 'code',
-                    'language': 'python',
-                    'image_file_path': transition['image_file_path'],
-                    'code': transition.get('code', None)
+                    "status": "error",
+                    'type': 'flag',
+                    "error": str(e),
+                    "message": f"Unexpected error during streaming action: {str(e)}"
                 }
 
-            # Step 3: Create combined image for critic
-            combined_image = merge_images([image, 
-                                           transition['image_file_path']],
-                                           titles=['Input Image', 'Transition Image'],
-                                           run_name=run_name, 
-                                           tag=tag,
-                                           save_folder=env.config.cache_folder,
-                                             return_path=self.config.image_path
-                                           )
-            
-            print(f"Combined image path: {combined_image}")
-
-            # Step 4: Get critic result
-            action_code = transition.get('code', None)
-            critic_result = self.critic.act(request,
-                                             action_code=action_code,
-                                             action_image=combined_image)
-            
-            critic_result['score'] = min(critic_result['text_critic']['score'], critic_result['vision_critic']['score'])
-
-            if self.debug:
-                print(f"Critic result: {critic_result}")
-
-            # Step 5: Yield final complete result
-            yield {
-                "status": "completed",
-                'type': 'flag',
-                "actor_result": actor_result,
-                "critic_result": critic_result,
-                "output_image": transition['image_file_path'],
-                "language": self.actor.config.code
-            }
-            
         except Exception as e:
             # Handle any unexpected errors
             yield {
@@ -171,8 +557,189 @@ class Module(BaseModel):
                 "error": str(e),
                 "message": f"Unexpected error during streaming action: {str(e)}"
             }
-        
-        
+
+
+    @traced('module.step', 'module')
+    def run_stages(self,
+                   env: Env,
+                   request: str,
+                   image: Union[str, Image.Image] = None,
+                   prev_state_code: str = None,
+                   prev_state_critique: str = None,
+                   prev_image: Union[str, Image.Image] = None,
+                   prev_critiques: tuple = None,
+                   run_name: str = '',
+                   tag: str = '',
+                   on_stage: Callable[[str, object], None] = None) -> dict:
+        """
+        Run one step as a graph of stages. The actor comes first. Then the render, the cheap
+        checks and the critic image run on one branch, and the text critic on the other when
+        overlap_stages is set and the critic allows it. The vision critic joins both branches.
+        When the render gets a result without the critics (cheap checks or a reused critique), the
+        overlapped text critic is cancelled if still queued, or its result is returned in 'spent_text_critic'.
+        It is cancelled the same way when a stage fails, and the step fails without waiting for it.
+
+        :param prev_image: Image of the previous state, shown to the critics when given.
+        :param prev_critiques: Tuple of the previous vision and text critiques, None to critique without the previous state.
+        :param on_stage: Called with the name and the result of every stage as it finishes, see StageGraph.
+        :return: Result of the step, with the per-stage timings in 'stages'.
+        """
+        with_prev_state = prev_critiques is not None
+        language = self.config.actor_config.code
+        prev_vision_critique, prev_text_critique = prev_critiques or (None, None)
+        graph = StageGraph(run_name=run_name, max_workers=self.config.stage_workers, on_stage=on_stage)
+        # Overlapped text critic request, cancelled when the render is scored without the critics or a stage fails
+        overlap = {'future': None, 'cancelled': False}
+        overlap_lock = threading.Lock()
+
+        def cancel_overlap() -> None:
+            with overlap_lock:
+                overlap['cancelled'] = True
+                if overlap['future'] is not None:
+                    overlap['future'].cancel()
+
+        graph.on_cancel(cancel_overlap)
+
+        def actor() -> dict:
+            if self.config.num_samples > 1:
+                actor_result, action_diff, transition, render_key, critic_result = self.best_of(env, request, image, prev_state_code, prev_state_critique,
+                                                                                                 run_name=run_name, tag=tag)
+                return {'actor_result': actor_result, 'action_diff': action_diff,
+                        'render': {'transition': transition, 'render_key': render_key, 'critic_result': critic_result}}
+
+            actor_result = self.actor.act(request, image, prev_state_code, prev_state_critique, run_name=run_name, tag=tag)
+            action, action_diff = self.resolve_action(actor_result, prev_state_code, request)
+            key = code_hash(env.executed_code(action) or action, language) if self.config.dedupe_code else None
+
+            if key is not None and self.config.unchanged_retry_temperature is not None and self.code_index.contains(run_name, key):
+                if self.debug:
+                    print(f"Actor returned code already rendered, retrying at temperature {self.config.unchanged_retry_temperature}")
+                actor_result = self.actor.act(request, image, prev_state_code, prev_state_critique, run_name=run_name, tag=f"{tag}_retry",
+                                              temperature=self.config.unchanged_retry_temperature)
+                action, action_diff = self.resolve_action(actor_result, prev_state_code, request)
+                retry_key = code_hash(env.executed_code(action) or action, language)
+                self.code_index.count(run_name, retries=1, retries_changed=int(retry_key != key))
+                key = retry_key
+
+            if self.debug:
+                print(f"Actor action: {action}")
+
+            result = {'actor_result': actor_result, 'action': action, 'action_diff': action_diff, 'code_hash': key}
+            cached = self.code_index.lookup(run_name, key) if key is not None else None
+            if cached is not None:
+                if self.debug:
+                    print(f"Reusing the render and critique of unchanged code, stats: {self.code_index.stats}")
+                result['render'] = {'transition': cached[0], 'render_key': None, 'critic_result': cached[1]}
+            return result
+
+        def render(actor: dict) -> dict:
+            if 'render' in actor:
+                return actor['render']
+            transition = env.step(actor['action'], run_name=run_name, tag=tag)
+            render_key, critic_result = self.lookup_render(transition, run_name, image, partial=True)
+            if critic_result is not None and not critic_result.get('text_pending'):
+                # Canned or reused result: the text critique is not needed anymore
+                cancel_overlap()
+            return {'transition': transition, 'render_key': render_key, 'critic_result': critic_result}
+
+        def merge(render: dict) -> Optional[tuple]:
+            if render['critic_result'] is not None:
+                return None
+            if prev_image is not None:
+                images = [image, prev_image, render['transition']['image_file_path']]
+                titles = ['Input Image', 'Previous Image', 'Transition Image']
+            else:
+                images = [image, render['transition']['image_file_path']]
+                titles = ['Input Image', 'Transition Image']
+            return self.prepare_critic_image(env, images, titles, run_name=run_name, tag=tag)
+
+        def text_critic(actor: dict) -> Optional[dict]:
+            if 'render' in actor:
+                return None
+            # The code is known once the actor returns, no need to wait for the render
+            action_code = env.executed_code(actor['action'])
+            with overlap_lock:
+                if overlap['cancelled']:
+                    return None
+                future = overlap['future'] = self.critic.submit_text(request, action_code, prev_text_critique,
+                                                                     run_name=run_name, tag=tag, code_diff=actor['action_diff'],
+                                                                     with_prev_state=with_prev_state)
+            try:
+                return self.critic.text_result(future)
+            except CancelledError:
+                return None
+
+        def critic(actor: dict, render: dict, merge: Optional[tuple], text_critic: dict = None) -> dict:
+            if render['critic_result'] is not None and render['critic_result'].get('text_pending'):
+                # Duplicate render of new code: reuse the vision critique, critique the new code
+                if text_critic is None:
+                    text_critic = self.critic.text_act(request, render['transition'].get('code', None), prev_text_critique,
+                                                       run_name=run_name, tag=tag, code_diff=actor['action_diff'], with_prev_state=with_prev_state)
+                return self.complete_reused(render['critic_result'], text_critic, render['render_key'], run_name)
+            if render['critic_result'] is not None:
+                if text_critic is not None:
+                    # The overlapped text critic ran before the render was known not to need it
+                    return dict(render['critic_result'], spent_text_critic=text_critic)
+                return render['critic_result']
+
+            combined_image, image_titles, image_input = merge
+            action_code = render['transition'].get('code', None)
+
+            if with_prev_state:
+                critic_result = self.critic.act_with_prev_state(request,
+                                                                action_code=action_code,
+                                                                code_diff=actor['action_diff'],
+                                                                action_image=combined_image,
+                                                                prev_vision_critique=prev_vision_critique,
+                                                                prev_text_critique=prev_text_critique,
+                                                                run_name=run_name,
+                                                                tag=tag,
+                                                                image_titles=image_titles,
+                                                                text_critique=text_critic)
+            else:
+                critic_result = self.critic.act(request,
+                                                action_code=action_code,
+                                                code_diff=actor['action_diff'],
+                                                action_image=combined_image,
+                                                run_name=run_name,
+                                                tag=tag,
+                                                image_titles=image_titles,
+                                                text_critique=text_critic)
+
+            critic_result['score'] = min(critic_result['text_critic']['score'], critic_result['vision_critic']['score'])
+            critic_result['parse_error'] = any(critic_result[key].get('parse_error', False) for key in ('text_critic', 'vision_critic'))
+            critic_result['image_input'] = image_input
+            self.remember_render(render['render_key'], critic_result, run_name)
+            return critic_result
+
+        graph.add('actor', actor)
+        graph.add('render', render, 'actor')
+        graph.add('merge', merge, 'render')
+        if self.config.overlap_stages and self.config.num_samples <= 1 and self.critic.can_overlap():
+            graph.add('text_critic', text_critic, 'actor')
+            graph.add('critic', critic, 'actor', 'render', 'merge', 'text_critic')
+        else:
+            graph.add('critic', critic, 'actor', 'render', 'merge')
+
+        results = graph.run()
+        transition = results['render']['transition']
+        critic_result = results['critic']
+
+        if results['actor'].get('code_hash') is not None and not critic_result.get('unchanged_code'):
+            self.code_index.add(run_name, results['actor']['code_hash'], transition, critic_result)
+
+        if self.debug:
+            print(f"Critic result: {critic_result}")
+
+        return {
+            "actor_result": results['actor']['actor_result'],
+            "critic_result": critic_result,
+            "output_image": transition['image_file_path'],  # Add this line to return the output image path
+            "similarity": transition.get('similarity', None),
+            "crop_ratio": transition.get('crop_ratio', None),
+            "stages": graph.report()
+        }
+
     def act(self,
             env: Env,
             request: str, 
@@ -191,43 +758,7 @@ class Module(BaseModel):
         :param prev_state_critique: Optional previous state critique for the critic.
         :return: Result of the action.
         """
-        # Delegate action to actor and critic
-        actor_result = self.actor.act(request, image, prev_state_code, prev_state_critique, run_name=run_name, tag=tag)
-        action = actor_result.get('action', request)
-
-        if self.debug:
-            print(f"Actor action: {action}")
-
-        transition = env.step(action, run_name=run_name, tag=tag)
-
-        combined_image = merge_images([image, transition['image_file_path']],
-                                       titles=['Input Image', 'Transition Image'],
-                                       run_name=run_name, 
-                                       tag=tag,
-                                       save_folder=env.config.cache_folder,
-                                       return_path=self.config.image_path
-                                       )
-
-        action_code = transition.get('code', None)
-        print(f"Combined image path: {combined_image}")
-        
-        critic_result = self.critic.act(request,
-                                         action_code=action_code,
-                                         action_image=combined_image,
-                                         run_name=run_name, 
-                                         tag=tag)
-        
-        critic_result['score'] = min(critic_result['text_critic']['score'], critic_result['vision_critic']['score'])  # Ensure score is between 0 and 1
-
-        if self.debug:
-            print(f"Critic result: {critic_result}")
-
-        return {
-            "actor_result": actor_result,
-            "critic_result": critic_result,
-            "output_image": transition['image_file_path']  # Add this line to return the output image path
-        }
-    
+        return self.run_stages(env, request, image, prev_state_code, prev_state_critique, run_name=run_name, tag=tag)
 
     def act_with_prev_state(self,
             env: Env, 
@@ -251,50 +782,86 @@ class Module(BaseModel):
         
         prev_state_critique = "### Vision Critique:\n" + (prev_vision_critique or '') + "\n\n### Text Critique:\n" + (prev_text_critique or '')
 
-        actor_result = self.actor.act_with_prev_state(request, image, prev_state_code, prev_state_critique, run_name=run_name, tag=tag)
-        action = actor_result.get('action', request)
-
-        if self.debug:
-            print(f"Actor action: {action}")
-
-        transition = env.step(action, run_name=run_name, tag=tag)
-
-        if prev_image is not None:
-            images = [image, prev_image, transition['image_file_path']]
-            titles = ['Input Image', 'Previous Image', 'Transition Image']
-        else:
-            images = [image, transition['image_file_path']]
-            titles = ['Input Image', 'Transition Image']
+        return self.run_stages(env, request, image, prev_state_code, prev_state_critique,
+                               prev_image=prev_image,
+                               prev_critiques=(prev_vision_critique, prev_text_critique),
+                               run_name=run_name,
+                               tag=tag)
 
+    @traced('module.propose', 'module')
+    def propose(self,
+            env: Env,
+            request: str,
+            image: Union[str, Image.Image] = None,
+            prev_state_code: str = None,
+            prev_state_critique: str = None,
+            num_candidates: int = 2,
+            run_name: str = '',
+            tag: str = '', **kwargs) -> List[dict]:
+        """
+        Generate several candidates for the same state and critique them together with the ranking critic.
 
-        combined_image = merge_images(images,
-                                       titles=titles,
-                                       run_name=run_name, 
-                                       tag=tag,
-                                       save_folder=env.config.cache_folder,
-                                       return_path=self.config.image_path
-                                       )
+        The actor calls run in parallel, the renders too when the environment allows it.
+        Each candidate is a separate sample of the actor, kept apart in the response cache.
 
-        action_code = transition.get('code', None)
-        critic_result = self.critic.act_with_prev_state(request,
-                                                        action_code=action_code,
-                                                        action_image=combined_image,
-                                                        prev_vision_critique=prev_vision_critique,
-                                                        prev_text_critique=prev_text_critique,
-                                                        run_name=run_name,
-                                                        tag=tag
-                                                        )
-        
-        critic_result['score'] = min(critic_result['text_critic']['score'], critic_result['vision_critic']['score'])  # Ensure score is between 0 and 1
+        :param env: Environment to execute actions in
+        :param request: The request/action to perform.
+        :param image: Optional image input for the actor.
+        :param prev_state_code: Optional previous state code for the actor.
+        :param prev_state_critique: Optional previous state critique for the actor.
+        :param num_candidates: Number of candidates to generate.
+        :return: Result of each candidate, in the format of act.
+        """
+        with ThreadPoolExecutor(max_workers=num_candidates) as executor:
+            futures = [executor.submit(self.actor.act, request, image, prev_state_code, prev_state_critique,
+                                       run_name=run_name, tag=f"{tag}_candidate_{i + 1}", sample=i)
+                       for i in range(num_candidates)]
+            actor_results = [future.result() for future in futures]
+
+        actions = [self.resolve_action(actor_result, prev_state_code, request)[0] for actor_result in actor_results]
+        transitions = self.render(env, actions, run_name=run_name, tags=[f"{tag}_candidate_{i + 1}" for i in range(num_candidates)])
+
+        results = []
+        pending = []
+        for i, (actor_result, transition) in enumerate(zip(actor_results, transitions)):
+            render_key, critic_result = self.lookup_render(transition, run_name, image)
+            results.append({
+                "actor_result": actor_result,
+                "critic_result": critic_result,
+                "output_image": transition['image_file_path'],
+                "similarity": transition.get('similarity', None),
+                "crop_ratio": transition.get('crop_ratio', None)
+            })
+            if critic_result is None:
+                pending.append((i, transition, render_key))
+
+        if pending:
+            def prepare(index: int) -> tuple:
+                combined_image, image_titles, _ = self.prepare_critic_image(env,
+                                                                            [image, pending[index][1]['image_file_path']],
+                                                                            ['Input Image', 'Transition Image'],
+                                                                            run_name=run_name,
+                                                                            tag=f"{tag}_candidate_{pending[index][0] + 1}")
+                return combined_image, image_titles
+
+            critic_results = self.critic.rank(request,
+                                              image=image,
+                                              candidates=[transition['image_file_path'] for _, transition, _ in pending],
+                                              action_codes=[transition.get('code', None) for _, transition, _ in pending],
+                                              prepare=prepare,
+                                              run_name=run_name,
+                                              tag=tag)
+
+            for (i, _, render_key), critic_result in zip(pending, critic_results):
+                critic_result['score'] = min(critic_result['text_critic']['score'], critic_result['vision_critic']['score'])
+                critic_result['parse_error'] = any(critic_result[key].get('parse_error', False) for key in ('text_critic', 'vision_critic'))
+                self.remember_render(render_key, critic_result, run_name)
+                results[i]['critic_result'] = critic_result
 
         if self.debug:
-            print(f"Critic result: {critic_result}")
+            print(f"Candidate scores: {[result['critic_result']['score'] for result in results]}")
 
-        return {
-            "actor_result": actor_result,
-            "critic_result": critic_result,
-            "output_image": transition['image_file_path']  # Add this line to return the output image path
-        }
+        return results
 
     def __str__(self):
         """
@@ -0,0 +1,188 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List
+
+import logging
+
+from agent.tracing import TRACER
+
+_stage_executors: Dict[int, ThreadPoolExecutor] = {}
+_stage_executor_lock = threading.Lock()
+
+
+def get_stage_executor(max_workers: int = 32) -> ThreadPoolExecutor:
+    """
+    Get the process-wide executor running the stages of every module with the same max_workers, created on first use.
+
+    It is kept apart from the critic executor so that a stage waiting on critic requests never
+    holds a critic worker. A step keeps at most three stages running at once (actor, then render
+    and text critic, then critic), so max_workers / 3 steps run their stages without queueing; the
+    stages of further steps wait for a free thread. The graphs run on the caller's thread, so a
+    full executor slows the steps down but never deadlocks them.
+
+    Modules configured with another stage_workers get an executor of their own.
+
+    :param max_workers: Number of threads shared by the stages of every module with this limit.
+    :return: The shared stage executor.
+    """
+    with _stage_executor_lock:
+        if max_workers not in _stage_executors:
+            _stage_executors[max_workers] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'stage-{max_workers}')
+        return _stage_executors[max_workers]
+
+
+class Stage:
+    """
+    A step of a module run: a function of the results of the stages it depends on.
+    """
+
+    def __init__(self, name: str, fn: Callable, deps: List[str]):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+
+
+class StageGraph:
+    """
+    Small dependency graph of stages: every stage starts as soon as the stages it depends on
+    have finished, so independent stages overlap.
+
+    A stage function is called with the results of its dependencies as keyword arguments,
+    named after the dependencies.
+    """
+
+    def __init__(self, run_name: str = None, max_workers: int = 32, on_stage: Callable[[str, object], None] = None):
+        """
+        :param run_name: Run the stages belong to, their spans are traced when the run is.
+        :param max_workers: Threads of the process-wide stage executor, see get_stage_executor.
+        :param on_stage: Called with the name and the result of every stage as it finishes, on the thread running the graph.
+        """
+        self.run_name = run_name
+        self.max_workers = max_workers
+        self.on_stage = on_stage
+        self.stages: Dict[str, Stage] = {}
+        self.results: Dict[str, object] = {}
+        self.timings: Dict[str, dict] = {}
+        self.cancelled = threading.Event()
+        self._cancel_hooks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._start = None
+
+    def add(self, name: str, fn: Callable, *deps: str) -> None:
+        """
+        Add a stage.
+
+        :param name: Name of the stage, also the keyword its result is passed as.
+        :param fn: Function of the stage.
+        :param deps: Names of the stages it depends on, added before it.
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = Stage(name, fn, list(deps))
+
+    def on_cancel(self, hook: Callable[[], None]) -> None:
+        """
+        Register a function called when the graph is cancelled, e.g. to cancel a request a running stage waits on.
+        """
+        self._cancel_hooks.append(hook)
+
+    def cancel(self) -> None:
+        """
+        Cancel the graph: no further stage starts and the cancel hooks run once.
+        """
+        if self.cancelled.is_set():
+            return
+        self.cancelled.set()
+        for hook in self._cancel_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logging.warning(f"Cancel hook of the stage graph failed: {e}")
+
+    def _run_stage(self, stage: Stage):
+        start = time.perf_counter()
+        try:
+            with TRACER.span(f"stage.{stage.name}", self.run_name, 'stage'):
+                return stage.fn(**{dep: self.results[dep] for dep in stage.deps})
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.timings[stage.name] = {
+                    'start': start - self._start,
+                    'end': end - self._start,
+                    'duration': end - start
+                }
+
+    def run(self) -> Dict[str, object]:
+        """
+        Run every stage.
+
+        :return: Result of every stage, keyed by name.
+        """
+        executor = get_stage_executor(self.max_workers)
+        self._start = time.perf_counter()
+        pending = dict(self.stages)
+        running = {}
+
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in self.results for dep in stage.deps):
+                    running[executor.submit(self._run_stage, stage)] = name
+                    del pending[name]
+
+            if not running:
+                raise RuntimeError(f"Stages {list(pending)} cannot run, their dependencies never finish")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    self.results[name] = future.result()
+                    if self.on_stage is not None:
+                        self.on_stage(name, self.results[name])
+                except Exception as e:
+                    # The queued stages never start and the running ones are cancelled through the
+                    # cancel hooks; the graph does not wait for them, their results are dropped
+                    for other in running:
+                        other.cancel()
+                    self.cancel()
+                    logging.warning(f"Stage {name} failed: {e}")
+                    raise
+
+        return self.results
+
+    def critical_path(self) -> List[str]:
+        """
+        Stages on the longest chain of dependencies, by duration.
+        """
+        length = {}
+        previous = {}
+        for name, stage in self.stages.items():
+            # Stages are added after their dependencies, so this order is topological
+            best = max(stage.deps, key=lambda dep: length[dep], default=None)
+            length[name] = self.timings.get(name, {}).get('duration', 0.0) + (length[best] if best else 0.0)
+            previous[name] = best
+
+        name = max(length, key=length.get, default=None)
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1]
+
+    def report(self) -> dict:
+        """
+        Per-stage timings, wall time of the run, time the stages would take one after the other,
+        and the time saved by the overlap.
+        """
+        wall_time = max((timing['end'] for timing in self.timings.values()), default=0.0)
+        serial_time = sum(timing['duration'] for timing in self.timings.values())
+        return {
+            'stages': dict(self.timings),
+            'critical_path': self.critical_path(),
+            'wall_time': wall_time,
+            'serial_time': serial_time,
+            'saved': serial_time - wall_time
+        }
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import glob
+import time
+import threading
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from pydantic import BaseModel, Field
+from typing import Optional, Dict, List, Tuple
+
+import numpy as np
+import logging
+
+# Dollars per million input and output tokens, matched on the model name prefix
+MODEL_PRICES = {
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gemini-2.0-flash': (0.10, 0.40),
+    'gemini-2.5-flash': (0.30, 2.50),
+    'gemini-2.5-pro': (1.25, 10.00),
+}
+
+
+def get_price(model_name: str, prices: Dict[str, Tuple[float, float]] = None) -> Tuple[float, float]:
+    """
+    Price of a model in dollars per million input and output tokens, the longest matching prefix wins.
+    Unknown models are free, so they never exhaust a dollar budget.
+    """
+    prices = prices if prices is not None else MODEL_PRICES
+    matches = [prefix for prefix in prices if model_name and model_name.startswith(prefix)]
+    if not matches:
+        return 0.0, 0.0
+    return prices[max(matches, key=len)]
+
+
+class ModelThresholds(BaseModel):
+    """
+    Stopping thresholds of an actor and critic pair in an environment and pipeline, learned from its past results.
+    """
+    target_score: float = Field(default=4, description="Score worth stopping at for the pair")
+    patience: Optional[int] = Field(default=None, description="Iterations without a better score before stopping, None to never stop on a plateau")
+    samples: int = Field(default=0, description="Number of past results the thresholds were learned from")
+    improvement_rate: float = Field(default=0.0, description="Share of the multi-iteration runs whose final score beat the first one")
+
+
+def thresholds_key(actor_model: str, critic_model: str, environment: str, pipeline: str) -> str:
+    """
+    Key of the learned thresholds of an actor and critic pair in an environment and pipeline.
+    """
+    return f"{actor_model}|{critic_model}|{environment}|{pipeline}"
+
+
+def score_trajectory(record: dict) -> List[float]:
+    """
+    Critic scores of the iterations of a saved run, in order.
+
+    Results saved before the scores of every iteration were kept only have the first and the best
+    score, taken as a two iteration run.
+    """
+    scores = [score for score in record.get('critic_scores') or [] if score is not None]
+    if scores:
+        return scores
+    if record.get('number_iter', 1) > 1 and record.get('first_critic_score') is not None:
+        return [record['first_critic_score'], record['critic_score']]
+    return [record['critic_score']]
+
+
+def learn_thresholds(results_dir: str = os.path.join(current_dir, '..', 'results'),
+                     default_target: float = 4,
+                     min_samples: int = 20,
+                     min_improvement: float = 0.5,
+                     max_improvement_rate: float = 0.2,
+                     min_points: int = 5) -> Dict[str, ModelThresholds]:
+    """
+    Learn the stopping thresholds of every actor and critic pair, environment and pipeline from the result files (*_eval.jsonl).
+
+    The thresholds are compared with the critic score of the runs, so they are learned from the
+    critic scores saved with the results (critic_scores, critic_score and first_critic_score), not
+    from the score of the separate evaluator. Results saved without a critic score are skipped. The
+    pipeline is the one of the record, or else the prefix of the file name (iterative_... or mcts_...),
+    'iterative' without a known prefix.
+
+    The target is the plateau point of the pair: the lowest best-so-far score after which the later
+    iterations of a run seldom improve it, capped at the default target. The patience is the wait
+    between improvements that covers most of them, 1 when the later iterations never improve, and
+    None when no run of the pair went past its first iteration.
+
+    :param results_dir: Folder of the result files.
+    :param default_target: Target score of the pairs without a lower plateau.
+    :param min_samples: Results needed before thresholds are learned for a key.
+    :param min_improvement: Score gain counted as an improvement, as in StoppingPolicy.
+    :param max_improvement_rate: Share of the iterations followed by an improvement below which a score is a plateau.
+    :param min_points: Iterations from that score on needed before a score is taken as the plateau.
+    :return: Thresholds keyed by thresholds_key.
+    """
+    records = {}
+    for path in glob.glob(os.path.join(results_dir, '*_eval.jsonl')):
+        file_pipeline = 'mcts' if os.path.basename(path).startswith('mcts_') else 'iterative'
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('critic_score') is None or 'actor_model' not in record:
+                    continue
+                key = thresholds_key(record['actor_model'],
+                                     record.get('critic_model', record['actor_model']),
+                                     record.get('environment'),
+                                     record.get('pipeline', file_pipeline))
+                records.setdefault(key, []).append(record)
+
+    thresholds = {}
+    for key, key_records in records.items():
+        if len(key_records) < min_samples:
+            continue
+
+        # Best score so far before every later iteration, whether the rest of the run improved it,
+        # and the iterations waited for every improvement
+        points, waits, improved_runs, multi_runs = [], [], 0, 0
+        for record in key_records:
+            scores = score_trajectory(record)
+            if len(scores) > 1:
+                multi_runs += 1
+                improved_runs += max(scores[1:]) > scores[0]
+            best, best_at = scores[0], 0
+            for i in range(1, len(scores)):
+                points.append((best, max(scores[i:]) >= best + min_improvement))
+                if scores[i] >= best + min_improvement:
+                    waits.append(i - best_at)
+                    best, best_at = scores[i], i
+
+        target = default_target
+        for level in sorted({best for best, _ in points}):
+            if level >= default_target:
+                break
+            above = [improved for best, improved in points if best >= level]
+            if len(above) < min_points:
+                break
+            if np.mean(above) < max_improvement_rate:
+                target = level
+                break
+
+        if waits:
+            patience = int(np.ceil(np.percentile(waits, 90)))
+        else:
+            patience = 1 if points else None
+        improvement_rate = improved_runs / multi_runs if multi_runs else 0.0
+
+        thresholds[key] = ModelThresholds(target_score=max(target, 1.0),
+                                          patience=patience,
+                                          samples=len(key_records),
+                                          improvement_rate=improvement_rate)
+    return thresholds
+
+
+def usage_delta(before: Dict[str, dict], after: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Tokens used between two usage snapshots keyed by model, as returned by RUN_USAGE.get.
+    """
+    return {
+        model_name: {key: value - before.get(model_name, {}).get(key, 0) for key, value in model_usage.items()}
+        for model_name, model_usage in after.items()
+    }
+
+
+class RunResults(list):
+    """
+    Results of the iterations of a run, in order, with the best one, the reason the run stopped
+    and the counters of the work the module skipped on duplicate renders and code.
+    """
+
+    def __init__(self, results: list = (), stop_reason: str = None, best_index: int = None, dedupe: dict = None):
+        super().__init__(results)
+        self.stop_reason = stop_reason
+        self.best_index = best_index
+        self.dedupe = dedupe
+
+    @property
+    def best(self) -> Optional[dict]:
+        """
+        Best result of the run, the last one if none was scored.
+        """
+        if not self:
+            return None
+        return self[self.best_index] if self.best_index is not None else self[-1]
+
+
+class StoppingPolicy(BaseModel):
+    """
+    When an iterative run stops: at a target score, on a score plateau, or when a wall-clock,
+    token or dollar budget would be exceeded by one more iteration.
+    """
+    target_score: Optional[float] = Field(default=4, description="Stop once the score reaches this value, None to never stop on the score")
+    patience: Optional[int] = Field(default=None, description="Stop after this many iterations without a better score, None to disable plateau detection")
+    min_improvement: float = Field(default=0.5, description="Score gain counted as an improvement by the plateau detection")
+    max_seconds: Optional[float] = Field(default=None, description="Wall-clock budget of a run in seconds")
+    max_tokens: Optional[int] = Field(default=None, description="Token budget of a run, input and output tokens reported by the providers for the calls of the run")
+    max_cost: Optional[float] = Field(default=None, description="Dollar budget of a run, priced with MODEL_PRICES")
+    learn_thresholds: bool = Field(default=False, description="Use the target score and patience learned from the past results of the actor and critic pair")
+    results_dir: str = Field(default=os.path.join(current_dir, '..', 'results'), description="Folder of the result files the thresholds are learned from")
+
+    def thresholds(self, actor_model: str, critic_model: str, environment: str = None, pipeline: str = 'iterative') -> Tuple[Optional[float], Optional[int]]:
+        """
+        Target score and patience for a pair of models in an environment and pipeline, learned ones when enabled and known.
+        """
+        target, patience = self.target_score, self.patience
+        if self.learn_thresholds:
+            learned = get_learned_thresholds(self.results_dir).get(thresholds_key(actor_model, critic_model, environment, pipeline))
+            if learned is not None:
+                target = learned.target_score if target is None else min(target, learned.target_score)
+                patience = learned.patience if patience is None else patience
+        return target, patience
+
+    def start(self, actor_model: str, critic_model: str, environment: str = None, pipeline: str = 'iterative',
+              target_score: Optional[float] = None) -> 'StoppingState':
+        """
+        Start tracking a run.
+
+        :param environment: Environment of the run (html or python), the learned thresholds are kept per environment.
+        :param pipeline: Pipeline of the run (iterative or mcts), the learned thresholds are kept per pipeline.
+        :param target_score: Target of this request, overrides the policy target.
+        """
+        target, patience = self.thresholds(actor_model, critic_model, environment, pipeline)
+        if target_score is not None:
+            target = target_score
+        return StoppingState(policy=self, target_score=target, patience=patience)
+
+
+_learned_thresholds: Dict[str, Tuple[tuple, Dict[str, ModelThresholds]]] = {}
+_learned_thresholds_lock = threading.Lock()
+
+
+def results_version(results_dir: str) -> tuple:
+    """
+    Names and modification times of the result files of a folder, changed by every saved result.
+    """
+    version = []
+    for path in sorted(glob.glob(os.path.join(results_dir, '*_eval.jsonl'))):
+        try:
+            version.append((path, os.path.getmtime(path)))
+        except OSError:
+            continue
+    return tuple(version)
+
+
+def get_learned_thresholds(results_dir: str) -> Dict[str, ModelThresholds]:
+    """
+    Thresholds learned from a results folder, learned again when a result file is added or changed.
+    """
+    path = os.path.abspath(results_dir)
+    version = results_version(path)
+    with _learned_thresholds_lock:
+        cached = _learned_thresholds.get(path)
+        if cached is None or cached[0] != version:
+            _learned_thresholds[path] = (version, learn_thresholds(path))
+            logging.info(f"Learned stopping thresholds of {len(_learned_thresholds[path][1])} model pairs, environments and pipelines from {path}")
+        return _learned_thresholds[path][1]
+
+
+class StoppingState(BaseModel):
+    """
+    Progress of a run against its stopping policy.
+    """
+    policy: StoppingPolicy
+    target_score: Optional[float] = None
+    patience: Optional[int] = None
+    started: float = Field(default_factory=time.perf_counter)
+    iterations: int = 0
+    best_score: float = -1
+    best_index: Optional[int] = None
+    since_best: int = 0
+    tokens: int = 0
+    cost: float = 0.0
+
+    def update(self, result: dict, usage: Dict[str, dict] = None) -> Optional[str]:
+        """
+        Record an iteration and decide whether to stop.
+
+        :param result: Result of the iteration, in the format of Module.act.
+        :param usage: Tokens used by the calls of the iteration, keyed by model (see RUN_USAGE).
+        :return: The reason to stop ('target_score', 'plateau', 'time_budget', 'token_budget' or 'cost_budget'), None to go on.
+        """
+        critic_result = result['critic_result']
+        score = critic_result['score']
+
+        if not critic_result.get('parse_error') and score >= self.best_score + (self.policy.min_improvement if self.best_index is not None else 0):
+            self.best_score, self.best_index, self.since_best = score, self.iterations, 0
+        else:
+            self.since_best += 1
+            if not critic_result.get('parse_error') and score >= self.best_score:
+                # A tie keeps the latest result as the best, without resetting the plateau
+                self.best_index = self.iterations
+        self.iterations += 1
+
+        for model_name, model_usage in (usage or {}).items():
+            self.tokens += model_usage['input_tokens'] + model_usage['output_tokens']
+            input_price, output_price = get_price(model_name)
+            self.cost += (model_usage['input_tokens'] * input_price + model_usage['output_tokens'] * output_price) / 1e6
+
+        if self.target_score is not None and score >= self.target_score and not critic_result.get('parse_error'):
+            return 'target_score'
+        if self.patience is not None and self.since_best >= self.patience:
+            return 'plateau'
+
+        # Stop when one more iteration at the average cost would exceed a budget
+        elapsed = time.perf_counter() - self.started
+        if self.policy.max_seconds is not None and elapsed * (1 + 1 / self.iterations) > self.policy.max_seconds:
+            return 'time_budget'
+        if self.policy.max_tokens is not None and self.tokens * (1 + 1 / self.iterations) > self.policy.max_tokens:
+            return 'token_budget'
+        if self.policy.max_cost is not None and self.cost * (1 + 1 / self.iterations) > self.policy.max_cost:
+            return 'cost_budget'
+        return None
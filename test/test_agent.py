@@ -0,0 +1,159 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from types import SimpleNamespace
+from PIL import Image
+
+from agent import ActorConfig, Actor, IMAGE_BUDGETS, get_image_budget, extract_usage
+from agent.actor import N_IGNORED_MODELS
+from test_render_checks import bar_chart
+
+
+def test_image_budget():
+    assert get_image_budget('gemini-2.5-flash') is IMAGE_BUDGETS['gemini']
+    assert get_image_budget('nim:google/gemma-3-27b-it').max_side == 896
+    assert get_image_budget('unknown-model').tile_size == 512
+
+    # The agent resolves its own copy, the caller's config and the shared budgets are untouched
+    config = ActorConfig(model_name='gpt-4.1-mini')
+    actor = Actor(config=config)
+    assert config.image_budget is None
+    assert actor.config.image_budget == IMAGE_BUDGETS['gpt'] and actor.config.image_budget is not IMAGE_BUDGETS['gpt']
+    actor.config.image_budget.max_tiles = 1
+    assert IMAGE_BUDGETS['gpt'].max_tiles == 6
+
+
+def test_fit_image(tmp_path):
+    actor = Actor(config=ActorConfig(model_name='gpt-4.1-mini', fit_folder=str(tmp_path / 'fit')))
+    large = str(tmp_path / 'large.png')
+    Image.new('RGB', (4000, 3000), 'white').save(large)
+
+    # A path is resized into the fit folder, never next to the source
+    fitted, tokens = actor.fit_image(large)
+    assert os.path.dirname(fitted) == str(tmp_path / 'fit')
+    assert tokens['tokens_saved'] == tokens['tokens_before'] - tokens['tokens_after'] >= 0
+    assert actor.fit_image(large)[0] == fitted
+    with Image.open(fitted) as image:
+        assert max(image.size) <= actor.config.image_budget.max_side
+
+    # A PIL image is resized in memory, an image within the budget is sent as it is
+    assert isinstance(actor.fit_image(Image.new('RGB', (4000, 3000)))[0], Image.Image)
+    small = str(tmp_path / 'small.png')
+    Image.new('RGB', (800, 600), 'white').save(small)
+    assert actor.fit_image(small)[0] == small
+    assert actor.image_stats['images'] == 4
+
+
+def test_extract_usage():
+    # OpenAI style, on a wrapper around the client
+    openai = SimpleNamespace(prompt_tokens=1000, completion_tokens=50, prompt_tokens_details=SimpleNamespace(cached_tokens=800))
+    usage = extract_usage(SimpleNamespace(llm=SimpleNamespace(last_usage=openai)))
+    assert usage == {'input_tokens': 1000, 'output_tokens': 50, 'cached_tokens': 800, 'cached_ratio': 0.8}
+
+    # Gemini and Anthropic style, as dictionaries
+    gemini = {'prompt_token_count': 200, 'candidates_token_count': 20, 'cached_content_token_count': 100}
+    assert extract_usage(SimpleNamespace(usage_metadata=gemini))['cached_ratio'] == 0.5
+    anthropic = {'input_tokens': 10, 'output_tokens': 5, 'cache_read_input_tokens': 0}
+    assert extract_usage(SimpleNamespace(usage=anthropic))['cached_tokens'] == 0
+
+    assert extract_usage(SimpleNamespace()) is None
+
+
+def test_cache_layout():
+    request = 'Make the bars red'
+    first = Actor(config=ActorConfig(model_name='gpt-4.1-mini', message_layout='cache'))
+    messages, _, _ = first.build_messages(request, bar_chart())
+    refined, _, _ = first.build_messages(request, bar_chart(), prev_state_code='plot()', prev_state_critique='Too blue')
+
+    # The system prompt, the image and the task are a byte-identical prefix of the refinement request
+    assert messages[0] == refined[0]
+    prefix = messages[1]['content']
+    assert refined[1]['content'][:len(prefix)] == prefix
+    assert 'plot()' in refined[1]['content'][-1]['text'] and 'Too blue' in refined[1]['content'][-1]['text']
+
+
+class StreamLLM:
+    """
+    Stand-in for a streaming LLM wrapper, yields a response in small chunks and records how far it got.
+    """
+
+    def __init__(self, response: str):
+        self.response = response
+        self.sent = 0
+        self.closed = False
+
+    def stream(self, messages: list, **kwargs):
+        try:
+            for start in range(0, len(self.response), 4):
+                self.sent = start + 4
+                yield self.response[start:start + 4]
+        finally:
+            self.closed = True
+
+
+def test_stream_action():
+    actor = Actor(config=ActorConfig(model_name='gpt-4.1-mini', code='python', stream_tail_chars=8))
+    response = "Here:\n```python\nplt.bar(x, y)\n```\n" + "A long explanation of the code.\n" * 50
+    llm = StreamLLM(response)
+    object.__setattr__(actor, 'llm', llm)
+
+    # The stream is cancelled shortly after the closing fence
+    result = actor.stream_action([{'role': 'user', 'content': 'Draw a bar chart'}])
+    assert result['action'] == "```python\nplt.bar(x, y)\n```"
+    assert result['stream']['stopped_early'] and llm.closed and llm.sent < 100 < len(response)
+    assert result['usage']['estimated'] and result['usage']['output_tokens'] == result['stream']['generated_chars'] // 4
+
+    # A wrapper that cannot stream falls back to a full call
+    object.__setattr__(actor, 'llm', lambda messages, **kwargs: response)
+    assert actor.stream_action([{'role': 'user', 'content': 'Draw a bar chart'}]) is None
+
+
+class SampleLLM:
+    """
+    Stand-in for an LLM wrapper numbering its answers, returning a list for n when native is set.
+    """
+
+    def __init__(self, native: bool):
+        self.native = native
+        self.requests = []
+
+    def __call__(self, messages: list, n: int = None, **kwargs):
+        self.requests.append(n)
+        if n is not None and self.native:
+            return [f"answer {i}" for i in range(n)]
+        return f"answer {len(self.requests)}"
+
+
+def test_sample():
+    actor = Actor(config=ActorConfig(model_name='gpt-4.1-mini'))
+    llm = SampleLLM(native=True)
+    object.__setattr__(actor, 'llm', llm)
+    assert [result['action'] for result in actor.sample('Draw a bar chart', num_samples=3)] == ['answer 0', 'answer 1', 'answer 2']
+    assert llm.requests == [3]
+
+    # A client ignoring n answers with one string: the samples are drawn with separate requests, from then on directly
+    actor = Actor(config=ActorConfig(model_name='gpt-4.1-nano'))
+    llm = SampleLLM(native=False)
+    object.__setattr__(actor, 'llm', llm)
+    try:
+        assert len(set(result['action'] for result in actor.sample('Draw a bar chart', num_samples=3))) == 3
+        assert llm.requests == [3, None, None, None] and 'gpt-4.1-nano' in N_IGNORED_MODELS
+        actor.sample('Draw a bar chart', num_samples=2)
+        assert llm.requests[4:] == [None, None]
+    finally:
+        N_IGNORED_MODELS.discard('gpt-4.1-nano')
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    test_image_budget()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_fit_image(pathlib.Path(tmp_dir))
+    test_extract_usage()
+    test_cache_layout()
+    test_stream_action()
+    test_sample()
+    print("Agent checks passed")
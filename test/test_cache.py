@@ -0,0 +1,104 @@
+import sys
+import os
+import time
+import threading
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import pytest
+from PIL import Image
+
+from agent.cache import LLMResponseCache, CachedLLM
+
+
+class EchoLLM:
+    """
+    Stand-in for an LLM wrapper, answers with the text of the last message.
+    """
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.calls = 0
+        self.kwargs = []
+        self._lock = threading.Lock()
+
+    def __call__(self, messages: list, **kwargs) -> str:
+        with self._lock:
+            self.calls += 1
+            self.kwargs.append(kwargs)
+        time.sleep(self.delay)
+        return f"echo: {messages[-1]['content']}"
+
+
+def messages(text: str, image: Image.Image = None) -> list:
+    content = text if image is None else [{'type': 'image', 'image': image}, {'type': 'text', 'text': text}]
+    return [{'role': 'user', 'content': content}]
+
+
+def test_key():
+    key = LLMResponseCache.key
+    red, blue = Image.new('RGB', (10, 10), 'red'), Image.new('RGB', (10, 10), 'blue')
+    # Images are keyed by content, whitespace and logger arguments are ignored
+    assert key('model', messages('hi', red)) == key('model', messages(' hi\n', red.copy()), run_name='run', tag='tag')
+    assert key('model', messages('hi', red)) != key('model', messages('hi', blue))
+    assert key('model', messages('hi')) != key('other model', messages('hi'))
+    assert key('model', messages('hi')) != key('model', messages('hi'), temperature=1.0)
+    assert key('model', messages('hi'), sample=0) != key('model', messages('hi'), sample=1)
+
+
+def test_read_write_and_replay(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    echo = EchoLLM()
+    cached = CachedLLM(echo, LLMResponseCache(path), 'model')
+
+    assert cached.complete_with_usage(messages('hi')) == ('echo: hi', None)
+    response, usage = cached.complete_with_usage(messages('hi'))
+    assert response == 'echo: hi' and usage['input_tokens'] == usage['output_tokens'] == 0
+    assert echo.calls == 1 and cached.cache.stats['hits'] == 1 and cached.cache.stats['misses'] == 1
+
+    # Replay serves the stored responses and never calls the model
+    replay = CachedLLM(echo, LLMResponseCache(path, mode='replay'), 'model')
+    assert replay(messages('hi')) == 'echo: hi'
+    with pytest.raises(ValueError):
+        replay(messages('new request'))
+    assert echo.calls == 1
+
+
+def test_coalescing(tmp_path):
+    echo = EchoLLM(delay=0.2)
+    cached = CachedLLM(echo, LLMResponseCache(str(tmp_path / 'cache.sqlite')), 'model')
+
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(cached(messages('hi')))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert responses == ['echo: hi'] * 4
+    assert echo.calls == 1 and cached.cache.stats['coalesced'] == 3
+    assert cached.cache.hit_rate() == 0.75
+
+
+def test_samples(tmp_path):
+    echo = EchoLLM()
+    cached = CachedLLM(echo, LLMResponseCache(str(tmp_path / 'cache.sqlite')), 'model')
+
+    # Samples of the same request are stored apart, the sample index is never sent to the model
+    for sample in (0, 1, 1):
+        assert cached(messages('hi'), sample=sample) == 'echo: hi'
+    assert echo.calls == 2 and echo.kwargs == [{}, {}]
+    assert cached.cache.stats['hits'] == 1
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    test_key()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_read_write_and_replay(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_coalescing(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_samples(pathlib.Path(tmp_dir))
+    print("Cache checks passed")
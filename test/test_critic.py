@@ -0,0 +1,176 @@
+import sys
+import os
+import threading
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from agent import CriticConfig, Critic, VisionCriticConfig, TextCriticConfig, CascadeConfig, VisionCritic, parse_critic_response, parse_failure_rate, clear_parse_stats
+from utils import split_combined_critique, split_ranking
+from test_render_checks import bar_chart
+
+
+class ScriptedLLM:
+    """
+    Stand-in for an LLM wrapper, answers every request with the same response and counts the requests.
+    """
+
+    def __init__(self, response: str):
+        self.response = response
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, messages: list, **kwargs) -> str:
+        with self._lock:
+            self.calls += 1
+        return self.response
+
+
+def critique(score: int) -> str:
+    return f"### Critique:\nThe chart scores {score}.\n### Score:\n{score}"
+
+
+def critic(vision: str = None, text: str = None, **config) -> Critic:
+    """
+    Critic on a small model, its critics answer with the given responses.
+    """
+    model_name = 'gpt-4.1-mini'
+    critic = Critic(CriticConfig(vision=VisionCriticConfig(model_name=model_name), text=TextCriticConfig(model_name=model_name), **config))
+    for agent, response in [(critic.vision_critic, vision), (critic.text_critic, text), (critic.combined_critic, vision)]:
+        if agent is not None and response is not None:
+            object.__setattr__(agent, 'llm', ScriptedLLM(response))
+    return critic
+
+
+COMBINED = """### Vision Critique:
+The bars are red as requested.
+### Vision Score:
+4
+### Code Critique:
+The code is correct.
+### Code Score:
+5
+"""
+
+
+def test_split_combined_critique():
+    sections = split_combined_critique(COMBINED)
+    assert sections['vision_critic'].startswith('### Critique:') and '### Score:\n4' in sections['vision_critic']
+    assert sections['text_critic'].startswith('### Critique:') and '### Score:\n5' in sections['text_critic']
+    assert split_combined_critique('no sections') == {'vision_critic': 'no sections', 'text_critic': 'no sections'}
+
+
+def test_combined_mode():
+    combined = critic(vision=COMBINED, mode='combined')
+    result = combined.act('Make the bars red', bar_chart(), 'plt.bar(x, y, color="red")')
+    assert result['mode'] == 'combined' and result['requests'] == 1
+    assert result['vision_critic']['score'] == 4 and result['text_critic']['score'] == 5
+    assert combined.combined_critic.llm.calls == 1
+
+    separate = critic(vision=critique(4), text=critique(5))
+    result = separate.act('Make the bars red', bar_chart(), 'plt.bar(x, y, color="red")')
+    assert result['mode'] == 'separate' and result['requests'] == 2
+    assert result['vision_critic']['score'] == 4 and result['text_critic']['score'] == 5
+
+
+def test_cascade():
+    request, image, code = 'Make the bars red', bar_chart(), 'plt.bar(x, y, color="red")'
+
+    # A failing gate skips the vision critic, which takes the gate score
+    failing = critic(vision=critique(4), text=critique(1), cascade=CascadeConfig(enabled=True))
+    result = failing.act(request, image, code)
+    assert result['cascade'] == 'skipped' and result['requests'] == 1
+    assert result['vision_critic']['skipped'] and result['vision_critic']['score'] == 1
+    assert failing.vision_critic.llm.calls == 0
+
+    # Inconclusive gate: the full vision critic runs and disagreements are counted
+    full = critic(vision=critique(1), text=critique(3), cascade=CascadeConfig(enabled=True))
+    assert full.act(request, image, code)['cascade'] == 'full'
+    assert full.cascade_rates()['disagreement_rate'] == 1.0
+
+    # A passing gate goes to the downgraded critic, escalated when it scores low
+    cascade = CascadeConfig(enabled=True, pass_above=5, downgrade_model='gpt-4.1-nano', escalate_below=3)
+    passing = critic(vision=critique(5), text=critique(5), cascade=cascade)
+    object.__setattr__(passing.downgraded_vision_critic, 'llm', ScriptedLLM(critique(5)))
+    result = passing.act(request, image, code)
+    assert result['cascade'] == 'downgraded' and result['requests'] == 2
+    assert passing.vision_critic.llm.calls == 0
+
+    object.__setattr__(passing.downgraded_vision_critic, 'llm', ScriptedLLM(critique(2)))
+    result = passing.act(request, image, code)
+    assert result['cascade'] == 'escalated' and result['requests'] == 3
+    assert result['vision_critic']['score'] == 5
+    assert passing.cascade_rates()['downgrade_rate'] == 1.0 and passing.cascade_rates()['escalation_rate'] == 0.5
+
+
+RANKING = """### Candidate 1
+### Critique:
+The bars are red.
+### Score:
+4
+### Candidate 2
+### Critique:
+The bars are still blue.
+### Score:
+1
+"""
+
+
+def test_split_ranking():
+    sections = split_ranking(RANKING, 3)
+    assert sections[0].startswith('### Critique:') and sections[0].endswith('4')
+    assert sections[1].endswith('1') and sections[2] is None
+    assert split_ranking(None, 2) == [None, None]
+
+
+def test_rank():
+    ranking = critic(vision=critique(3), text=critique(5))
+    object.__setattr__(ranking.ranking_critic, 'llm', ScriptedLLM(RANKING))
+    candidates = [bar_chart('red'), bar_chart(), bar_chart('green')]
+    results = ranking.rank('Make the bars red', bar_chart(), candidates, action_codes=['a()', 'b()', 'c()'])
+
+    # One ranking request for the candidates it scored, the missing one falls back to its own request
+    assert [result['vision_critic']['score'] for result in results] == [4, 1, 3]
+    assert [result['mode'] for result in results] == ['ranking', 'ranking', 'separate']
+    assert ranking.ranking_critic.llm.calls == 1 and ranking.vision_critic.llm.calls == 1
+    assert ranking.text_critic.llm.calls == 3
+    assert sum(result['requests'] for result in results) == 1 + 3 + 1
+
+
+def test_parse_critic_response():
+    agent = VisionCritic(VisionCriticConfig(model_name='parse-test-model'))
+    repair = ScriptedLLM('{"score": 3}')
+    object.__setattr__(agent, 'llm', repair)
+    clear_parse_stats('parse-run')
+
+    parsed = parse_critic_response(agent, critique(4), run_name='parse-run')
+    assert parsed == {'critique': 'The chart scores 4.', 'score': 4, 'parse_error': False}
+
+    # Free text: the score line is salvaged without a repair request
+    salvaged = parse_critic_response(agent, "The bars are fine.\nScore: 5", run_name='parse-run')
+    assert salvaged['score'] == 5 and not salvaged['parse_error'] and repair.calls == 0
+
+    # No score at all: one repair request
+    repaired = parse_critic_response(agent, "The chart scored 2 last time, better now.", run_name='parse-run')
+    assert repaired['score'] == 3 and repair.calls == 1
+
+    # Repair disabled: scored 0 and flagged
+    failed = parse_critic_response(agent, "Looks good.", run_name='parse-run', repair=False)
+    assert failed['score'] == 0 and failed['parse_error'] and repair.calls == 1
+
+    stats = parse_failure_rate('parse-test-model', run_name='parse-run')['parse-test-model']
+    assert (stats['parsed'], stats['repaired'], stats['failed']) == (1, 2, 1) and stats['failure_rate'] == 0.25
+
+    # The run counts start over, the process counts are kept
+    clear_parse_stats('parse-run')
+    assert parse_failure_rate(run_name='parse-run') == {}
+    assert parse_failure_rate('parse-test-model')['parse-test-model']['failed'] >= 1
+
+
+if __name__ == "__main__":
+    test_split_combined_critique()
+    test_combined_mode()
+    test_cascade()
+    test_split_ranking()
+    test_rank()
+    test_parse_critic_response()
+    print("Critic checks passed")
@@ -0,0 +1,72 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from utils import image_hash, color_thumbnail
+from pipeline.dedupe import RenderIndex, RenderKey, CodeIndex
+from test_render_checks import bar_chart
+
+
+def render_key(color: str = 'blue', code: str = 'plot()') -> RenderKey:
+    chart = bar_chart(color)
+    return RenderKey(hash=image_hash(chart), thumbnail=color_thumbnail(chart), code=code)
+
+
+def test_render_index_lookup():
+    index = RenderIndex()
+    index.add('run', render_key(), {'score': 3, 'vision_critic': {}, 'text_critic': {}})
+
+    # Same render and code: both critiques are reused
+    hit = index.lookup('run', render_key())
+    assert hit['reused'] and hit['code_match'] and hit['score'] == 3
+    # Same render, other code: only the vision critique holds
+    assert index.lookup('run', render_key(code='other()'))['code_match'] is False
+    # Recolored series, or another run: no reuse
+    assert index.lookup('run', render_key('red')) is None
+    assert index.lookup('other run', render_key()) is None
+
+    assert index.stats_of('run') == {'lookups': 3, 'hits': 2, 'critic_calls_saved': 3}
+    assert index.stats_of('other run') == {'lookups': 1, 'hits': 0, 'critic_calls_saved': 0}
+    assert index.stats['lookups'] == 4
+
+
+def test_render_index_clear():
+    index = RenderIndex()
+    index.add('run', render_key(), {'score': 3})
+    index.add('other run', render_key(), {'score': 3})
+    index.lookup('run', render_key())
+
+    # A new run under the same name starts empty, the totals are kept
+    index.clear('run')
+    assert index.lookup('run', render_key()) is None
+    assert index.stats_of('run') == {'lookups': 1, 'hits': 0, 'critic_calls_saved': 0}
+    assert index.lookup('other run', render_key()) is not None
+    assert index.stats['hits'] == 2
+
+    index.clear()
+    assert index.entries == {} and index.run_stats == {}
+
+
+def test_code_index():
+    index = CodeIndex()
+    critic_result = {'score': 3, 'requests': 2}
+    index.add('run', 'hash', {'image_file_path': 'render.png'}, critic_result)
+    assert index.lookup('other run', 'hash') is None
+
+    transition, reused = index.lookup('run', 'hash')
+    assert transition == {'image_file_path': 'render.png'} and reused['unchanged_code'] and 'reused' not in critic_result
+    index.count('run', retries=1)
+    assert index.stats_of('run')['critic_calls_saved'] == 2 and index.stats_of('run')['retries'] == 1
+
+    # A new run under the same name starts empty, the counters over every run are kept
+    index.clear('run')
+    assert index.lookup('run', 'hash') is None
+    assert index.stats_of('run')['lookups'] == 1 and index.stats['lookups'] == 3
+
+
+if __name__ == "__main__":
+    test_render_index_lookup()
+    test_render_index_clear()
+    test_code_index()
+    print("Dedupe checks passed")
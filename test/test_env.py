@@ -0,0 +1,41 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from PIL import Image
+
+from pipeline.execution.env import Env, EnvConfig
+from test_render_checks import bar_chart
+
+
+def test_postprocess_render(tmp_path):
+    env = Env(config=EnvConfig(cache_folder=str(tmp_path)))
+    render = str(tmp_path / 'render.png')
+    canvas = Image.new('RGB', (600, 450), 'white')
+    canvas.paste(bar_chart(), (200, 150))
+    canvas.save(render)
+
+    # The crop is written next to the render, which is left untouched
+    transition = env.postprocess_render({'image_file_path': render})
+    assert transition['raw_image_file_path'] == render
+    assert transition['image_file_path'] == str(tmp_path / 'render_crop.png')
+    assert 0 < transition['crop_ratio'] < 1
+    with Image.open(render) as raw, Image.open(transition['image_file_path']) as cropped:
+        assert raw.size == (600, 450)
+        assert cropped.width < 220 and cropped.height < 170
+
+    # Nothing to crop: the transition keeps the render
+    transition = env.postprocess_render({'image_file_path': transition['image_file_path']})
+    assert 'raw_image_file_path' not in transition and transition['crop_ratio'] == 1.0
+
+    env.config.autocrop = False
+    assert env.postprocess_render({'image_file_path': render}) == {'image_file_path': render}
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_postprocess_render(pathlib.Path(tmp_dir))
+    print("Env checks passed")
@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+import threading
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from agent.executor import CriticExecutor
+
+
+def test_concurrency_per_model():
+    executor = CriticExecutor(max_workers=4, max_concurrency_per_model=2)
+    lock = threading.Lock()
+    running = {'slow': 0, 'fast': 0}
+    peak = {'slow': 0, 'fast': 0}
+
+    def call(model_name: str, seconds: float) -> str:
+        with lock:
+            running[model_name] += 1
+            peak[model_name] = max(peak[model_name], running[model_name])
+        time.sleep(seconds)
+        with lock:
+            running[model_name] -= 1
+        return model_name
+
+    slow = [executor.submit('slow', call, 'slow', 0.2) for _ in range(6)]
+    time.sleep(0.05)
+    # The queued calls of the busy model hold no thread, the other model runs at once
+    fast = executor.submit('fast', call, 'fast', 0)
+    assert fast.result(timeout=0.1) == 'fast'
+    assert [future.result() for future in slow] == ['slow'] * 6
+    assert peak == {'slow': 2, 'fast': 1}
+
+    stats = executor.stats()
+    assert stats['slow']['calls'] == 6 and stats['slow']['in_flight'] == 0 and stats['slow']['queued'] == 0
+    # The last calls waited for two rounds of the slow model
+    assert max(future.timing['queue_wait'] for future in slow) > 0.3
+    assert all(future.timing['execution'] >= 0.2 for future in slow)
+
+
+def test_exception():
+    executor = CriticExecutor(max_workers=1, max_concurrency_per_model=1)
+
+    def fail():
+        raise ValueError('critic failed')
+
+    future = executor.submit('model', fail)
+    assert isinstance(future.exception(), ValueError)
+    # The slot of a failed call is released
+    assert executor.submit('model', lambda: 1).result(timeout=1) == 1
+    assert executor.stats()['model']['in_flight'] == 0
+
+
+if __name__ == "__main__":
+    test_concurrency_per_model()
+    test_exception()
+    print("Executor checks passed")
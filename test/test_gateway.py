@@ -0,0 +1,113 @@
+import sys
+import os
+import time
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import pytest
+
+from agent.gateway import (
+    ProviderLimits,
+    ProviderGateway,
+    AdaptiveLimiter,
+    TokenBucket,
+    GatewayLLM,
+    get_provider,
+    is_rate_limit_error,
+    retry_after
+)
+
+
+class RateLimitError(Exception):
+    """
+    Named like the rate limit errors of the openai and anthropic SDKs.
+    """
+
+
+class StatusError(Exception):
+    def __init__(self, message: str, status_code: int = None, headers: dict = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = type('Response', (), {'headers': headers or {}, 'status_code': status_code})()
+
+
+def test_is_rate_limit_error():
+    assert is_rate_limit_error(RateLimitError('slow down'))
+    assert is_rate_limit_error(StatusError('Too Many Requests', status_code=429))
+    # Only the status and the exception type count, not the message
+    assert not is_rate_limit_error(StatusError('Invalid request: field 429 is out of range', status_code=400))
+    assert not is_rate_limit_error(ValueError('rate limit of the chart axis exceeded'))
+    assert retry_after(StatusError('Too Many Requests', 429, {'retry-after': '2'})) == 2.0
+
+
+def test_get_provider():
+    assert get_provider('gpt-4.1-mini') == 'openai'
+    assert get_provider('gemini-2.5-flash') == 'gemini'
+    assert get_provider('nim:meta/llama-4-maverick') == 'nim'
+
+
+def test_retries():
+    gateway = ProviderGateway('test', ProviderLimits(requests_per_minute=None, tokens_per_minute=None, max_retries=2, backoff_base=0.01))
+    attempts = []
+
+    def flaky(messages: list) -> str:
+        attempts.append(messages)
+        if len(attempts) < 3:
+            raise RateLimitError('slow down')
+        return 'ok'
+
+    llm = GatewayLLM(flaky, gateway)
+    assert llm([{'role': 'user', 'content': 'hi'}]) == 'ok'
+    assert gateway.last_call()['retries'] == 2
+    assert gateway.stats['rate_limited'] == 2 and gateway.stats['requests'] == 1
+
+    # Other errors are raised at once, rate limits after max_retries
+    def broken(messages: list) -> str:
+        attempts.append(messages)
+        raise ValueError('bad request')
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        GatewayLLM(broken, gateway)([])
+    assert len(attempts) == 1
+
+    def limited(messages: list) -> str:
+        attempts.append(messages)
+        raise RateLimitError('slow down')
+
+    attempts.clear()
+    with pytest.raises(RateLimitError):
+        GatewayLLM(limited, gateway)([])
+    assert len(attempts) == 3
+    assert gateway.stats['failures'] == 2 and gateway.limiter.in_flight == 0
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(ProviderLimits(initial_concurrency=8, min_concurrency=1, max_concurrency=9, latency_target=1.0))
+    limiter.acquire()
+    limiter.release(latency=0.1)
+    assert limiter.limit == 8 + 1 / 8
+    limiter.acquire()
+    limiter.release(rate_limited=True)
+    assert limiter.limit == (8 + 1 / 8) / 2
+    limiter.acquire()
+    limiter.release(latency=2.0)
+    assert limiter.limit == (8 + 1 / 8) / 4
+
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=600)
+    assert bucket.acquire(600) == 0.0
+    start = time.perf_counter()
+    # 10 tokens per second
+    assert bucket.acquire(2) > 0
+    assert 0.1 < time.perf_counter() - start < 1.0
+
+
+if __name__ == "__main__":
+    test_is_rate_limit_error()
+    test_get_provider()
+    test_retries()
+    test_adaptive_limiter()
+    test_token_bucket()
+    print("Gateway checks passed")
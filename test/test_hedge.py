@@ -0,0 +1,88 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import time
+import threading
+
+from agent.hedge import HedgedLLM, get_latency_tracker
+
+
+class SleepyLLM:
+    """
+    Stand-in for a client answering after a delay, recording the threads it ran on.
+    """
+
+    def __init__(self, name: str, delay: float):
+        self.name = name
+        self.delay = delay
+        self.threads = []
+
+    def complete_with_usage(self, messages: list, **kwargs):
+        self.threads.append(threading.current_thread())
+        time.sleep(self.delay)
+        return self.name, {'input_tokens': 10, 'output_tokens': 5, 'cached_tokens': 0, 'cached_ratio': 0.0}
+
+    def __call__(self, messages: list, **kwargs):
+        return self.complete_with_usage(messages, **kwargs)[0]
+
+
+def warm(model_name: str, latency: float = 0.01) -> None:
+    tracker = get_latency_tracker(model_name)
+    for _ in range(20):
+        tracker.add(latency)
+
+
+def test_cold_calls_run_inline():
+    primary, hedge = SleepyLLM('primary', 0.0), SleepyLLM('hedge', 0.0)
+    llm = HedgedLLM(primary, [hedge], 'hedge-test-cold')
+    assert llm(['hi']) == 'primary'
+    # No latency observed yet: the request ran on the calling thread and nothing was hedged
+    assert primary.threads == [threading.current_thread()]
+    assert hedge.threads == [] and llm.stats['hedged'] == 0
+
+
+def test_over_budget_runs_inline():
+    warm('hedge-test-budget')
+    primary, hedge = SleepyLLM('primary', 0.0), SleepyLLM('hedge', 0.0)
+    llm = HedgedLLM(primary, [hedge], 'hedge-test-budget', budget=0.0)
+    assert llm(['hi']) == 'primary'
+    assert primary.threads == [threading.current_thread()]
+
+
+def test_hedge_wins_and_loser_is_dropped():
+    warm('hedge-test-win')
+    primary, hedge = SleepyLLM('primary', 0.3), SleepyLLM('hedge', 0.0)
+    llm = HedgedLLM(primary, [hedge], 'hedge-test-win', budget=1.0)
+
+    start = time.perf_counter()
+    response, usage = llm.complete_with_usage(['hi'])
+    assert response == 'hedge' and usage['output_tokens'] == 5
+    # The caller did not wait for the slow primary
+    assert time.perf_counter() - start < 0.25
+    assert llm.stats['hedged'] == 1 and llm.stats['hedge_wins'] == 1
+
+    # The losing request completes in the background and its tokens are counted
+    time.sleep(0.4)
+    assert llm.stats['dropped_tokens'] == 15
+
+
+def test_primary_error_falls_back_to_hedge():
+    warm('hedge-test-error')
+
+    class FailingLLM(SleepyLLM):
+        def complete_with_usage(self, messages: list, **kwargs):
+            time.sleep(self.delay)
+            raise RuntimeError('boom')
+
+    llm = HedgedLLM(FailingLLM('primary', 0.1), [SleepyLLM('hedge', 0.2)], 'hedge-test-error', budget=1.0)
+    assert llm(['hi']) == 'hedge'
+
+
+if __name__ == "__main__":
+    test_cold_calls_run_inline()
+    test_over_budget_runs_inline()
+    test_hedge_wins_and_loser_is_dropped()
+    test_primary_error_falls_back_to_hedge()
+    print("Hedge checks passed")
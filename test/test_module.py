@@ -0,0 +1,149 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from types import SimpleNamespace
+from PIL import Image
+
+from pipeline.module import Module, ModuleConfig
+from pipeline.execution.env import Env, EnvConfig
+from agent import ActorConfig, CriticConfig, VisionCriticConfig, TextCriticConfig
+from test_render_checks import bar_chart
+
+
+def module(actor: dict = None, **config) -> Module:
+    """
+    Module on a small model, the tests below never reach the LLM.
+
+    :param actor: Fields of the actor configuration.
+    """
+    model_name = 'gpt-4.1-mini'
+    return Module(ModuleConfig(
+        actor_config=ActorConfig(model_name=model_name, **(actor or {})),
+        critic_config=CriticConfig(vision=VisionCriticConfig(model_name=model_name), text=TextCriticConfig(model_name=model_name)),
+        **config
+    ))
+
+
+def test_screen_render(tmp_path):
+    screen = module().screen_render
+
+    blank = str(tmp_path / 'blank.png')
+    Image.new('RGB', (200, 150), 'white').save(blank)
+    chart = str(tmp_path / 'chart.png')
+    bar_chart().save(chart)
+
+    assert screen({'image_file_path': blank})['score'] == 0
+    assert screen({'image_file_path': str(tmp_path / 'missing.png')})['score'] == 0
+    failed = screen({'image_file_path': chart, 'error': 'NameError: plt\n'})
+    assert failed['canned'] and 'NameError: plt' in failed['vision_critic']['critique']
+    assert screen({'image_file_path': chart}) is None
+
+
+def test_screen_render_similarity(tmp_path):
+    chart = str(tmp_path / 'chart.png')
+    bar_chart().save(chart)
+    recolored = str(tmp_path / 'recolored.png')
+    bar_chart('red').save(recolored)
+
+    # An unchanged render is scored 1, the similarity is kept on the transition
+    transition = {'image_file_path': chart}
+    assert module(unchanged_similarity=0.99).screen_render(transition, image=bar_chart())['score'] == 1
+    assert transition['similarity']['score'] > 0.99
+
+    screen = module(unchanged_similarity=0.99, min_similarity=0.99).screen_render
+    assert screen({'image_file_path': recolored}, image=bar_chart())['score'] == 0
+    assert module(unchanged_similarity=0.99).screen_render({'image_file_path': recolored}, image=bar_chart()) is None
+
+
+def test_prepare_critic_image(tmp_path):
+    env = SimpleNamespace(config=SimpleNamespace(cache_folder=str(tmp_path)))
+    chart = str(tmp_path / 'chart.png')
+    bar_chart().save(chart)
+    images = [bar_chart(), str(tmp_path / 'missing.png'), chart]
+    titles = ['Input', 'Previous', 'Transition']
+
+    # Merged: one canvas, its token estimate comes from the layout
+    merged, merged_titles, merged_input = module().prepare_critic_image(env, images, titles)
+    assert isinstance(merged, Image.Image) and merged_titles is None
+    assert merged_input['mode'] == 'merged' and merged_input['image_tokens'] > 0
+
+    # Multi-image: the images are passed as they are, the missing one is dropped
+    multi_module = module()
+    multi_module.critic.config.vision.multi_image = True
+    images, image_titles, image_input = multi_module.prepare_critic_image(env, images, titles)
+    assert image_titles == ['Input', 'Transition'] and images[1] == chart
+    assert image_input['mode'] == 'multi' and image_input['compose_time'] == 0.0
+    assert image_input['merged_image_tokens'] == merged_input['image_tokens']
+    assert image_input['image_tokens_saved'] == merged_input['image_tokens'] - image_input['image_tokens']
+
+
+def test_resolve_action():
+    edits = "<<<<<<< SEARCH\nplt.bar(x, y)\n=======\nplt.bar(x, y, color='red')\n>>>>>>> REPLACE"
+    previous = "```python\nimport matplotlib.pyplot as plt\nplt.bar(x, y)\nplt.show()\n```"
+
+    # The edits are applied to the previous code, the action becomes the full program
+    actor_result = {'action': edits}
+    action, diff = module(actor={'edit_format': 'search_replace'}).resolve_action(actor_result, previous)
+    assert action == "```python\nimport matplotlib.pyplot as plt\nplt.bar(x, y, color='red')\nplt.show()\n```"
+    assert actor_result['action'] == action and actor_result['edits'] == {'raw': edits, 'applied': 1, 'failed': 0}
+    assert "-plt.bar(x, y)" in diff and "+plt.bar(x, y, color='red')" in diff
+
+    # A full program, or the full-program format, is used as it is
+    full = {'action': previous}
+    assert module(actor={'edit_format': 'search_replace'}).resolve_action(full, previous) == (previous, None)
+    assert module().resolve_action({'action': edits}, previous) == (edits, None)
+
+
+class RenderEnv(Env):
+    """
+    Environment rendering every action to the same chart, counting the renders.
+    """
+    chart: str = ''
+    steps: int = 0
+
+    def step(self, action: str, run_name: str = None, tag: str = None) -> dict:
+        self.steps += 1
+        return {'code': self.executed_code(action), 'image_file_path': self.chart}
+
+
+def test_stream_act(tmp_path):
+    chart = str(tmp_path / 'chart.png')
+    bar_chart().save(chart)
+    env = RenderEnv(config=EnvConfig(cache_folder=str(tmp_path)), chart=chart)
+    streamed = module()
+    critique = "### Critique:\nFine.\n### Score:\n4"
+    for agent in (streamed.critic.vision_critic, streamed.critic.text_critic):
+        object.__setattr__(agent, 'llm', lambda messages, **kwargs: critique)
+
+    def stream(action: str) -> list:
+        object.__setattr__(streamed.actor, 'llm', lambda messages, **kwargs: action)
+        return list(streamed.stream_act(env, 'Make the bars red', image=bar_chart('red'), run_name='stream-run'))
+
+    # The step goes through the stage graph: stage results are streamed, the timings come with the result
+    chunks = stream("```python\nplt.bar(x, y)\n```")
+    assert [chunk['status'] for chunk in chunks] == ['actor_completed', 'environment_executed', 'completed']
+    assert chunks[1]['code'].strip() == 'plt.bar(x, y)' and chunks[-1]['critic_result']['score'] == 4
+    assert 'stages' in chunks[-1] and env.steps == 1
+
+    # Code already rendered in the run is not rendered again
+    chunks = stream("Same code:\n```python\nplt.bar(x, y)\n```")
+    assert chunks[-1]['critic_result']['score'] == 4 and env.steps == 1
+
+    # An empty action stops before the render
+    chunks = stream("")
+    assert [chunk['status'] for chunk in chunks] == ['actor_completed', 'error'] and env.steps == 1
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_screen_render(pathlib.Path(tmp_dir))
+        test_screen_render_similarity(pathlib.Path(tmp_dir))
+        test_prepare_critic_image(pathlib.Path(tmp_dir))
+    test_resolve_action()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_stream_act(pathlib.Path(tmp_dir))
+    print("Module checks passed")
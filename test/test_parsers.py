@@ -0,0 +1,134 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from utils import parse_edits, apply_edits, CodeFenceParser, extract_code, parse_critique, salvage_score
+
+
+CODE = """import matplotlib.pyplot as plt
+def plot(ax, x):
+    ax.plot(x)
+plt.title('Sales')
+"""
+
+EDITS = """Change the chart type and the title:
+<<<<<<< SEARCH
+plt.title('Sales')
+=======
+plt.title('Revenue')
+>>>>>>> REPLACE
+<<<<<<< SEARCH
+    ax.plot(x)
+=======
+    ax.bar(x)
+>>>>>>> REPLACE
+"""
+
+RESPONSE = """Sketch first:
+```python
+x = 1
+```
+Final version:
+```python
+```python
+y = 2
+```
+Done.
+"""
+
+
+def test_parse_edits():
+    edits = parse_edits(EDITS)
+    assert edits == [("plt.title('Sales')", "plt.title('Revenue')"), ('    ax.plot(x)', '    ax.bar(x)')]
+    assert parse_edits('no edit here') == []
+    assert parse_edits(None) == []
+
+
+def test_apply_edits():
+    code, failed = apply_edits(CODE, parse_edits(EDITS))
+    assert failed == []
+    assert "    ax.bar(x)\n" in code and "plt.title('Revenue')" in code
+
+    # Match ignoring the trailing whitespace
+    code, failed = apply_edits(CODE, [("plt.title('Sales')   ", "plt.title('Revenue')")])
+    assert failed == [] and "plt.title('Revenue')" in code
+
+    # Match ignoring the indentation, the replacement is re-indented
+    code, failed = apply_edits(CODE, [('  ax.plot(x)', '  ax.scatter(x)')])
+    assert failed == [] and "    ax.scatter(x)\n" in code
+
+    # Unknown search block: the code is unchanged and the edit reported
+    code, failed = apply_edits(CODE, [('plt.show()', 'plt.close()')])
+    assert code == CODE and failed == [('plt.show()', 'plt.close()')]
+
+    # Empty search block appends the replacement
+    code, failed = apply_edits(CODE, [('', 'plt.show()')])
+    assert failed == [] and code.endswith("plt.title('Sales')\nplt.show()")
+
+
+def test_code_fence_parser():
+    parser = CodeFenceParser('python', tail_chars=5)
+    for char in RESPONSE:
+        parser.feed(char)
+    parser.finish()
+
+    # The last block wins, the doubled opening fence is tolerated
+    assert parser.blocks == [('python', 'x = 1'), ('python', 'y = 2')]
+    assert parser.code == 'y = 2'
+    assert parser.response() == "```python\ny = 2\n```"
+    assert parser.can_stop()
+
+    # Inside an open fence the stream cannot be cut
+    parser = CodeFenceParser('python')
+    parser.feed("```python\nx = 1\n```\n```python\ny = ")
+    assert parser.done and not parser.can_stop()
+
+    # Blocks of another language are ignored
+    parser = CodeFenceParser('python')
+    parser.feed("```html\n<div></div>\n```\n")
+    assert not parser.done and parser.code is None
+
+
+def test_extract_code():
+    assert extract_code(RESPONSE) == 'y = 2'
+    assert extract_code('no code') == 'no code'
+    assert extract_code('') == ''
+
+
+def test_parse_critique():
+    assert parse_critique("### Critique:\nGood.\n### Score:\n4") == {'critique': 'Good.', 'score': 4}
+    assert parse_critique('```json\n{"critique": "Fine", "score": 3}\n```') == {'critique': 'Fine', 'score': 3}
+    assert parse_critique('Here it is: {"critique": "Fine", "score": "5"}')['score'] == 5
+    assert parse_critique("### Critique:\nGood.\n### Score:\n\\boxed{2}")['score'] == 2
+
+    # Scores out of range or missing are not parsed
+    assert parse_critique('{"critique": "Fine", "score": 10}') is None
+    assert parse_critique("### Critique:\nGood.\n### Score:\nfour") is None
+    assert parse_critique("The chart is fine, score 4") is None
+
+
+def test_salvage_score():
+    assert salvage_score("The bars are right.\nScore: 4") == 4
+    assert salvage_score("**Final score**: 3/5") == 3
+    assert salvage_score("I would give it \\boxed{5}") == 5
+    assert salvage_score("Overall this is a 2/5 chart.") == 2
+    # The last score wins
+    assert salvage_score("Score: 1\nAfter the fix:\nScore: 4") == 4
+
+    # Prose mentions and out of range numbers are not scores
+    assert salvage_score("The previous iteration scored 2, this one is better.") is None
+    assert salvage_score("Score: 10") is None
+    assert salvage_score("\\boxed{10}") is None
+    assert salvage_score("It is 10/5") is None
+    assert salvage_score("no score here") is None
+
+
+if __name__ == "__main__":
+    test_parse_edits()
+    test_apply_edits()
+    test_code_fence_parser()
+    test_extract_code()
+    test_parse_critique()
+    test_salvage_score()
+    print("Parser checks passed")
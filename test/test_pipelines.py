@@ -0,0 +1,81 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from typing import List
+
+from pipeline.module import Module, ModuleConfig
+from pipeline.mcts import MCTSPipeline
+from pipeline.execution.env import Env, EnvConfig
+from agent import ActorConfig, CriticConfig, VisionCriticConfig, TextCriticConfig
+
+
+class ScriptedModule(Module):
+    """
+    Module whose steps return scripted scores instead of calling the actor and the critics.
+    """
+    first_score: float = 3
+    candidate_scores: List[float] = []
+    steps: int = 0
+
+    def result(self, score: float) -> dict:
+        self.steps += 1
+        return {
+            'actor_result': {'action': f"```python\nstep_{self.steps}()\n```"},
+            'critic_result': {'score': score, 'vision_critic': {'critique': 'vision'}, 'text_critic': {'critique': 'text'}},
+            'output_image': f"render_{self.steps}.png"
+        }
+
+    def act(self, env: Env, request: str, **kwargs) -> dict:
+        return self.result(self.first_score if self.steps == 0 else self.candidate_scores[0])
+
+    def propose(self, env: Env, request: str, num_candidates: int = 2, **kwargs) -> List[dict]:
+        return [self.result(score) for score in self.candidate_scores[:num_candidates]]
+
+
+def scripted_module(**fields) -> ScriptedModule:
+    model_name = 'gpt-4.1-mini'
+    module = ScriptedModule(ModuleConfig(
+        actor_config=ActorConfig(model_name=model_name),
+        critic_config=CriticConfig(vision=VisionCriticConfig(model_name=model_name), text=TextCriticConfig(model_name=model_name))
+    ))
+    for name, value in fields.items():
+        setattr(module, name, value)
+    return module
+
+
+def test_mcts_counts_one_4_per_expansion(tmp_path):
+    env = Env(config=EnvConfig(cache_folder=str(tmp_path)))
+
+    # Three candidates scoring 4 in one expansion count once: the search runs three expansions
+    module = scripted_module(candidate_scores=[4, 4, 4])
+    result = MCTSPipeline(module=module, env=env, num_candidates=3, max_iterations=10).act('Make the bars red')
+    assert module.steps == 1 + 3 * 3
+    assert result[0]['score'] >= 4 and 'dedupe' in result[0]
+
+    module = scripted_module(candidate_scores=[4])
+    MCTSPipeline(module=module, env=env, num_candidates=1, max_iterations=10).act('Make the bars red')
+    assert module.steps == 1 + 3
+
+
+def test_mcts_runs_are_apart(tmp_path):
+    env = Env(config=EnvConfig(cache_folder=str(tmp_path)))
+    module = scripted_module(candidate_scores=[4])
+    first, second = MCTSPipeline(module=module, env=env), MCTSPipeline(module=module, env=env)
+    assert first.run_name != second.run_name
+
+    # A run starting under a name forgets the code indexed by an earlier run of that name
+    module.code_index.add(first.run_name, 'hash', {'image_file_path': 'render.png'}, {'score': 4})
+    first.act('Make the bars red')
+    assert module.code_index.lookup(first.run_name, 'hash') is None
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_mcts_counts_one_4_per_expansion(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_mcts_runs_are_apart(pathlib.Path(tmp_dir))
+    print("Pipeline checks passed")
@@ -0,0 +1,58 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from agent.prompt.get_sys_prompt import PromptRegistry, get_sys_prompt
+
+
+def test_prompt_registry(tmp_path):
+    registry = PromptRegistry(check_interval=0)
+    path = str(tmp_path / 'prompt.md')
+    with open(path, 'w') as f:
+        f.write('first\n')
+
+    builds = []
+
+    def build(content: str) -> str:
+        builds.append(content)
+        return content.strip().upper()
+
+    assert registry.assemble('prompt', (path,), build) == 'FIRST'
+    assert registry.assemble('prompt', (path,), build) == 'FIRST'
+    assert builds == ['first\n']
+
+    # A changed file is read and assembled again
+    with open(path, 'w') as f:
+        f.write('second\n')
+    os.utime(path, (0, os.path.getmtime(path) + 1))
+    assert registry.read(path) == 'second\n'
+    assert registry.assemble('prompt', (path,), build) == 'SECOND'
+    assert len(builds) == 2
+
+
+def test_check_interval(tmp_path):
+    # Within the check interval the file is not looked at
+    registry = PromptRegistry(check_interval=3600)
+    path = str(tmp_path / 'prompt.md')
+    with open(path, 'w') as f:
+        f.write('first')
+    assert registry.read(path) == 'first'
+    os.remove(path)
+    assert registry.read(path) == 'first'
+
+
+def test_get_sys_prompt():
+    assert get_sys_prompt('actor') == get_sys_prompt('actor').strip() != ''
+    assert get_sys_prompt('unknown') == "You are a helpful assistant"
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_prompt_registry(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_check_interval(pathlib.Path(tmp_dir))
+    test_get_sys_prompt()
+    print("Prompt checks passed")
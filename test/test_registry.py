@@ -0,0 +1,93 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from agent.registry import PooledLLM, ClientRegistry
+from agent.usage import call_with_usage
+
+
+class StatefulLLM:
+    """
+    Stand-in for a provider wrapper keeping the usage of its last call and an SDK client.
+    """
+
+    def __init__(self, delay: float = 0.02):
+        self.client = object()
+        self.usage = None
+        self.delay = delay
+        self.busy = False
+        self.overlaps = 0
+
+    def __call__(self, messages: list, **kwargs) -> str:
+        if self.busy:
+            self.overlaps += 1
+        self.busy = True
+        text = messages[-1]['content']
+        self.usage = {'prompt_tokens': len(text), 'completion_tokens': 1}
+        time.sleep(self.delay)
+        self.busy = False
+        return text
+
+    def stream(self, messages: list, **kwargs):
+        yield from messages[-1]['content']
+
+
+def messages(text: str) -> list:
+    return [{'role': 'user', 'content': text}]
+
+
+def test_pooled_usage_per_call():
+    built = []
+
+    def build():
+        built.append(StatefulLLM())
+        return built[-1]
+
+    llm = PooledLLM(build, ('model', True, False, None))
+    texts = ['a' * n for n in range(1, 17)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda text: call_with_usage(llm, messages(text)), texts))
+
+    # Every call got the usage of its own request, no wrapper served two threads at once
+    assert all(usage['input_tokens'] == len(text) for text, (_, usage) in zip(texts, results))
+    assert [response for response, _ in results] == texts
+    assert sum(wrapper.overlaps for wrapper in built) == 0
+    assert 1 < llm.size == len(built) <= 8
+
+
+def test_pooled_stream():
+    llm = PooledLLM(StatefulLLM, ('model', True, False, None))
+    assert ''.join(llm.stream(messages('hello'))) == 'hello'
+    assert llm.size == 1 and llm(messages('again')) == 'again' and llm.size == 1
+
+
+def test_registry_shares_sdk_client():
+    registry = ClientRegistry()
+    registry.build = lambda model_name, multimodal=False, rotate=False, logger=None: SimpleNamespace(llm=StatefulLLM()) if logger else StatefulLLM()
+
+    first = registry.get('model')._checkout()
+    second = registry.get('model')._checkout()
+    logged = registry.get('model', logger='mongodb')._checkout()
+    other = registry.get('other model')._checkout()
+
+    # Wrappers are never shared, their SDK client is, also behind a message logger
+    assert first is not second
+    assert first.client is second.client is logged.llm.client
+    assert other.client is not first.client
+    assert registry.live_clients() == 2 and registry.stats['shared'] == 2
+
+    # Rotating wrappers switch clients with the key and keep their own
+    rotating = registry.get('model', rotate=True)._checkout()
+    assert rotating.client is not first.client
+
+
+if __name__ == "__main__":
+    test_pooled_usage_per_call()
+    test_pooled_stream()
+    test_registry_shares_sdk_client()
+    print("Registry checks passed")
@@ -0,0 +1,68 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from PIL import Image, ImageDraw
+
+from utils import image_hash, hamming_distance, color_thumbnail, thumbnail_distance, inspect_render, image_similarity, merge_layout, merge_images
+
+
+def bar_chart(color: str = 'blue', shift: int = 0) -> Image.Image:
+    """
+    Small synthetic bar chart.
+    """
+    image = Image.new('RGB', (200, 150), 'white')
+    draw = ImageDraw.Draw(image)
+    for i, height in enumerate([40, 80, 60, 100]):
+        draw.rectangle([20 + i * 45 + shift, 140 - height, 50 + i * 45 + shift, 140], fill=color)
+    draw.line([10, 140, 190, 140], fill='black')
+    return image
+
+
+def test_image_hash():
+    chart = bar_chart()
+    assert hamming_distance(image_hash(chart), image_hash(chart.copy())) == 0
+    assert hamming_distance(image_hash(chart), image_hash(bar_chart(shift=5))) > 0
+
+
+def test_thumbnail_catches_recolor():
+    # The grayscale hash does not see a recolored series, the color thumbnail does
+    chart, recolored = bar_chart(), bar_chart('red')
+    assert hamming_distance(image_hash(chart), image_hash(recolored)) <= 2
+    assert thumbnail_distance(color_thumbnail(chart), color_thumbnail(chart.copy())) == 0
+    assert thumbnail_distance(color_thumbnail(chart), color_thumbnail(recolored)) > 12
+
+
+def test_inspect_render():
+    blank = inspect_render(Image.new('RGB', (100, 100), 'white'))
+    assert blank['blank'] and blank['reason'] == 'uniform image'
+    assert not inspect_render(bar_chart())['blank']
+
+
+def test_image_similarity():
+    chart = bar_chart()
+    same = image_similarity(chart, chart.copy())
+    recolored = image_similarity(chart, bar_chart('red'))
+    empty = image_similarity(chart, Image.new('RGB', chart.size, 'white'))
+    assert abs(same['score'] - 1.0) < 1e-6
+    assert empty['score'] < recolored['score'] < same['score']
+
+
+def test_merge_layout():
+    # The layout is computed without drawing and matches the merged canvas
+    images = [bar_chart(), Image.new('RGB', (400, 600), 'white'), bar_chart('red')]
+    titles = ['Input', '', 'Transition']
+    layout = merge_layout([image.size for image in images], titles)
+    assert layout['cols'] == 3 and layout['title_height'] > 0
+    assert merge_images(images, titles=titles).size == layout['canvas']
+    assert merge_layout([(3200, 400)], max_width=1600)['sizes'] == [(1580, 197)]
+
+
+if __name__ == "__main__":
+    test_image_hash()
+    test_thumbnail_catches_recolor()
+    test_inspect_render()
+    test_image_similarity()
+    test_merge_layout()
+    print("Render checks passed")
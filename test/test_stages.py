@@ -0,0 +1,84 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import time
+import threading
+
+import pytest
+
+from pipeline.stages import StageGraph, get_stage_executor
+from agent.executor import get_critic_executor
+
+
+def test_stages_overlap():
+    graph = StageGraph()
+    finished = []
+    graph.add('actor', lambda: 'code')
+    graph.add('render', lambda actor: time.sleep(0.2) or f"render of {actor}", 'actor')
+    graph.add('text_critic', lambda actor: time.sleep(0.2) or f"critique of {actor}", 'actor')
+    graph.add('critic', lambda render, text_critic: (render, text_critic), 'render', 'text_critic')
+    graph.on_stage = lambda name, result: finished.append(name)
+
+    results = graph.run()
+    assert results['critic'] == ('render of code', 'critique of code')
+    assert finished[0] == 'actor' and finished[-1] == 'critic'
+    report = graph.report()
+    assert report['critical_path'][0] == 'actor' and report['critical_path'][-1] == 'critic'
+    assert report['saved'] > 0.1
+
+
+def test_failure_cancels_running_stages():
+    graph = StageGraph()
+    released = threading.Event()
+    graph.on_cancel(released.set)
+
+    def fail(actor):
+        raise ValueError('render failed')
+
+    graph.add('actor', lambda: 'code')
+    # Stands for the overlapped text critic, waiting on a request the cancel hook cancels
+    graph.add('text_critic', lambda actor: released.wait(5), 'actor')
+    graph.add('render', fail, 'actor')
+    graph.add('critic', lambda render, text_critic: None, 'render', 'text_critic')
+
+    start = time.perf_counter()
+    with pytest.raises(ValueError):
+        graph.run()
+    assert time.perf_counter() - start < 1
+    assert graph.cancelled.is_set() and released.is_set() and 'critic' not in graph.results
+
+
+def test_on_stage_can_stop_the_graph():
+    graph = StageGraph()
+    rendered = []
+
+    def on_stage(name, result):
+        if name == 'actor' and not result:
+            raise ValueError('empty action')
+
+    graph.on_stage = on_stage
+    graph.add('actor', lambda: '')
+    graph.add('render', lambda actor: rendered.append(actor), 'actor')
+    with pytest.raises(ValueError):
+        graph.run()
+    assert rendered == []
+
+
+def test_executors_keyed_by_limits():
+    assert get_stage_executor(4) is get_stage_executor(4)
+    assert get_stage_executor(4) is not get_stage_executor(8)
+    assert get_stage_executor(8)._max_workers == 8
+
+    assert get_critic_executor(4, 2) is get_critic_executor(4, 2)
+    assert get_critic_executor(4, 2) is not get_critic_executor(4, 3)
+    assert get_critic_executor(4, 3).max_concurrency_per_model == 3
+
+
+if __name__ == "__main__":
+    test_stages_overlap()
+    test_failure_cancels_running_stages()
+    test_on_stage_can_stop_the_graph()
+    test_executors_keyed_by_limits()
+    print("Stage checks passed")
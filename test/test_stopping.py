@@ -0,0 +1,133 @@
+import sys
+import os
+import json
+import time
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from pipeline.stopping import StoppingPolicy, StoppingState, get_price, learn_thresholds, get_learned_thresholds, thresholds_key
+
+
+def result(score: float, parse_error: bool = False) -> dict:
+    """
+    Iteration result with only the fields the stopping state reads.
+    """
+    return {'critic_result': {'score': score, 'parse_error': parse_error}}
+
+
+def test_target_score():
+    state = StoppingPolicy(target_score=4).start('actor', 'critic')
+    assert state.update(result(3)) is None
+    assert state.update(result(4)) == 'target_score'
+    assert state.best_index == 1 and state.best_score == 4
+
+
+def test_parse_error_never_stops_or_wins():
+    state = StoppingPolicy(target_score=4).start('actor', 'critic')
+    assert state.update(result(2)) is None
+    assert state.update(result(5, parse_error=True)) is None
+    assert state.best_index == 0 and state.best_score == 2
+
+
+def test_plateau():
+    state = StoppingPolicy(target_score=None, patience=2, min_improvement=0.5).start('actor', 'critic')
+    assert state.update(result(2)) is None
+    # Below min_improvement: no better score, a tie still becomes the best result
+    assert state.update(result(2)) is None
+    assert state.best_index == 1 and state.since_best == 1
+    assert state.update(result(2.4)) == 'plateau'
+
+
+def test_token_and_cost_budgets():
+    usage = {'gpt-4.1': {'input_tokens': 1000, 'output_tokens': 100}}
+
+    state = StoppingPolicy(target_score=None, max_tokens=2500).start('actor', 'critic')
+    assert state.update(result(1), usage) is None
+    # 2200 tokens used, a third iteration at the same cost would exceed the budget
+    assert state.update(result(1), usage) == 'token_budget'
+    assert state.tokens == 2200
+
+    input_price, output_price = get_price('gpt-4.1')
+    cost = (1000 * input_price + 100 * output_price) / 1e6
+    state = StoppingPolicy(target_score=None, max_cost=cost * 2.5).start('actor', 'critic')
+    assert state.update(result(1), usage) is None
+    assert state.update(result(1), usage) == 'cost_budget'
+
+    # Unknown models are free
+    state = StoppingPolicy(target_score=None, max_cost=0.001).start('actor', 'critic')
+    assert state.update(result(1), {'local-model': {'input_tokens': 10 ** 6, 'output_tokens': 10 ** 6}}) is None
+
+
+def test_request_target_overrides_policy():
+    state = StoppingPolicy(target_score=4).start('actor', 'critic', target_score=5)
+    assert isinstance(state, StoppingState) and state.target_score == 5
+    assert state.update(result(4)) is None
+
+
+def write_results(path, runs, actor='actor', critic='critic', environment='html', **fields):
+    """
+    Result file with one saved run per list of critic scores.
+    """
+    with open(path, 'a') as f:
+        for scores in runs:
+            f.write(json.dumps({'actor_model': actor, 'critic_model': critic, 'environment': environment,
+                                'critic_score': max(scores), 'first_critic_score': scores[0],
+                                'number_iter': len(scores), 'critic_scores': scores, **fields}) + '\n')
+
+
+def test_learned_plateau(tmp_path):
+    # Runs improve from 2 and 3, never from 3.5: the plateau is 3.5, below the default target
+    runs = [[2, 3, 3.5, 3.5, 3.5]] * 10 + [[3, 3.5, 3.5]] * 10
+    write_results(tmp_path / 'iterative_actor_critic_html_eval.jsonl', runs)
+    thresholds = learn_thresholds(str(tmp_path), min_samples=20)[thresholds_key('actor', 'critic', 'html', 'iterative')]
+    assert thresholds.target_score == 3.5
+    assert thresholds.patience == 1 and thresholds.samples == 20
+    assert thresholds.improvement_rate == 1.0
+
+    # Runs that keep improving have no plateau below the default target, and the patience covers the waits
+    runs = [[1, 1, 2, 2, 3, 3, 4]] * 20
+    write_results(tmp_path / 'mcts_actor_critic_html_eval.jsonl', runs)
+    thresholds = learn_thresholds(str(tmp_path), min_samples=20)[thresholds_key('actor', 'critic', 'html', 'mcts')]
+    assert thresholds.target_score == 4 and thresholds.patience == 2
+
+
+def test_learned_thresholds_per_pipeline_file(tmp_path):
+    # The file prefix keeps the iterative and MCTS results apart
+    write_results(tmp_path / 'iterative_actor_critic_html_eval.jsonl', [[3, 3, 3]] * 20)
+    write_results(tmp_path / 'mcts_actor_critic_html_eval.jsonl', [[4]] * 5)
+    thresholds = learn_thresholds(str(tmp_path), min_samples=20)
+    assert set(thresholds) == {thresholds_key('actor', 'critic', 'html', 'iterative')}
+    assert thresholds[thresholds_key('actor', 'critic', 'html', 'iterative')].target_score == 3
+
+    state = StoppingPolicy(target_score=4, learn_thresholds=True, results_dir=str(tmp_path)).start('actor', 'critic', 'html', 'iterative')
+    assert state.target_score == 3 and state.patience == 1
+    state = StoppingPolicy(target_score=4, learn_thresholds=True, results_dir=str(tmp_path)).start('actor', 'critic', 'html', 'mcts')
+    assert state.target_score == 4 and state.patience is None
+
+
+def test_learned_thresholds_follow_new_results(tmp_path):
+    assert get_learned_thresholds(str(tmp_path)) == {}
+    path = tmp_path / 'iterative_actor_critic_html_eval.jsonl'
+    write_results(path, [[3, 3, 3]] * 20)
+    assert get_learned_thresholds(str(tmp_path))[thresholds_key('actor', 'critic', 'html', 'iterative')].target_score == 3
+
+    # Cached while the files are unchanged, learned again once a result is saved
+    cached = get_learned_thresholds(str(tmp_path))
+    assert get_learned_thresholds(str(tmp_path)) is cached
+    write_results(path, [[1, 2, 3, 4]] * 40)
+    os.utime(path, (time.time() + 1, time.time() + 1))
+    assert get_learned_thresholds(str(tmp_path))[thresholds_key('actor', 'critic', 'html', 'iterative')].samples == 60
+
+
+if __name__ == "__main__":
+    test_target_score()
+    test_parse_error_never_stops_or_wins()
+    test_plateau()
+    test_token_and_cost_budgets()
+    test_request_target_overrides_policy()
+    import tempfile
+    import pathlib
+    for test in (test_learned_plateau, test_learned_thresholds_per_pipeline_file, test_learned_thresholds_follow_new_results):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("Stopping checks passed")
@@ -0,0 +1,72 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import json
+
+from agent import Agent, AgentConfig, Telemetry, TELEMETRY
+
+
+def test_record_and_summary():
+    telemetry = Telemetry()
+    telemetry.record('actor', 'model', latency=1.0)
+    assert telemetry.summary() == {}
+
+    telemetry.configure(enabled=True)
+    telemetry.record('actor', 'model', latency=1.0, input_tokens=100, retries=None)
+    telemetry.record('actor', 'model', latency=3.0, input_tokens=300)
+    summary = telemetry.summary()['actor/model']
+    assert summary['calls'] == 2 and summary['latency']['mean'] == 2.0
+    assert summary['input_tokens']['sum'] == 400 and 'retries' not in summary
+
+
+def test_prometheus_escapes_labels():
+    telemetry = Telemetry()
+    telemetry.configure(enabled=True)
+    telemetry.record('critic "vision"', 'nim:meta\\llama\n', latency=0.7)
+    text = telemetry.prometheus()
+    assert 'agent_calls_total{agent="critic \\"vision\\"",model="nim:meta\\\\llama\\n"} 1' in text
+    assert 'agent_latency_bucket{agent="critic \\"vision\\"",model="nim:meta\\\\llama\\n",le="1"} 1' in text
+    assert all(line.count('"') % 2 == 0 for line in text.splitlines())
+
+
+def test_jsonl_flush(tmp_path):
+    path = str(tmp_path / 'calls.jsonl')
+    telemetry = Telemetry()
+    telemetry.configure(enabled=True, jsonl_path=path, flush_interval=3600)
+    telemetry.record('router', 'model', run_name='run', latency=0.5)
+    telemetry.configure(enabled=False)
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records[0]['agent'] == 'router' and records[0]['run_name'] == 'run'
+
+
+def test_config_toggle():
+    # Off unless an agent asks for it, then every call records the gateway queue time and retries
+    TELEMETRY.reset()
+    Agent(AgentConfig(name='Quiet Agent', model_name='telemetry-model'))
+    assert not TELEMETRY.enabled
+
+    agent = Agent(AgentConfig(name='Telemetry Agent', model_name='telemetry-model', telemetry=True))
+    try:
+        assert TELEMETRY.enabled
+        agent.call_llm([{'role': 'system', 'content': 'system'}, {'role': 'user', 'content': 'hi'}], tag='test')
+        summary = TELEMETRY.summary()['Telemetry Agent/telemetry-model']
+        assert summary['calls'] == 1
+        assert summary['queue_time']['count'] == 1 and summary['retries']['count'] == 1
+    finally:
+        TELEMETRY.configure(enabled=False)
+        TELEMETRY.reset()
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    test_record_and_summary()
+    test_prometheus_escapes_labels()
+    with tempfile.TemporaryDirectory() as tmp:
+        test_jsonl_flush(Path(tmp))
+    test_config_toggle()
+    print("Telemetry checks passed")
@@ -0,0 +1,104 @@
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+import json
+import time
+import threading
+
+from agent.tracing import TRACER, traced, trace_run
+from pipeline.stages import StageGraph
+
+
+class Worker:
+    model_name = 'worker-model'
+
+    @traced('worker.work', 'test')
+    def work(self, seconds: float, run_name: str = None, tag: str = None) -> float:
+        time.sleep(seconds)
+        return seconds
+
+
+def load(path: str) -> tuple:
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    threads = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+    return spans, threads
+
+
+def test_traced_arguments(tmp_path):
+    worker = Worker()
+    path = str(tmp_path / 'trace.json')
+    with trace_run('traced-run', path):
+        worker.work(0.0, 'traced-run', 'positional')
+        worker.work(0.0, run_name='traced-run', tag='keyword')
+        worker.work(0.0)
+        worker.work(0.0, run_name='other-run')
+
+    spans, _ = load(path)
+    work = [span for span in spans if span['name'] == 'worker.work']
+    assert [span['args']['tag'] for span in work] == ['positional', 'keyword']
+    assert all(span['args']['model'] == 'worker-model' for span in work)
+
+
+def test_spans_nest_per_thread(tmp_path):
+    worker = Worker()
+    path = str(tmp_path / 'trace.json')
+    with trace_run('nested-run', path):
+        graph = StageGraph(run_name='nested-run', max_workers=4)
+        graph.add('actor', lambda: worker.work(0.02, run_name='nested-run', tag='actor'))
+        graph.add('render', lambda actor: worker.work(0.05, run_name='nested-run', tag='render'), 'actor')
+        graph.add('text_critic', lambda actor: worker.work(0.05, run_name='nested-run', tag='text'), 'actor')
+        graph.run()
+
+        # Threads started one after the other may get the same OS ident, never the same row
+        for _ in range(2):
+            thread = threading.Thread(target=worker.work, args=(0.0,), kwargs={'run_name': 'nested-run', 'tag': 'short'})
+            thread.start()
+            thread.join()
+
+    spans, threads = load(path)
+    by_tid = {}
+    for span in spans:
+        by_tid.setdefault(span['tid'], []).append(span)
+
+    # On every row, two spans are either disjoint or one holds the other
+    for row in by_tid.values():
+        for a in row:
+            for b in row:
+                a_end, b_end = a['ts'] + a['dur'], b['ts'] + b['dur']
+                assert a_end <= b['ts'] or b_end <= a['ts'] or (a['ts'] <= b['ts'] and b_end <= a_end) or (b['ts'] <= a['ts'] and a_end <= b_end)
+
+    # Each work span runs inside the stage span of its own thread
+    for span in spans:
+        if span['name'] == 'worker.work' and span['args']['tag'] != 'short':
+            stage = [other for other in by_tid[span['tid']] if other['name'].startswith('stage.')]
+            assert stage and threads[span['tid']].startswith('stage')
+
+    short = [span['tid'] for span in spans if span['args'].get('tag') == 'short']
+    assert len(set(short)) == 2
+    assert all(tid in threads for tid in by_tid)
+
+
+def test_nested_runs_export_once(tmp_path):
+    outer, inner = str(tmp_path / 'outer.json'), str(tmp_path / 'inner.json')
+    with trace_run('shared-run', outer):
+        with trace_run('shared-run', inner):
+            Worker().work(0.0, run_name='shared-run', tag='inner')
+        # The inner block left the run open
+        assert TRACER.enabled('shared-run')
+    assert not os.path.exists(inner) and not TRACER.enabled('shared-run')
+    spans, _ = load(outer)
+    assert [span['args'].get('tag') for span in spans if span['name'] == 'worker.work'] == ['inner']
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_traced_arguments(pathlib.Path(tmp_dir))
+        test_spans_nest_per_thread(pathlib.Path(tmp_dir))
+        test_nested_runs_export_once(pathlib.Path(tmp_dir))
+    print("Tracing checks passed")
@@ -1,3 +1,4 @@
+import os
 from pydantic import BaseModel, Field
 from typing import Generator
 
@@ -8,8 +9,12 @@ from pipeline.execution import Env
 from pipeline.module import Module, ModuleConfig
 from pipeline.iterative import IterativePipeline
 from agent import (
+    traced,
+    trace_run,
     ActorConfig,
     Actor,
+    AgentConfig,
+    Agent,
     CriticConfig,
     TextCriticConfig,
     VisionCriticConfig
@@ -18,17 +23,27 @@ from pipeline.execution import HtmlEnv, HtmlEnvConfig, PythonEnv, PythonEnvConfi
 import logging
 
 from utils import open_image
-from llm import get_llm_wrapper
 from llm.llm_utils import get_json_from_text_response
 
+
+class RouterConfig(AgentConfig):
+    """
+    Configuration for the router agent.
+    """
+    name: str = Field(default='Router Agent', description="Purpose of the agent")
+    module_name: str = 'router'
+
+
 class Router(BaseModel):
     model_config = {"arbitrary_types_allowed": True}
     model_name: str = "gpt-4.1-mini"
-    llm: any = Field(default_factory=lambda: get_llm_wrapper("gpt-4.1-mini"))
+    # Calls go through Agent.call_llm, like the pipeline agents: shared client, gateway, usage and telemetry
+    agent: Agent = None
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.llm = get_llm_wrapper(self.model_name)
+        if self.agent is None:
+            self.agent = Agent(RouterConfig(model_name=self.model_name))
 
     @staticmethod
     def __flatten_response(messages: list[str]) -> str:
@@ -41,9 +56,12 @@ class Router(BaseModel):
         return text.strip()
 
 
-    def router(self, request: str, last_response: list[dict], image: Image.Image = None) -> str:
+    @traced('router', 'router')
+    def router(self, request: str, last_response: list[dict], image: Image.Image = None, run_name: str = None) -> str:
         """
         Route the request to the appropriate agent based on the content of the request.
+
+        :param run_name: Run the request belongs to, for the message logger and the trace.
         """
 #         system_prompt = """
 # You are a routing agent, and based on the user's request and previous responses, you will determine which agent should handle the request.
@@ -138,7 +156,7 @@ Maintain the task as user's language for SQL's task.
                 }
             ]
 
-        response = self.llm(messages)
+        response, _ = self.agent.call_llm(messages, run_name=run_name, tag='router')
 
         try:
             response_json = get_json_from_text_response(response, new_method=True)
@@ -184,152 +202,157 @@ class Text2Chart(BaseModel):
         """
         Process a single request and return the response.
         """
+        # Router, SQL agent, actor and environment spans are traced when the pipeline traces
+        run_name = f"Text2Chart_{self.router.model_name}"
+        with trace_run(run_name, os.path.join(self.iterative_pipeline.trace_dir, run_name, 'trace.json'), self.iterative_pipeline.trace):
+            last_response = self.prev_requests[:-4].copy()
 
-        last_response = self.prev_requests[:-4].copy()
+            if not image:
+                image = self.images[-1] if self.images else None
 
-        if not image:
-            image = self.images[-1] if self.images else None
-
-        # Route the request
-        routing_result = self.router.router(request, last_response, image)
-        agent = routing_result.get("agent", "Pass")
-        task = routing_result.get("task", "")
-
-        yield {
-            'type': 'text',
-            "status": "routing",
-            "message": f"Routing request to agent: {agent} with task: {task}"
-        }
-
-        if agent == "Pass":
+            # Route the request
+            routing_result = self.router.router(request, last_response, image, run_name=run_name)
+            agent = routing_result.get("agent", "Pass")
+            task = routing_result.get("task", "")
 
             yield {
                 'type': 'text',
-                "status": "pass",
-                "message": "Request passed to the next agent or no action taken."
+                "status": "routing",
+                "message": f"Routing request to agent: {agent} with task: {task}"
             }
 
-            return
+            if agent == "Pass":
+
+                yield {
+                    'type': 'text',
+                    "status": "pass",
+                    "message": "Request passed to the next agent or no action taken."
+                }
 
-        if agent == "SQL":
-            # Use SQL Agent to generate SQL query
-            table = self.sql_agent.generate_sql(self.sql_agent.db, task, to_markdown=True)
+                return
 
-            yield {
-                'type': 'table',
-                "status": "table",
-                "message": "SQL query generated successfully.",
-                "content": table
-            }
+            if agent == "SQL":
+                # Use SQL Agent to generate SQL query
+                table = self.sql_agent.generate_sql(self.sql_agent.db, task, to_markdown=True, run_name=run_name)
 
-            request += f"\n\n### SQL Query Result:\n{table}\n"
+                yield {
+                    'type': 'table',
+                    "status": "table",
+                    "message": "SQL query generated successfully.",
+                    "content": table
+                }
 
+                request += f"\n\n### SQL Query Result:\n{table}\n"
 
 
-        if len(self.prev_requests) != 0:
-            temp_request = '### Previous Request:\n' + self.prev_requests[-1] + '\n' + request
-        else:
-            temp_request = request
-        self.prev_requests.append(request)
 
-        action = self.actor.act(
-            request=temp_request,
-            image=image,
-            run_name=f"Text2Chart_{self.router.model_name}",
-            tag="single_text2chart"
-        )
+            if len(self.prev_requests) != 0:
+                temp_request = '### Previous Request:\n' + self.prev_requests[-1] + '\n' + request
+            else:
+                temp_request = request
+            self.prev_requests.append(request)
 
-        print(f"Action generated by actor: {action}")
+            action = self.actor.act(
+                request=temp_request,
+                image=image,
+                run_name=run_name,
+                tag="single_text2chart"
+            )
 
-        action = action['action']
-        if not action:
-            yield {
-                'type': 'text',
-                "status": "error",
-                "message": "No action generated by the actor."
-            }
-            return
+            print(f"Action generated by actor: {action}")
+
+            action = action['action']
+            if not action:
+                yield {
+                    'type': 'text',
+                    "status": "error",
+                    "message": "No action generated by the actor."
+                }
+                return
         
-        transition = self.env.step(
-            action=action,
-            run_name=f"Text2Chart_{self.router.model_name}",
-            tag="single_text2chart"
-        )
+            transition = self.env.step(
+                action=action,
+                run_name=run_name,
+                tag="single_text2chart"
+            )
 
-        self.images.append(open_image(transition.get('image_file_path', None)))
+            self.images.append(open_image(transition.get('image_file_path', None)))
 
-        yield {
-            'type': 'code',
-            'code': action,
-            'language': self.actor.config.code,
-            'status': 'completed',
-            'image_file_path': transition.get('image_file_path', None),
-            'message': "Action executed successfully.",
-        }
+            yield {
+                'type': 'code',
+                'code': action,
+                'language': self.actor.config.code,
+                'status': 'completed',
+                'image_file_path': transition.get('image_file_path', None),
+                'message': "Action executed successfully.",
+            }
 
 
     def process_request(self, request: str, image: Image.Image = None) -> Generator[dict, None, None]:
         """
         Process a request and return the response.
         """
-        last_request = self.prev_requests[:-4].copy()
-
-        if not image:
-            image = self.images[-1] if self.images else None
-
-        # Route the request
-        routing_result = self.router.router(request, last_request, image)
-        agent = routing_result.get("agent", "Pass")
-        task = routing_result.get("task", "")
+        # The routing and SQL spans go to the trace of the streamed pipeline run
+        run_name = self.iterative_pipeline.run_name
+        with trace_run(run_name, os.path.join(self.iterative_pipeline.trace_dir, run_name, 'trace.json'), self.iterative_pipeline.trace):
+            last_request = self.prev_requests[:-4].copy()
+
+            if not image:
+                image = self.images[-1] if self.images else None
+
+            # Route the request
+            routing_result = self.router.router(request, last_request, image, run_name=run_name)
+            agent = routing_result.get("agent", "Pass")
+            task = routing_result.get("task", "")
         
-        # agent = "SQL"
-        # task = last_request + " " + request
+            # agent = "SQL"
+            # task = last_request + " " + request
 
-        if agent == "Pass":
+            if agent == "Pass":
 
-            yield {
-                'type': 'text',
-                "status": "pass",
-                "message": "Request passed to the next agent or no action taken."
-            }
+                yield {
+                    'type': 'text',
+                    "status": "pass",
+                    "message": "Request passed to the next agent or no action taken."
+                }
 
-            return
+                return
 
-        if agent == "SQL":
-            # Use SQL Agent to generate SQL query
-            table = self.sql_agent.generate_sql(self.sql_agent.db, task, to_markdown=True)
+            if agent == "SQL":
+                # Use SQL Agent to generate SQL query
+                table = self.sql_agent.generate_sql(self.sql_agent.db, task, to_markdown=True, run_name=run_name)
 
-            if self.debug:
-                print(f"Generated SQL query:\n{table}")
+                if self.debug:
+                    print(f"Generated SQL query:\n{table}")
 
-            yield {
-                'type': 'table',
-                "status": "table",
-                "message": "SQL query generated successfully.",
-                "content": table
-            }
+                yield {
+                    'type': 'table',
+                    "status": "table",
+                    "message": "SQL query generated successfully.",
+                    "content": table
+                }
 
-            request += f"\n\n### SQL Query Result:\n{table}\n"
+                request += f"\n\n### SQL Query Result:\n{table}\n"
 
 
 
-        if len(self.prev_requests) != 0:
-            temp_request = '### Previous Request:\n' + self.prev_requests[-1] + '\n' + request
-        else:
-            temp_request = request
+            if len(self.prev_requests) != 0:
+                temp_request = '### Previous Request:\n' + self.prev_requests[-1] + '\n' + request
+            else:
+                temp_request = request
 
-        if self.debug:
-            logging.debug(f"Processing request: {temp_request}")
+            if self.debug:
+                logging.debug(f"Processing request: {temp_request}")
 
-        self.prev_requests.append(request)
+            self.prev_requests.append(request)
 
-        image_generator = self.iterative_pipeline.stream_act(
-            request=temp_request,
-            image=image,
-        )
+            image_generator = self.iterative_pipeline.stream_act(
+                request=temp_request,
+                image=image,
+            )
 
-        for chunk in image_generator:
-            yield chunk
+            for chunk in image_generator:
+                yield chunk
 
 
 
@@ -6,7 +6,8 @@ sys.path.append(os.path.join(current_dir, '..'))
 
 from text2sql.postgres_utils import PostgresDB
 from text2sql.text2sql_utils import TIR_reasoning, df_to_markdown
-from llm import get_llm_wrapper, get_rotate_llm_wrapper
+from agent.base import AgentConfig, Agent
+from agent.tracing import traced
 
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -25,20 +26,33 @@ You must generate/regenerate SQL
 
 
 
+class SQLAgentConfig(AgentConfig):
+    """
+    Configuration for the SQL agent.
+    """
+    name: str = Field(default='SQL Agent', description="Purpose of the agent")
+    module_name: str = 'sql_agent'
+
+
 class SQLAgent(BaseModel):
     model_config = {"arbitrary_types_allowed": True}
     db: PostgresDB = Field(default_factory=PostgresDB)
     model_name: str = "gpt-4.1-mini"
-    llm: Optional[any] = None  # Placeholder for LLM wrapper
+    # Calls go through Agent.call_llm, like the pipeline agents: shared client, gateway, usage and telemetry
+    agent: Optional[Agent] = None
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.llm = get_llm_wrapper(self.model_name)
+        if self.agent is None:
+            self.agent = Agent(SQLAgentConfig(model_name=self.model_name))
 
 
-    def generate_sql(self, db: PostgresDB, question: str, previous_query: str = None, to_markdown: bool = False) -> str:
+    @traced('sql_agent', 'sql_agent')
+    def generate_sql(self, db: PostgresDB, question: str, previous_query: str = None, to_markdown: bool = False, run_name: str = None) -> str:
         """
         Generate a SQL query based on the user's question.
+
+        :param run_name: Run the request belongs to, for the message logger and the trace.
         """
         schema = self.db.get_schema()
         prompt_with_schema = prompt.format(schema=schema)
@@ -51,7 +65,7 @@ class SQLAgent(BaseModel):
             {"role": "user", "content": question}
         ]
 
-        response = self.llm(messages)
+        response, _ = self.agent.call_llm(messages, run_name=run_name, tag='sql_agent')
 
         print("LLM Response:", response)
 
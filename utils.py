@@ -1,9 +1,14 @@
-from typing import Union
+from typing import Union, Optional
 from PIL import Image, ImageDraw, ImageFont
 import os
+import re
+import json
+import hashlib
+import difflib
 import sys 
 import time
 import threading
+import numpy as np
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -86,6 +91,210 @@ def extract_critique_and_score(raw_response: str) -> dict:
 
 
 
+def _score_value(value) -> Optional[int]:
+    """
+    Score between 0 and 5 from a number or a numeric string, None if it is not one.
+    """
+    try:
+        score = float(str(value).strip().strip('*').strip())
+    except (TypeError, ValueError):
+        return None
+    if not 0 <= score <= 5:
+        return None
+    return int(round(score))
+
+
+def parse_critique(raw_response: str) -> Optional[dict]:
+    """
+    Strict parser of a critic response: a JSON object with 'critique' and 'score', or the
+    '### Critique' / '### Score' format with a numeric score.
+
+    :param raw_response: The raw response string.
+    :return: A dictionary containing the critique and score, None if the response does not follow either format.
+    """
+    text = raw_response.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[-1].rsplit('```', 1)[0].strip()
+
+    candidates = [text]
+    match = re.search(r'\{.*\}', text, re.DOTALL)
+    if match is not None and match.group(0) != text:
+        candidates.append(match.group(0))
+    for candidate in candidates:
+        if not candidate.startswith('{'):
+            continue
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, dict) and _score_value(data.get('score')) is not None:
+            return {'critique': str(data.get('critique', '')).strip(), 'score': _score_value(data['score'])}
+
+    if '### Critique' in raw_response and '### Score' in raw_response:
+        score = raw_response.split('### Score')[1].strip().lstrip(':').strip()
+        if '\\boxed{' in score:
+            score = score.split('\\boxed{')[1].split('}')[0]
+        else:
+            score = score.split('\n')[0]
+        if _score_value(score) is not None:
+            return {'critique': extract_critique_and_score(raw_response)['critique'], 'score': _score_value(score)}
+
+    return None
+
+
+def salvage_score(raw_response: str) -> Optional[int]:
+    """
+    Find the score of a critic response that does not follow the expected format:
+    "\\boxed{4}", a line holding only the score such as "Score: 4" or "**Final score**: 3/5",
+    or a score out of 5 such as "3/5". The last match wins.
+
+    Scores mentioned in the prose ("the previous iteration scored 2") are not taken, and
+    numbers outside 0-5 ("Score: 10") are rejected rather than cut to their first digit.
+
+    :return: The score, None if no score is found.
+    """
+    patterns = [
+        r'\\boxed\{\s*(\d+(?:\.\d+)?)\s*\}',
+        r'^[#*\s]*(?:final\s+|overall\s+)?score[*\s]*[:=-]?[*\s]*(\d+(?:\.\d+)?)(?:\s*/\s*5)?[*.\s]*$',
+        r'(?<![\d.])(\d+(?:\.\d+)?)\s*/\s*5(?![\d.])',
+    ]
+    for pattern in patterns:
+        matches = re.findall(pattern, raw_response, re.IGNORECASE | re.MULTILINE)
+        for match in reversed(matches):
+            score = _score_value(match)
+            if score is not None:
+                return score
+    return None
+
+
+def split_combined_critique(raw_response: str) -> dict:
+    """
+    Split the raw response of the combined critic into a vision and a code section, each in
+    the '### Critique' / '### Score' format so that it goes through the usual critic parsing.
+
+    :param raw_response: The raw response string, with Vision and Code sections.
+    :return: A dictionary with the 'vision_critic' and 'text_critic' sections, the whole response for both when it has no sections.
+    """
+    if '### Vision Critique' in raw_response and '### Code Critique' in raw_response:
+        vision_part, code_part = raw_response.split('### Code Critique', 1)
+        return {
+            'vision_critic': vision_part.replace('### Vision Critique', '### Critique', 1).replace('### Vision Score', '### Score', 1),
+            'text_critic': '### Critique' + code_part.replace('### Code Score', '### Score', 1)
+        }
+    return {'vision_critic': raw_response, 'text_critic': raw_response}
+
+
+def split_ranking(raw_response: str, num_candidates: int) -> list:
+    """
+    Split the raw response of the ranking critic into the section of each candidate.
+
+    :param raw_response: The raw response string, with one '### Candidate i' section per candidate.
+    :param num_candidates: Number of candidates sent.
+    :return: List with the section of each candidate, None for the candidates missing from the response.
+    """
+    sections = [None] * num_candidates
+    for section in re.split(r'###\s*Candidate\s+', raw_response or '')[1:]:
+        match = re.match(r'(\d+)', section)
+        if match is None:
+            continue
+        index = int(match.group(1)) - 1
+        if 0 <= index < num_candidates:
+            sections[index] = section[match.end():].strip()
+    return sections
+
+
+def _title_font():
+    """
+    Font used for the titles of merged images.
+    """
+    try:
+        return ImageFont.truetype("arial.ttf", 36)
+    except:
+        return ImageFont.load_default()
+
+
+def merge_layout(
+    sizes: list[tuple[int, int]],
+    titles: list[str] = None,
+    rows: int = 1,
+    padding: int = 10,
+    max_width: int = 1600,
+    max_height: int = 800,
+    font = None
+) -> dict:
+    """
+    Compute the layout of merged images without touching any pixel.
+
+    :param sizes: List of (width, height) of the images to merge.
+    :param titles: Optional list of titles for each image.
+    :param rows: Number of rows to arrange the images in.
+    :param padding: Padding between images in pixels.
+    :param max_width: Maximum width of the output image.
+    :param max_height: Maximum height of the output image.
+    :param font: Font of the titles, defaults to the merge_images font.
+    :return: A dictionary with the number of columns, the title height, the resized image sizes and the canvas size.
+    """
+    if titles is None:
+        titles = [""] * len(sizes)
+    if font is None:
+        font = _title_font()
+
+    # Calculate layout
+    cols = (len(sizes) + rows - 1) // rows
+    
+    # Calculate title heights
+    title_heights = []
+    for title in titles:
+        if title:
+            # Create a temporary image to measure text dimensions
+            temp = Image.new('RGB', (1, 1))
+            draw = ImageDraw.Draw(temp)
+            bbox = draw.textbbox((0, 0), title, font=font)
+            title_heights.append(bbox[3] - bbox[1] + 10)  # Add some extra padding
+        else:
+            title_heights.append(0)
+    
+    max_title_height = max(title_heights) if title_heights else 0
+    
+    # First, calculate what size each image should be to fit within constraints
+    # Available space for images (excluding padding and titles)
+    available_width = max_width - (padding * (cols + 1))
+    available_height = max_height - (padding * (rows + 1)) - (max_title_height * rows)
+    
+    # Calculate maximum cell size
+    max_cell_width = available_width // cols
+    max_cell_height = available_height // rows
+    
+    # Fit all images within the cell size while maintaining aspect ratio
+    resized_sizes = []
+    for width, height in sizes:
+        # Calculate scale factor to fit within cell
+        scale_w = max_cell_width / width
+        scale_h = max_cell_height / height
+        scale = min(scale_w, scale_h, 1.0)  # Don't upscale, only downscale
+        
+        if scale < 1.0:
+            resized_sizes.append((int(width * scale), int(height * scale)))
+        else:
+            resized_sizes.append((width, height))
+    
+    # Find the actual dimensions needed
+    max_img_width = max(width for width, _ in resized_sizes)
+    max_img_height = max(height for _, height in resized_sizes)
+    
+    # Calculate final canvas size
+    canvas_width = cols * max_img_width + (cols + 1) * padding
+    canvas_height = rows * (max_img_height + max_title_height) + (rows + 1) * padding
+
+    return {
+        'cols': cols,
+        'title_height': max_title_height,
+        'sizes': resized_sizes,
+        'cell': (max_img_width, max_img_height),
+        'canvas': (canvas_width, canvas_height)
+    }
+
+
 def merge_images(
     images: list[Union[str, Image.Image]], 
     titles: list[str] = None,
@@ -134,61 +343,21 @@ def merge_images(
         titles = titles + [""] * (len(images) - len(titles))
     
     # Load font for titles
-    try:
-        font = ImageFont.truetype("arial.ttf", 36)
-    except:
-        font = ImageFont.load_default()
+    font = _title_font()
     
-    # Calculate layout
-    cols = (len(images) + rows - 1) // rows
+    layout = merge_layout([img.size for img in images], titles, rows, padding, max_width, max_height, font)
+    cols = layout['cols']
+    max_title_height = layout['title_height']
+    max_img_width, max_img_height = layout['cell']
+    canvas_width, canvas_height = layout['canvas']
     
-    # Calculate title heights
-    title_heights = []
-    for title in titles:
-        if title:
-            # Create a temporary image to measure text dimensions
-            temp = Image.new('RGB', (1, 1))
-            draw = ImageDraw.Draw(temp)
-            bbox = draw.textbbox((0, 0), title, font=font)
-            title_heights.append(bbox[3] - bbox[1] + 10)  # Add some extra padding
-        else:
-            title_heights.append(0)
-    
-    max_title_height = max(title_heights) if title_heights else 0
-    
-    # First, calculate what size each image should be to fit within constraints
-    # Available space for images (excluding padding and titles)
-    available_width = max_width - (padding * (cols + 1))
-    available_height = max_height - (padding * (rows + 1)) - (max_title_height * rows)
-    
-    # Calculate maximum cell size
-    max_cell_width = available_width // cols
-    max_cell_height = available_height // rows
-    
-    # Resize all images to fit within the cell size while maintaining aspect ratio
+    # Resize all images to their cell size
     resized_images = []
-    for img in images:
-        # Calculate scale factor to fit within cell
-        scale_w = max_cell_width / img.width
-        scale_h = max_cell_height / img.height
-        scale = min(scale_w, scale_h, 1.0)  # Don't upscale, only downscale
-        
-        if scale < 1.0:
-            new_width = int(img.width * scale)
-            new_height = int(img.height * scale)
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+    for img, size in zip(images, layout['sizes']):
+        if size != img.size:
+            resized_images.append(img.resize(size, Image.LANCZOS))
         else:
-            resized_img = img.copy()
-        
-        resized_images.append(resized_img)
-    
-    # Find the actual dimensions needed
-    max_img_width = max(img.width for img in resized_images)
-    max_img_height = max(img.height for img in resized_images)
-    
-    # Calculate final canvas size
-    canvas_width = cols * max_img_width + (cols + 1) * padding
-    canvas_height = rows * (max_img_height + max_title_height) + (rows + 1) * padding
+            resized_images.append(img.copy())
     
     # Create new image with calculated dimensions
     new_image = Image.new('RGB', (canvas_width, canvas_height), color='white')
@@ -252,6 +421,580 @@ def merge_images(
 
     return new_image
 
+def estimate_image_tokens(
+    width: int,
+    height: int,
+    tile_size: int = 512,
+    base_tokens: int = 85,
+    tile_tokens: int = 170,
+    max_side: int = 2048,
+    short_side: Optional[int] = 768,
+    max_tiles: Optional[int] = None
+) -> int:
+    """
+    Estimate the number of tokens a tiled vision model bills for an image.
+
+    The image is fitted within max_side, its shortest side is brought down to short_side,
+    then every tile_size x tile_size tile costs tile_tokens on top of base_tokens.
+
+    :param width: Width of the image in pixels.
+    :param height: Height of the image in pixels.
+    :param max_tiles: Maximum number of tiles the provider bills, None for no limit.
+    :return: Estimated number of image tokens.
+    """
+    width, height = _provider_size(width, height, max_side, short_side)
+
+    tiles = int(np.ceil(width / tile_size) * np.ceil(height / tile_size))
+    if max_tiles is not None:
+        tiles = min(tiles, max_tiles)
+    return base_tokens + tile_tokens * tiles
+
+
+def _provider_size(width: int, height: int, max_side: int, short_side: Optional[int]) -> tuple[float, float]:
+    """
+    Size of an image after the provider's own downscaling.
+    """
+    scale = min(1.0, max_side / max(width, height))
+    if short_side is not None and min(width, height) * scale > short_side:
+        scale = short_side / min(width, height)
+    return width * scale, height * scale
+
+
+def fit_image_to_budget(
+    image: Image.Image,
+    tile_size: int = 512,
+    max_tiles: int = 6,
+    min_side: int = 1024,
+    max_side: int = 2048,
+    short_side: Optional[int] = 768
+) -> Image.Image:
+    """
+    Resize an image to the cheapest tile grid that keeps its text readable.
+
+    The image is first scaled so that its longest side is min_side (never upscaled), which
+    gives the fewest tiles that still keep the chart readable. It is then grown back, up to
+    its original size, to fill that tile grid since the extra pixels are free.
+    If the grid is larger than max_tiles, the image is shrunk to fit max_tiles.
+
+    :param image: PIL Image object.
+    :param tile_size: Side of the provider's tiles in pixels.
+    :param max_tiles: Maximum number of tiles to pay for.
+    :param min_side: Minimum length of the longest side for the chart to stay readable.
+    :param max_side: Longest side accepted by the provider.
+    :param short_side: Shortest side the provider downscales to, None if it does not.
+    :return: Resized PIL Image object, or the image itself if no resize is needed.
+    """
+    width, height = image.size
+    provider_width, provider_height = _provider_size(width, height, max_side, short_side)
+    limit = provider_width / width
+
+    scale = min(limit, min_side / max(width, height))
+    cols = int(np.ceil(width * scale / tile_size))
+    rows = int(np.ceil(height * scale / tile_size))
+
+    while cols * rows > max_tiles and scale > 0:
+        # Drop a row or a column, whichever costs less
+        scale = max(((cols - 1) * tile_size) / width if cols > 1 else 0,
+                    ((rows - 1) * tile_size) / height if rows > 1 else 0)
+        cols = int(np.ceil(width * scale / tile_size))
+        rows = int(np.ceil(height * scale / tile_size))
+
+    if scale <= 0:
+        return image
+
+    # Fill the tile grid
+    scale = min(limit, (cols * tile_size) / width, (rows * tile_size) / height)
+    if scale >= 1.0:
+        return image
+
+    return image.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS)
+
+
+def image_hash(image: Union[str, Image.Image], hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """
+    Compute a perceptual hash (pHash) of an image.
+
+    The image is reduced to a small grayscale square, transformed with a 2D DCT and the
+    low-frequency block is thresholded on its median, so renders that look the same get
+    the same (or a very close) hash even if the files differ byte by byte.
+
+    :param image: PIL Image object or path to the image.
+    :param hash_size: Side of the low-frequency DCT block, the hash has hash_size ** 2 bits.
+    :param highfreq_factor: Downscale factor, the image is resized to hash_size * highfreq_factor.
+    :return: Hash as a python integer.
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+
+    size = hash_size * highfreq_factor
+    pixels = np.asarray(image.convert('L').resize((size, size), Image.LANCZOS), dtype=np.float64)
+
+    # DCT-II basis, applied on rows and columns
+    n = np.arange(size)
+    basis = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    dct = basis @ pixels @ basis.T
+
+    low_freq = dct[:hash_size, :hash_size]
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def color_thumbnail(image: Union[str, Image.Image], size: int = 32) -> np.ndarray:
+    """
+    Small RGB thumbnail of an image, the mean color of every cell of a size x size grid.
+
+    The perceptual hash only sees the grayscale layout, so a recolored series or a new legend
+    keeps the same hash. Comparing thumbnails cell by cell catches these edits.
+
+    :param image: PIL Image object or path to the image.
+    :param size: Side of the grid.
+    :return: Array of shape (size, size, 3).
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+    return np.asarray(image.convert('RGB').resize((size, size), Image.BOX), dtype=np.uint8)
+
+
+def thumbnail_distance(thumbnail_a: np.ndarray, thumbnail_b: np.ndarray) -> int:
+    """
+    Largest difference of a color channel between two thumbnails of the same size.
+    """
+    return int(np.abs(thumbnail_a.astype(np.int16) - thumbnail_b.astype(np.int16)).max())
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """
+    Number of differing bits between two image hashes.
+    """
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def content_mask(pixels: np.ndarray, tolerance: int = 16) -> np.ndarray:
+    """
+    Mask of the pixels that differ from the background of a grayscale frame.
+
+    The background is taken as the median of the border pixels.
+
+    :param pixels: 2D grayscale array.
+    :param tolerance: Grayscale difference from the background for a pixel to count as content.
+    :return: Boolean array of the same shape.
+    """
+    pixels = pixels.astype(np.int16)
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    return np.abs(pixels - np.median(border)) > tolerance
+
+
+def inspect_render(
+    image: Union[str, Image.Image],
+    tolerance: int = 16,
+    min_std: float = 2.0,
+    min_content_ratio: float = 0.002
+) -> dict:
+    """
+    Check whether a rendered chart is blank, near-uniform or has almost no content.
+
+    Everything that differs from the background by more than the tolerance counts as content.
+
+    :param image: PIL Image object or path to the image.
+    :param tolerance: Grayscale difference from the background for a pixel to count as content.
+    :param min_std: Minimum standard deviation of the grayscale frame.
+    :param min_content_ratio: Minimum fraction of content pixels.
+    :return: A dictionary with the blank flag, the reason and the measured values.
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+
+    pixels = np.asarray(image.convert('L'), dtype=np.int16)
+    if pixels.size == 0:
+        return {'blank': True, 'reason': 'empty image', 'std': 0.0, 'content_ratio': 0.0}
+
+    std = float(pixels.std())
+    content_ratio = float(content_mask(pixels, tolerance).mean())
+
+    reason = ''
+    if std < min_std:
+        reason = 'uniform image'
+    elif content_ratio < min_content_ratio:
+        reason = 'almost no content'
+
+    return {
+        'blank': bool(reason),
+        'reason': reason,
+        'std': std,
+        'content_ratio': content_ratio
+    }
+
+
+def _box_mean(pixels: np.ndarray, window: int) -> np.ndarray:
+    """
+    Mean over every window x window block of a 2D array, computed with an integral image.
+    """
+    integral = np.pad(pixels, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    total = (integral[window:, window:] - integral[:-window, window:]
+             - integral[window:, :-window] + integral[:-window, :-window])
+    return total / (window * window)
+
+
+def autocrop_image(image: Union[str, Image.Image], padding: int = 10, tolerance: int = 16) -> tuple:
+    """
+    Crop the background margins around the content of a chart.
+
+    :param image: PIL Image object or path to the image.
+    :param padding: Margin kept around the content in pixels.
+    :param tolerance: Grayscale difference from the background for a pixel to count as content.
+    :return: Tuple of the cropped image and the ratio of the cropped area over the original area.
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+
+    mask = content_mask(np.asarray(image.convert('L')), tolerance)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    # Nothing to crop around
+    if rows.size == 0:
+        return image, 1.0
+
+    width, height = image.size
+    box = (
+        max(int(cols[0]) - padding, 0),
+        max(int(rows[0]) - padding, 0),
+        min(int(cols[-1]) + 1 + padding, width),
+        min(int(rows[-1]) + 1 + padding, height)
+    )
+    if box == (0, 0, width, height):
+        return image, 1.0
+
+    cropped = image.crop(box)
+    return cropped, (cropped.width * cropped.height) / (width * height)
+
+
+def image_similarity(
+    image_a: Union[str, Image.Image],
+    image_b: Union[str, Image.Image],
+    size: int = 256,
+    window: int = 7,
+    bins: int = 8
+) -> dict:
+    """
+    Cheap pixel-level similarity between two charts, all values are in [0, 1].
+
+    - ssim: structural similarity of the downscaled grayscale images.
+    - edge: cosine similarity of the gradient magnitude maps, i.e. of the chart layout.
+    - histogram: intersection of the normalized RGB color histograms.
+
+    :param image_a: First PIL Image object or path.
+    :param image_b: Second PIL Image object or path.
+    :param size: Side of the square both images are downscaled to.
+    :param window: Side of the SSIM window.
+    :param bins: Number of histogram bins per color channel.
+    :return: A dictionary with each metric and their mean as 'score'.
+    """
+    rgb = []
+    for image in (image_a, image_b):
+        if isinstance(image, str):
+            image = Image.open(image)
+        rgb.append(np.asarray(image.convert('RGB').resize((size, size), Image.BILINEAR), dtype=np.float64))
+
+    gray = [pixels @ np.array([0.299, 0.587, 0.114]) for pixels in rgb]
+
+    # Structural similarity with a uniform window
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_a, mean_b = _box_mean(gray[0], window), _box_mean(gray[1], window)
+    var_a = _box_mean(gray[0] ** 2, window) - mean_a ** 2
+    var_b = _box_mean(gray[1] ** 2, window) - mean_b ** 2
+    covariance = _box_mean(gray[0] * gray[1], window) - mean_a * mean_b
+    ssim_map = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / ((mean_a ** 2 + mean_b ** 2 + c1) * (var_a + var_b + c2))
+    ssim = float(np.clip(ssim_map.mean(), 0.0, 1.0))
+
+    # Edge maps
+    edges = []
+    for pixels in gray:
+        grad_y, grad_x = np.gradient(pixels)
+        edges.append(np.hypot(grad_x, grad_y).ravel())
+    norm = np.linalg.norm(edges[0]) * np.linalg.norm(edges[1])
+    if norm > 0:
+        edge = float(edges[0] @ edges[1] / norm)
+    else:
+        # Two flat images have the same (empty) layout
+        edge = 1.0 if np.linalg.norm(edges[0]) == np.linalg.norm(edges[1]) else 0.0
+
+    # Color histograms
+    histograms = []
+    for pixels in rgb:
+        quantized = (pixels.astype(np.int64) * bins) // 256
+        index = (quantized[..., 0] * bins + quantized[..., 1]) * bins + quantized[..., 2]
+        histogram = np.bincount(index.ravel(), minlength=bins ** 3)
+        histograms.append(histogram / histogram.sum())
+    histogram = float(np.minimum(histograms[0], histograms[1]).sum())
+
+    return {
+        'ssim': ssim,
+        'edge': edge,
+        'histogram': histogram,
+        'score': (ssim + edge + histogram) / 3
+    }
+
+
+CODE_LANGUAGES = {
+    'python': ('python', 'python3', 'py'),
+    'html': ('html',),
+}
+
+
+class CodeFenceParser:
+    """
+    Incremental parser of fenced code blocks in a streamed response.
+
+    The program is the LAST closed block of the target language, the rule the environments
+    apply to a full response (get_code_from_text_response(action)[-1]), since models often
+    sketch code before the final block. A stream can only be cut once a block of the target
+    language is closed and tail_chars of text followed it without a new fence opening.
+
+    Tolerates the formatting mistakes models make (see note.txt): a fence opened twice
+    (```python followed by ```python), a fence opened in the middle of a line
+    ("chart:```python") and stray <image> placeholders inside the code.
+    """
+
+    def __init__(self, language: str = 'python', tail_chars: int = 0):
+        """
+        :param language: Language of the code block to wait for, a key of CODE_LANGUAGES.
+        :param tail_chars: Text to read after the last closed block before the response can be cut.
+        """
+        self.languages = CODE_LANGUAGES.get(language, (language,))
+        self.tail_chars = tail_chars
+        self.text = ''
+        self.language = None
+        self.code_lines = []
+        # Language and code of every closed block of the target language
+        self.blocks = []
+        self._tail = 0
+        self._pending = ''
+        self._inside = False
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether a block of the target language was closed.
+        """
+        return bool(self.blocks)
+
+    def can_stop(self) -> bool:
+        """
+        Whether the response can be cut: a block of the target language is closed and at
+        least tail_chars of text followed it outside any fence.
+        """
+        return self.done and not self._inside and self._tail >= self.tail_chars
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Feed a chunk of the response.
+
+        :param chunk: Text received since the last call.
+        :return: True once the response can be cut (see can_stop).
+        """
+        self.text += chunk
+        self._pending += chunk
+        while '\n' in self._pending:
+            line, self._pending = self._pending.split('\n', 1)
+            self._line(line)
+        return self.can_stop()
+
+    def finish(self) -> bool:
+        """
+        Parse the last line of the response, once the stream has ended.
+
+        :return: True if a code block of the target language was closed.
+        """
+        if self._pending:
+            self._line(self._pending)
+            self._pending = ''
+        return self.done
+
+    def _line(self, line: str) -> None:
+        stripped = line.strip()
+
+        if not self._inside:
+            if '```' in line:
+                self._inside = True
+                self.language = line.split('```', 1)[1].strip().lower()
+                self.code_lines = []
+            elif self.done:
+                self._tail += len(line) + 1
+            return
+
+        if stripped.startswith('```'):
+            language = stripped[3:].strip().lower()
+            if language and not ''.join(self.code_lines).strip():
+                # Doubled opening fence, keep the last language
+                self.language = language
+                return
+            self._close()
+            if language:
+                # Closing and opening fences on the same line
+                self._inside = True
+                self.language = language
+                self.code_lines = []
+            return
+
+        if stripped.endswith('```'):
+            # Closing fence right after the last line of code
+            self.code_lines.append(line.rstrip()[:-3])
+            self._close()
+            return
+
+        if stripped == '<image>':
+            return
+
+        self.code_lines.append(line)
+
+    def _close(self) -> None:
+        self._inside = False
+        if self.language in self.languages and ''.join(self.code_lines).strip():
+            self.blocks.append((self.language, '\n'.join(self.code_lines).strip('\n')))
+            self._tail = 0
+
+    @property
+    def code(self) -> Optional[str]:
+        """
+        Code of the last block of the target language, None until one is closed.
+        """
+        return self.blocks[-1][1] if self.blocks else None
+
+    def response(self) -> str:
+        """
+        The last code block alone, with a single well-formed fence so that
+        get_code_from_text_response reads the same code as the parser.
+        """
+        if not self.done:
+            return self.text
+        language, code = self.blocks[-1]
+        return f"```{language}\n{code}\n```"
+
+
+def extract_code(text: str, language: str = 'python') -> str:
+    """
+    Code of the last fenced block of the language in a response, the block the environments render,
+    or the text itself if it has no such block.
+    """
+    if not text:
+        return ''
+    parser = CodeFenceParser(language)
+    parser.feed(text)
+    parser.finish()
+    return parser.code if parser.done else text.strip()
+
+
+def normalize_code(code: str, language: str = 'python') -> str:
+    """
+    Normalize code so that programs differing only in layout compare equal: trailing
+    whitespace, blank lines and whole-line comments (# for python, <!-- --> for html) are dropped.
+    """
+    if language == 'html':
+        code = re.sub(r'<!--.*?-->', '', code or '', flags=re.DOTALL)
+    lines = []
+    for line in (code or '').splitlines():
+        line = line.rstrip()
+        if not line.strip() or (language == 'python' and line.lstrip().startswith('#')):
+            continue
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def code_hash(code: str, language: str = 'python') -> str:
+    """
+    Hash of the normalized code, equal for programs that differ only in layout and comments.
+    """
+    return hashlib.sha256(normalize_code(code, language).encode('utf-8')).hexdigest()
+
+
+EDIT_BLOCK_PATTERN = re.compile(r'<{5,9} SEARCH[^\n]*\n(.*?)\n?={5,9}\n(.*?)\n?>{5,9} REPLACE', re.DOTALL)
+
+
+def parse_edits(text: str) -> list:
+    """
+    Search/replace edit blocks of a response.
+
+    :param text: Response with blocks of the form <<<<<<< SEARCH / ======= / >>>>>>> REPLACE.
+    :return: List of (search, replace) tuples, in order.
+    """
+    return [(search, replace) for search, replace in EDIT_BLOCK_PATTERN.findall(text or '')]
+
+
+def _find_lines(lines: list, search_lines: list, normalize) -> Optional[int]:
+    """
+    Index of the first line where search_lines match lines, comparing normalized lines.
+    """
+    target = [normalize(line) for line in search_lines]
+    normalized = [normalize(line) for line in lines]
+    for start in range(len(lines) - len(target) + 1):
+        if normalized[start:start + len(target)] == target:
+            return start
+    return None
+
+
+def apply_edits(code: str, edits: list) -> tuple:
+    """
+    Apply search/replace edits to code.
+
+    Each search block is matched exactly at the start of a line first, then line by line ignoring
+    trailing whitespace, then ignoring indentation (the replacement is re-indented by the difference),
+    and last as a fragment of a line. An empty search block appends the replacement.
+
+    :param code: Code to edit.
+    :param edits: List of (search, replace) tuples.
+    :return: Tuple of the edited code and the list of edits whose search block was not found.
+    """
+    failed = []
+    for search, replace in edits:
+        if not search.strip():
+            code = code.rstrip('\n') + '\n' + replace
+            continue
+
+        index = code.find(search)
+        if index == 0 or (index > 0 and code[index - 1] == '\n'):
+            code = code[:index] + replace + code[index + len(search):]
+            continue
+
+        lines = code.split('\n')
+        search_lines = search.strip('\n').split('\n')
+        replace_lines = replace.split('\n') if replace else []
+
+        start = _find_lines(lines, search_lines, str.rstrip)
+        if start is None:
+            start = _find_lines(lines, search_lines, str.strip)
+            if start is not None:
+                # Shift the replacement by the indentation difference of the first line
+                found_indent = len(lines[start]) - len(lines[start].lstrip())
+                search_indent = len(search_lines[0]) - len(search_lines[0].lstrip())
+                shift = found_indent - search_indent
+                if shift > 0:
+                    replace_lines = [' ' * shift + line if line.strip() else line for line in replace_lines]
+                elif shift < 0:
+                    replace_lines = [line[min(-shift, len(line) - len(line.lstrip())):] for line in replace_lines]
+
+        if start is None:
+            if index >= 0:
+                # Fragment of a line
+                code = code[:index] + replace + code[index + len(search):]
+            else:
+                failed.append((search, replace))
+            continue
+
+        code = '\n'.join(lines[:start] + replace_lines + lines[start + len(search_lines):])
+
+    return code, failed
+
+
+def code_diff(old_code: str, new_code: str, context: int = 3) -> str:
+    """
+    Unified diff between two versions of the code, with a few lines of context around every change.
+    """
+    diff = difflib.unified_diff(old_code.split('\n'), new_code.split('\n'),
+                                fromfile='previous', tofile='current', n=context, lineterm='')
+    return '\n'.join(diff)
+
+
 if __name__ == "__main__":
 
     text = "### Critique:\nThe code correctly converts the line graph data into a grouped bar chart as requested. It aligns the years across the three datasets, fills missing data with zero, and plots the bars side-by-side with appropriate width and spacing. The title and axis labels are added correctly, and the legend distinguishes the three groups. The figure size is reasonable for clarity.\n\nOne minor improvement could be to use `np.nan` instead of zero for missing data so that bars are not shown for missing years, but zero also works visually. Overall, the chart is clear, accurate, and aesthetically reasonable.\n\n### Score\n5"